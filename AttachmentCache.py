@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from Metrics import CACHE_LOOKUPS
+
+class AttachmentCache:
+    '''
+    Content addressed on-disk cache for text extracted from attachments (embedded text, OCR text, page stats).
+
+    Entries are json files named by the sha256 of the attachment bytes plus the extraction settings, so a
+    re-posted file costs a hash instead of a full re-extraction. The total size of the entries on disk is
+    bounded by max_bytes, and the least recently used entries are evicted first (recency survives restarts
+    through the files' mtimes).
+
+    Thread safe, since extraction runs in worker threads.
+    '''
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict() # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(content: bytes, *settings: object) -> str:
+        '''Key for content extracted with the given settings (e.g. ocr mode), anything that changes the output must be in settings'''
+        digest = hashlib.sha256(content).hexdigest()
+        suffix = "-".join(str(x) for x in settings)
+        return f"{digest}-{suffix}" if suffix else digest
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_index(self) -> None:
+        '''rebuild the in-memory LRU order from the files on disk, oldest mtime first'''
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            st = os.stat(os.path.join(self.cache_dir, filename))
+            entries.append((st.st_mtime, filename[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def get(self, key: str) -> dict | None:
+        '''Returns the cached entry for key, or None on a miss'''
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="attachment", result="miss")
+                return None
+            try:
+                with open(self._path(key), "r") as f:
+                    entry = json.load(f)
+                os.utime(self._path(key)) # persist the recency
+            except (OSError, ValueError):
+                # deleted or corrupted behind our back
+                self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache="attachment", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.inc(cache="attachment", result="hit")
+            return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        '''Store entry under key, then evict the least recently used entries until under max_bytes'''
+        data = json.dumps(entry).encode()
+        with self._lock:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return f"attachment cache: {len(self._entries)} entries, {self._total_bytes} bytes | hits: {self.hits} misses: {self.misses} hit rate: {hit_rate:.2%}"
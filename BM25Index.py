@@ -0,0 +1,102 @@
+import os
+import re
+import json
+import math
+import heapq
+import threading
+from collections import Counter
+
+# too common to tell chunks apart, leaving them out keeps the posting lists that get scored short
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have i if in into is it its of on or so that the their then there these
+they this to was we were what when which who will with you your
+""".split())
+
+def tokenize(text: str) -> list[str]:
+    '''lowercased words, keeping identifiers and codes like ERR_CONN_RESET or 0x80070005 whole'''
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS]
+
+class BM25Index:
+    '''
+    In-process inverted index scoring documents (chunks) with BM25, for the exact identifiers, error codes and
+    names that embedding search tends to miss.
+
+    Only the posting lists of the query's terms are scored, so a lookup costs about the number of chunks containing
+    those terms, not the size of the index. Additions are appended to a jsonl file (one line per chunk: its id and
+    term frequencies) which is replayed on load.
+    '''
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._ids: list[str] = [] # internal doc number -> chunk id
+        self._numbers: dict[str, int] = {} # chunk id -> internal doc number
+        self._lengths: list[int] = []
+        self._total_length = 0
+        self._postings: dict[str, dict[int, int]] = {} # term -> doc number -> term frequency
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self._numbers
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # torn last line of a crash mid-write
+                self._add(entry["id"], entry["tf"])
+
+    def _add(self, chunk_id: str, term_frequencies: dict[str, int]) -> None:
+        number = len(self._ids)
+        self._ids.append(chunk_id)
+        self._numbers[chunk_id] = number
+        length = sum(term_frequencies.values())
+        self._lengths.append(length)
+        self._total_length += length
+        postings = self._postings
+        for term, tf in term_frequencies.items():
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = {}
+            posting[number] = tf
+
+    def add_many(self, chunks: list[tuple[str, str]]) -> None:
+        '''Index (chunk id, text) pairs, chunks that are already indexed are ignored'''
+        with self._lock:
+            lines = []
+            for chunk_id, text in chunks:
+                if chunk_id in self._numbers:
+                    continue
+                term_frequencies = dict(Counter(tokenize(text)))
+                self._add(chunk_id, term_frequencies)
+                lines.append(json.dumps({"id": chunk_id, "tf": term_frequencies}) + "\n")
+            if len(lines) > 0:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.writelines(lines)
+
+    def query(self, text: str, k: int) -> list[tuple[str, float]]:
+        '''Top k (chunk id, score) for text, best first. Chunks sharing no term with text are never returned'''
+        n = len(self._ids)
+        if n == 0:
+            return []
+        avg_length = self._total_length / n
+        scores: dict[int, float] = {}
+        for term in set(tokenize(text)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for number, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[number] / avg_length)
+                scores[number] = scores.get(number, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+        return [(self._ids[number], score) for number, score in best]
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from Metrics import CACHE_LOOKUPS
+
+class BlobStore:
+    '''
+    Content addressed store for the bulky parts of threads (image bytes, extracted pdf text), so messages only hold a
+    small reference to them: {"hash": sha256, "mime": ..., "size": bytes, ...} (see put).
+
+    Every blob is written once to a file under data_dir named after its hash, which is what evicted sessions and
+    saved threads refer to. The most recently used blobs are also kept in memory, up to max_bytes, so materializing
+    the active threads for a request rarely touches the disk. The same upload in several threads is stored once.
+
+    Blobs no thread refers to anymore (threads reset, trimmed or deleted) are removed by sweep.
+
+    File reads and writes run in a worker thread to keep them off the event loop.
+    '''
+    def __init__(self, data_dir: str, max_bytes: int):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.data_dir, blob_hash[:2], blob_hash)
+
+    def _write(self, blob_hash: str, data: bytes) -> None:
+        path = self._path(blob_hash)
+        if os.path.exists(path):
+            os.utime(path) # same content, already stored. Newly referenced again, keep it out of the next sweep
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, blob_hashes: list[str]) -> dict[str, bytes]:
+        blobs = {}
+        for blob_hash in blob_hashes:
+            try:
+                with open(self._path(blob_hash), "rb") as f:
+                    blobs[blob_hash] = f.read()
+            except FileNotFoundError:
+                continue # deleted from data_dir, left for the caller to deal with
+        return blobs
+
+    def _remember(self, blob_hash: str, data: bytes) -> None:
+        if blob_hash in self._memory:
+            self._memory.move_to_end(blob_hash)
+            return
+        self._memory[blob_hash] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_bytes -= len(dropped) # still on disk
+
+    async def put(self, data: bytes, mime: str, **metadata: Any) -> dict:
+        '''Store data, returns the reference to keep in the thread (metadata, e.g. width and height, is added to it)'''
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if blob_hash not in self._memory:
+            await asyncio.to_thread(self._write, blob_hash, data)
+        self._remember(blob_hash, data)
+        return {"hash": blob_hash, "mime": mime, "size": len(data), **metadata}
+
+    async def get_many(self, blob_hashes: list[str]) -> dict[str, bytes]:
+        '''
+        The blobs with the given hashes, those that aren't in memory are read from disk in one go.
+        A blob that is neither in memory nor on disk is left out.
+        '''
+        blobs, missing = {}, []
+        for blob_hash in dict.fromkeys(blob_hashes):
+            data = self._memory.get(blob_hash)
+            if data is None:
+                missing.append(blob_hash)
+                continue
+            self._memory.move_to_end(blob_hash)
+            blobs[blob_hash] = data
+        self.hits += len(blobs)
+        self.misses += len(missing)
+        CACHE_LOOKUPS.inc(len(blobs), cache="blob", result="hit")
+        CACHE_LOOKUPS.inc(len(missing), cache="blob", result="miss")
+        if len(missing) > 0:
+            for blob_hash, data in (await asyncio.to_thread(self._read, missing)).items():
+                self._remember(blob_hash, data)
+                blobs[blob_hash] = data
+        return blobs
+
+    async def get(self, blob_hash: str) -> bytes:
+        return (await self.get_many([blob_hash]))[blob_hash]
+
+    def _sweep(self, referenced: set[str], min_age_s: float) -> list[str]:
+        removed = []
+        cutoff = time.time() - min_age_s
+        if not os.path.isdir(self.data_dir):
+            return removed
+        for prefix in os.listdir(self.data_dir):
+            prefix_dir = os.path.join(self.data_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    if name in referenced or os.path.getmtime(path) > cutoff:
+                        continue
+                    os.remove(path)
+                    removed.append(name)
+                except FileNotFoundError:
+                    continue
+        return removed
+
+    async def sweep(self, referenced: set[str], min_age_s: float = 3600) -> int:
+        '''
+        Delete the blobs whose hash is not in referenced, returns how many were deleted.
+        Blobs stored (or stored again) in the last min_age_s seconds are kept, they may belong to a message that
+        is being handled and isn't in any thread yet.
+        '''
+        removed = await asyncio.to_thread(self._sweep, referenced, min_age_s)
+        for blob_hash in removed:
+            data = self._memory.pop(blob_hash, None)
+            if data is not None:
+                self._memory_bytes -= len(data)
+        return len(removed)
+
+    def stats(self) -> str:
+        return f"blobs: {len(self._memory)} in memory (~{self._memory_bytes} bytes), {self.hits} hits, {self.misses} read from disk"
+
+def referenced_blobs(messages: Iterable[dict]) -> set[str]:
+    '''hashes of the blobs the image and pdf references in messages point to'''
+    hashes = set()
+    for message in messages:
+        if isinstance(message["content"], str):
+            continue
+        for part in message["content"]:
+            if part["type"] in ("image", "pdf"):
+                hashes.add(part[part["type"]]["hash"])
+    return hashes
@@ -1,7 +1,15 @@
+from __future__ import annotations
 from GenerativeAI import Image_Gen_Controller, LLM_Controller
-import asyncio
+import os
+import time
+import discord
+from urllib.parse import urlparse
 from Utils import find_text_between_markers, Message
-from VectorDB import VectorDB
+from VectorDB import VectorDB, AsyncVectorDB, dedupe_chunks, pack_chunks
+from TokenCounter import count_text_tokens
+from EmbeddingCache import EmbeddingCache
+from Metrics import stage
+from ReminderScheduler import ReminderScheduler, Reminder
 
 class CommandInterpreter:
     '''
@@ -23,7 +31,47 @@ class CommandInterpreter:
         chroma_data_path = f"{app_data_dir}/chroma_data"
         embed_model = "all-MiniLM-L6-v2"
         collection_name = "main"
-        self.vectorDB = VectorDB(chroma_data_path, embed_model, collection_name)
+        vectorDB = VectorDB(chroma_data_path, embed_model, collection_name, # loaded on first use
+                            chunk_tokens=int(os.getenv("VECTORDB_CHUNK_TOKENS", "200")),
+                            chunk_overlap=int(os.getenv("VECTORDB_CHUNK_OVERLAP", "32")),
+                            embed_batch_size=int(os.getenv("VECTORDB_EMBED_BATCH_SIZE", "64")),
+                            embedding_cache=EmbeddingCache(f"{app_data_dir}/embedding_cache.sqlite3",
+                                                           max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))),
+                            backend=os.getenv("VECTORDB_BACKEND", "chroma"), # chroma or numpy
+                            numpy_dtype=os.getenv("VECTORDB_NUMPY_DTYPE", "float32"))
+        # embeddings and searches run on a worker thread, concurrent queries are batched together
+        self.vectorDB = AsyncVectorDB(vectorDB, batch_window_s=float(os.getenv("VECTORDB_BATCH_WINDOW_S", "0.01")))
+        self.query_mode = os.getenv("VECTORDB_QUERY_MODE", "hybrid") # vector, lexical or hybrid (both, fused)
+        # query picks query_k diverse chunks out of the best query_candidates, then packs them into the model's budget
+        self.query_k = int(os.getenv("VECTORDB_QUERY_K", "8"))
+        self.query_candidates = int(os.getenv("VECTORDB_QUERY_CANDIDATES", "32"))
+        self.mmr_lambda = float(os.getenv("VECTORDB_MMR_LAMBDA", "0.5"))
+
+        # pending reminders are persisted and delivered from one task, through the discord client once it's attached
+        self.discord_client: discord.Client | None = None
+        self.reminders = ReminderScheduler(f"{app_data_dir}/reminders.sqlite3", self._deliver_reminder)
+
+    def start_reminders(self, client: discord.Client) -> None:
+        '''Deliver reminders through client from now on, including the ones saved before a restart'''
+        self.discord_client = client
+        self.reminders.start()
+
+    async def close(self) -> None:
+        '''Stop delivering reminders and the vector db's worker thread'''
+        await self.reminders.close()
+        self.vectorDB.close()
+
+    async def _deliver_reminder(self, reminder: Reminder) -> None:
+        if self.discord_client is None:
+            print(f"REMINDER: {reminder.text}")
+            return
+        channel = self.discord_client.get_channel(reminder.channel_id) or await self.discord_client.fetch_channel(reminder.channel_id)
+        await channel.send(f"<@{reminder.user_id}> REMINDER: {reminder.text}")
+
+    def warm_up(self) -> None:
+        '''Load the lazily initialized subsystems (image gen client, vector db) ahead of their first use'''
+        self.image_gen.warm_up()
+        self.vectorDB.warm_up()
 
     async def main(self, msg : Message, command : str | None = None) -> None | str:
         '''
@@ -34,6 +82,11 @@ class CommandInterpreter:
 
         Assumes: command does NOT have a command prefix symbol.
         '''
+        with stage("command_interpreter", msg.trace):
+            return await self._handle(msg, command)
+
+    async def _handle(self, msg : Message, command : str | None) -> None | str:
+        '''Handles the command, see main'''
         # Before this function would take command separately, but now it is assumed that the command is in the message
         # allow the old way of passing in the command to be used still.
         if command is None:
@@ -43,27 +96,28 @@ class CommandInterpreter:
             return self.help_str
 
         if command == "chroma status":
-            return "on"
+            return f"on | {self.vectorDB.stats()}"
 
         if command[0:9] == "remind me":
             try:
                 tmp = list(map(str.strip, command.split(',')))
-                task, time, unit = tmp[1], float(tmp[2]), tmp[3]
+                task, amount, unit = tmp[1], float(tmp[2]), tmp[3]
                 if unit == "s":
-                    remind_time = time
+                    remind_time = amount
                 elif unit == "m":
-                    remind_time = time * 60
+                    remind_time = amount * 60
                 elif unit == "h":
-                    remind_time = time * 3600
+                    remind_time = amount * 3600
                 elif unit == "d":
-                    remind_time = time * 86400
+                    remind_time = amount * 86400
                 else:
                     await Message.send_msg_to_usr(msg, "only time units implemented: s, m, h, d")
                     return
 
-                await Message.send_msg_to_usr(msg, f"Reminder set for '{task}' in {time} {unit}.")
-                await asyncio.sleep(remind_time)
-                await Message.send_msg_to_usr(msg, f"REMINDER: {task}")
+                channel_id = msg.discordMsg.channel.id if msg.discordMsg is not None else 0
+                user_id = msg.author.id if msg.author is not None else 0
+                await self.reminders.add(time.time() + remind_time, channel_id, user_id, task)
+                await Message.send_msg_to_usr(msg, f"Reminder set for '{task}' in {amount} {unit}.")
             except Exception as _:
                 await Message.send_msg_to_usr(msg, "usage: remind me, [task_description], [time], [unit]")
             return
@@ -87,25 +141,44 @@ class CommandInterpreter:
         ### Vector DB
         # user uploads a pdf to ingest into the vector db
         if command == "upload":
+            ocr_summaries = []
+            documents, metadatas = [], []
             if msg.attachments:
                 for pdf in msg.attachments['pdfs']:
-                    embedded_text, ocr_text = pdf.embedded_text, pdf.ocr_text
-                    document = "\nPDF CONTENTS:\n" + embedded_text + "\nOCR CONTENTS:\n" + ocr_text
-                    self.vectorDB.upload(document)
+                    source = os.path.basename(urlparse(pdf.url).path)
+                    if pdf.extraction is not None:
+                        # one document per page so that every chunk knows which page it came from
+                        pages = zip(pdf.extraction.embedded_pages, pdf.extraction.ocr_pages)
+                        for page, (embedded_text, ocr_text) in enumerate(pages, start=1):
+                            documents.append(embedded_text + "\n" + ocr_text)
+                            metadatas.append({"source": source, "page": page})
+                        ocr_summaries.append(pdf.extraction.summary())
+                    else:
+                        documents.append(pdf.embedded_text + "\n" + pdf.ocr_text)
+                        metadatas.append({"source": source})
                 for text in msg.attachments['texts']:
-                    self.vectorDB.upload(text)
-            return "Upload complete."
+                    documents.append(text)
+                    metadatas.append({"source": "text attachment"})
+            chunks, duplicates = await self.vectorDB.upload_many(documents, metadatas)
+            return "\n".join([f"Upload complete, {chunks} chunks stored, {duplicates} duplicate chunks skipped."] + ocr_summaries)
 
         if command[:5] == "query":
+            if self.gpt_interpreter is None:
+                raise Exception("command interpreter's unexpected gpt interpreter is None.")
             # get context from db
             db_query_prompt = command[6:]
-            db_context = self.vectorDB.query(db_query_prompt)[0]
+            chunks = await self.vectorDB.query(db_query_prompt, k=self.query_k, mode=self.query_mode,
+                                               candidates=self.query_candidates, mmr_lambda=self.mmr_lambda)
+            if len(chunks) == 0:
+                if await self.vectorDB.size() == 0:
+                    return "The vector db is empty, `upload` some documents first."
+                return "Found nothing in the vector db matching the query."
+            model, budget = await self.gpt_interpreter.rag_settings(msg)
+            db_context = "\n---\n".join(pack_chunks(dedupe_chunks(chunks), budget, lambda text: count_text_tokens(text, model)))
 
             # pass to gpt
-            prompt = f"ORIGINAL USER QUERY:{command[6:]}\nVECTOR DB CONTEXT:{db_context}\nRESPONSE:"
-            if self.gpt_interpreter is None:
-                raise Exception("command interpreter's unexpected gpt interpreter is None.")
-            gpt_response = await self.gpt_interpreter.main(Message.from_text(prompt))
+            prompt = f"ORIGINAL USER QUERY:{db_query_prompt}\nVECTOR DB CONTEXT:{db_context}\nRESPONSE:"
+            gpt_response = await self.gpt_interpreter.main(Message.from_text(prompt, parent=msg))
 
             return gpt_response
 
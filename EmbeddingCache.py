@@ -0,0 +1,96 @@
+import os
+import time
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+import numpy as np
+
+from Metrics import CACHE_LOOKUPS
+
+class EmbeddingCache:
+    '''
+    Persistent cache of text embeddings in a sqlite database, keyed by (embedding model, sha256 of the text),
+    so identical text is only ever embedded once per model, across uploads and restarts.
+    Vectors are stored as float32 blobs.
+    At most max_entries vectors are kept, the least recently used are deleted when new ones push it over.
+    '''
+    def __init__(self, db_path: str, max_entries: int = 200_000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    used REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (model, text_hash)
+                )''')
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(embeddings)")]
+            if "used" not in columns: # created before the cap
+                conn.execute("ALTER TABLE embeddings ADD COLUMN used REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def embed(self, model: str, texts: list[str], embed: Callable[[list[str]], list]) -> list[np.ndarray]:
+        '''
+        Embeddings of texts under model: cached ones are read from the database, the rest are computed
+        with a single call to embed and stored.
+        '''
+        hashes = [self.text_hash(text) for text in texts]
+        found: dict[str, np.ndarray] = {}
+        now = time.time()
+        with self._connect() as conn:
+            # sqlite caps the number of bound parameters, look the hashes up in slices
+            unique = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                rows = conn.execute(f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                                    [model, *part]).fetchall()
+                found.update((h, np.frombuffer(vector, dtype=np.float32)) for h, vector in rows)
+                if len(rows) > 0:
+                    conn.execute(f"UPDATE embeddings SET used = ? WHERE model = ? AND text_hash IN ({placeholders})",
+                                 [now, model, *part])
+
+            missing = list(dict.fromkeys(h for h in hashes if h not in found)) # unique, in order
+            self.hits += len(texts) - sum(1 for h in hashes if h not in found)
+            self.misses += len(missing)
+            CACHE_LOOKUPS.inc(len(texts) - len(missing), cache="embedding", result="hit")
+            CACHE_LOOKUPS.inc(len(missing), cache="embedding", result="miss")
+            if len(missing) > 0:
+                text_of = dict(zip(hashes, texts))
+                vectors = embed([text_of[h] for h in missing])
+                for h, vector in zip(missing, vectors):
+                    found[h] = np.asarray(vector, dtype=np.float32)
+                conn.executemany("INSERT OR REPLACE INTO embeddings (model, text_hash, vector, used) VALUES (?, ?, ?, ?)",
+                                 [(model, h, found[h].tobytes(), now) for h in missing])
+                self._evict(conn)
+        return [found[h] for h in hashes]
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        excess = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+            self.evictions += excess
+
+    def stats(self) -> str:
+        return f"embedding cache: {self.hits} hits, {self.misses} misses, {self.evictions} evicted"
@@ -1,14 +1,24 @@
-from openai import OpenAI
+from __future__ import annotations
 import os
-import pickle
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from Utils import constructHelpMsg, Message
+import weakref
+from contextlib import asynccontextmanager
+from Utils import constructHelpMsg, Message, StreamingReply, outbound_queue
 import time
 from PIL import Image
 import io
 import base64
 from abc import ABC, abstractmethod
+from TokenCounter import count_message_tokens, count_text_tokens, TOKENS_PER_REPLY
+from SessionStore import Session, SessionStore
+from ResponseCache import ResponseCache
+from ThreadStore import ThreadStore
+from BlobStore import BlobStore, referenced_blobs
+from Metrics import stage, IN_FLIGHT, QUEUED, TOKENS
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI # imported on first use, the package takes about a second to import
 
 #################### Abstract Classes defining the common interface #################### 
 
@@ -22,20 +32,81 @@ class LLM_Instance(ABC):
     async def main(self, msg: Message) -> str:
         pass
 
+class RequestLimiter:
+    '''
+    Bounds how many requests are in flight to a provider's API at once. Requests over the limit wait their turn.
+    There is one per provider API for the whole app (see llm_limiters, image_gen_limiters), shared by every
+    controller and provider instance, so outbound throughput is governed in one place.
+    name labels its in flight / queued gauges in the metrics.
+    '''
+    def __init__(self, max_in_flight: int, name: str = "default"):
+        self.max_in_flight = max_in_flight
+        self.name = name
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.queued = 0 # waiting for a free slot
+        self.completed = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        '''Hold one of the in-flight slots for the duration of the block'''
+        self.queued += 1
+        QUEUED.inc(limiter=self.name)
+        try:
+            with stage(f"{self.name}_limiter_wait"):
+                await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+            QUEUED.dec(limiter=self.name)
+        self.in_flight += 1
+        IN_FLIGHT.inc(limiter=self.name)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            IN_FLIGHT.dec(limiter=self.name)
+            self.completed += 1
+            self._semaphore.release()
+
+    def stats(self) -> str:
+        return f"in flight: {self.in_flight}/{self.max_in_flight} | queued: {self.queued} | completed: {self.completed}"
+
+# one limiter per provider API, every LLM_Controller / Image_Gen_Controller (main and the personal assistant
+# each have their own) and every provider instance goes through these
+llm_limiters = {
+    "openai": RequestLimiter(int(os.getenv("LLM_MAX_IN_FLIGHT", "8")), name="llm"),
+    "anthropic": RequestLimiter(int(os.getenv("ANTHROPIC_MAX_IN_FLIGHT", "8")), name="anthropic"),
+}
+image_gen_limiters = {
+    "openai": RequestLimiter(int(os.getenv("IMAGE_GEN_MAX_IN_FLIGHT", "2")), name="image_gen"),
+    "stable diffusion": RequestLimiter(int(os.getenv("STABLE_DIFFUSION_MAX_IN_FLIGHT", "1")), name="stable_diffusion"),
+}
+
 #################### Specific implementations that will implement the abstract classes #################### 
 
 class Dalle(Image_Gen_Instance):
-    def __init__(self):
+    def __init__(self, limiter: RequestLimiter | None = None):
         self.model = "dall-e-3"
-        self.client = OpenAI()
+        self._client: AsyncOpenAI | None = None
+        self.limiter = limiter if limiter is not None else image_gen_limiters["openai"]
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI()
+        return self._client
+
+    def warm_up(self) -> None:
+        self.client
 
     async def main(self, msg: Message) -> Image.Image:
         '''
         Create an image using Dalle from openai and return it as a base64-encoded image
         '''
         prompt = msg.content
-        def blocking_api_call():
-            return self.client.images.generate(
+        async with self.limiter.slot(), stage("image_generation", msg.trace, model=self.model):
+            response = await self.client.images.generate(
                         model = self.model,
                         prompt = prompt,
                         size = "1024x1024",
@@ -44,10 +115,6 @@ class Dalle(Image_Gen_Instance):
                         n = 1,
                     )
 
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            response = await loop.run_in_executor(executor, blocking_api_call)
-
         # decode from base 64 json into image
         tmp = response.data[0].b64_json
         encoded_img = tmp if tmp is not None else ""
@@ -57,20 +124,25 @@ class Dalle(Image_Gen_Instance):
         return image
 
 class Stable_Diffusion(Image_Gen_Instance):
-    def __init__(self):
-        pass
+    def __init__(self, limiter: RequestLimiter | None = None):
+        self.limiter = limiter if limiter is not None else image_gen_limiters["stable diffusion"]
 
     async def main(self, msg: Message) -> Image.Image:
         # TODO:
-        return Image.new('RGB', (1024, 1024), color='black')
+        async with self.limiter.slot():
+            return Image.new('RGB', (1024, 1024), color='black')
 
 class OpenAI_LLM(LLM_Instance):
-    def __init__(self, readPromptFile:bool=False, app_data_dir: str = './data', default_model: str = 'gpt-4o'):
+    def __init__(self, readPromptFile:bool=False, app_data_dir: str = './data', default_model: str = 'gpt-4o', limiter: RequestLimiter | None = None):
         self.api_key = os.getenv("OPENAI_API_KEY", "")
         assert self.api_key != '', 'OPENAI_API_KEY environment variable not found.'
-        self.app_data_dir = os.getenv("APP_DATA_DIR", "./data")
+        self.app_data_dir = app_data_dir
 
-        self.client = OpenAI(api_key=self.api_key)
+        self._client: AsyncOpenAI | None = None
+        self.limiter = limiter if limiter is not None else llm_limiters["openai"]
+        self.response_cache = ResponseCache(ttl_s=float(os.getenv("RESPONSE_CACHE_TTL_S", "3600")),
+                                            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+                                            semantic=os.getenv("RESPONSE_CACHE_SEMANTIC", "False").lower() in ("true", "1", "yes"))
 
         # format: [max return tokens] [context length] [knowledge cutoff]
         self.gpt_models_info = {
@@ -94,18 +166,32 @@ class OpenAI_LLM(LLM_Instance):
             "presence_penalty": ["0", "float"],
             "max_tokens": [self.gpt_models_info[default_model][0], "int"],
             "context_length": [self.gpt_models_info[default_model][1], "int"],
-            "knowledge_cutoff": [self.gpt_models_info[default_model][2], "str"]
+            "knowledge_cutoff": [self.gpt_models_info[default_model][2], "str"],
+            "stream": ["True", "bool"], # stream replies into discord as they are generated, when the caller supports it
+            "cache": ["False", "bool"], # reuse cached completions for repeated requests (only when temperature is 0)
+            "rag_context_tokens": ["2000", "int"] # budget for the vector db context pasted into `query` prompts
         }
         self.chatgpt_name="assistant"
         self.cmd_prefix = "!"
 
+        # every conversation (see Message.session_key) has its own session with its own thread, prompt and settings.
+        # gpt_settings above belongs to the default session, which new sessions are copied from.
+        self.sessions = SessionStore(f"{app_data_dir}/sessions", self._new_session,
+                                     max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+                                     max_sessions=int(os.getenv("SESSION_MAX_RESIDENT", "256")))
+
         # gpt prompts
         self.gpt_prompts_file = f"{app_data_dir}/gpt_prompts.txt"
         self.all_gpt_available_prompts = [] # list of all prompt names
         self.map_promptname_to_prompt = {} # dictionary of (k,v) = (prompt_name, prompt_as_str)
-        self.curr_prompt_name = None  # name of prompt we're currently using
         self.hotswap_models = ["gpt-4-0125-preview", "gpt-4-vision-preview"] # for now not changeable.
-        self.pickled_threads_dir = f"{app_data_dir}/pickled_threads"
+        self.thread_store = ThreadStore(f"{app_data_dir}/threads.sqlite3")
+        # threads saved before the thread store existed were pickled one per file
+        self.thread_store.import_pickled_threads(f"{app_data_dir}/pickled_threads",
+                                                 lambda msgs: sum(count_message_tokens(m, default_model) for m in msgs))
+        # images and pdf text are kept out of the threads, which only hold references to them
+        self.blobs = BlobStore(f"{app_data_dir}/blobs", max_bytes=int(os.getenv("BLOB_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+        _openai_llms.add(self)
 
         # modifying prompts
         self.modify_prompts_state = None
@@ -125,11 +211,12 @@ class OpenAI_LLM(LLM_Instance):
             "list models (lm)": "list the available gpt models",
             "modify prompts": "modify the prompts for gpt",
             "save thread": "save the current gptX thread to a file",
-            "show old threads": "show the old threads that have been saved",
+            "show old threads": "format `show old threads, [page]` list the threads that have been saved, newest first",
             "load thread": "format `load thread, [unique id]` load a gptX thread from a file",
             "delete thread": "format `delete thread, [unique id]` delete a gptX thread from a file",
             "current model (cm)": "show the current gpt model",
             "swap": f"hotswap btwn models: ({self.hotswap_models})",
+            "cache stats": "show the response cache hit rates (enable the cache with `gptset cache True`)",
         }
         self.commands_help_str = constructHelpMsg(self.commands)
 
@@ -138,14 +225,25 @@ class OpenAI_LLM(LLM_Instance):
             self._gpt_read_prompts_from_file() # read the prompts from disk, if any, if enabled.
         self._init_empty_prompt() # at object instantiation, start with an empty system assistant prompt
 
-    async def _gen_GPT_Response(self, msg : Message) -> str:
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=self.api_key)
+        return self._client
+
+    def warm_up(self) -> None:
+        '''Import openai and create the client now instead of on the first request'''
+        self.client
+
+    async def _gen_GPT_Response(self, msg : Message, session : Session) -> str:
         '''
         retrieves a GPT response given a string input and a dictionary containing the settings to use
         checks for attachments in the discord Message construct
         returns the response str
         '''
         assert len(self.api_key) > 0, 'Empty API Key, cannot request GPT generation.'
-        settings_dict = self.gpt_settings
+        settings_dict = session.settings
 
         response_msg = ""
 
@@ -156,12 +254,17 @@ class OpenAI_LLM(LLM_Instance):
         if msg.attachments is not None:
             for text in msg.attachments['texts']:
                 content[0]['text'] = content[0]['text'] + "\n<FILECONTENTSTART>:\n" + text + "\n<FILECONTENTEND>"
-            for imageB64str in msg.attachments['images']:
-                image_dict = {"type": "image_url", "image_url": {"url" : f"data:image/jpeg;base64,{imageB64str}"}}
-                content.append(image_dict)
+            # the thread only keeps references to images and pdf text, see _materialize_messages
+            for image in msg.attachments['images']:
+                ref = await self.blobs.put(image.data, image.mime, width=image.width, height=image.height)
+                content.append({"type": "image", "image": ref})
             for pdf in msg.attachments['pdfs']:
                 embedded_text, ocr_text = pdf.embedded_text, pdf.ocr_text
-                content[0]['text'] = content[0]['text'] + "\n<PDFCONTENTSTART>" + "\nEMBEDDED TEXT:\n" + embedded_text + "\nOCR TEXT:\n" + ocr_text + "\n<PDFCONTENTEND>"
+                # pages with a usable text layer are not OCR'd, don't send an empty section
+                ocr_section = "\nOCR TEXT:\n" + ocr_text if ocr_text else ""
+                pdf_text = "<PDFCONTENTSTART>" + "\nEMBEDDED TEXT:\n" + embedded_text + ocr_section + "\n<PDFCONTENTEND>"
+                ref = await self.blobs.put(pdf_text.encode('utf-8'), "text/plain", tokens=count_text_tokens(pdf_text, settings_dict["model"][0]))
+                content.append({"type": "pdf", "pdf": ref})
 
         new_usr_msg = {
             "role": "user",
@@ -170,31 +273,86 @@ class OpenAI_LLM(LLM_Instance):
 
         ##############################
         # update list of messages, then use it to query
-        settings_dict["messages"][0].append(new_usr_msg)
-
-        def blocking_api_call():
-            # query
-            return self.client.chat.completions.create(
-                model = settings_dict["model"][0],
-                messages = settings_dict["messages"][0],
-                temperature = float(settings_dict["temperature"][0]),
-                top_p = float(settings_dict["top_p"][0]),
-                frequency_penalty = float(settings_dict["frequency_penalty"][0]),
-                presence_penalty = float(settings_dict["presence_penalty"][0]),
-                max_tokens = int(settings_dict["max_tokens"][0])
-            )
-
-        # Run the blocking function in a separate thread using run_in_executor
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            completion = await loop.run_in_executor(executor, blocking_api_call)
-
-        tmp = completion.choices[0].message.content
-        chatgptcompletion = tmp if tmp is not None else ""
+        self._append_to_thread(session, new_usr_msg)
+        self._trim_thread(session, self._get_context_budget(session))
+
+        request = dict(
+            model = settings_dict["model"][0],
+            messages = session.messages,
+            temperature = float(settings_dict["temperature"][0]),
+            top_p = float(settings_dict["top_p"][0]),
+            frequency_penalty = float(settings_dict["frequency_penalty"][0]),
+            presence_penalty = float(settings_dict["presence_penalty"][0]),
+            max_tokens = int(settings_dict["max_tokens"][0])
+        )
+
+        # only deterministic requests are worth caching
+        use_cache = self._setting_enabled(session, "cache") and float(settings_dict["temperature"][0]) == 0.0
+        if use_cache:
+            cached = await self.response_cache.get(request)
+            if cached is not None:
+                if msg.reply_stream is not None:
+                    await msg.reply_stream.push(cached)
+                    await msg.reply_stream.finish()
+                return response_msg + cached
+
+        # the cache is keyed by the compact thread, the images and pdf text only go into the payload sent to openai
+        with stage("materialize_thread", msg.trace, messages=len(request["messages"])):
+            payload = dict(request, messages=await self._materialize_messages(request["messages"]))
+
+        stream = msg.reply_stream is not None and self._setting_enabled(session, "stream")
+        with stage("openai_completion", msg.trace, model=request["model"], stream=stream) as span:
+            if stream:
+                chatgptcompletion = await self._stream_completion(payload, msg.reply_stream)
+            else:
+                async with self.limiter.slot():
+                    completion = await self.client.chat.completions.create(**payload)
+                tmp = completion.choices[0].message.content
+                chatgptcompletion = tmp if tmp is not None else ""
+            completion_tokens = count_text_tokens(chatgptcompletion, request["model"])
+            span.set(prompt_tokens=session.thread_tokens, completion_tokens=completion_tokens)
+        TOKENS.inc(session.thread_tokens, model=request["model"], kind="prompt")
+        TOKENS.inc(completion_tokens, model=request["model"], kind="completion")
+
+        if use_cache:
+            await self.response_cache.put(request, chatgptcompletion)
         response_msg += chatgptcompletion
         return response_msg
 
-    def _add_and_set_prompt(self, promptName : str, promptStr : str, resetThread : bool = False) -> None:
+    async def rag_settings(self, session_key : str | None) -> tuple[str, int]:
+        '''(model, token budget for retrieved context) of the session with key session_key'''
+        session = await self.sessions.acquire(session_key)
+        try:
+            # sessions saved before the setting existed don't have it
+            return session.settings["model"][0], int(session.settings.get("rag_context_tokens", ["2000"])[0])
+        finally:
+            await self.sessions.release(session)
+
+    def _setting_enabled(self, session : Session, setting : str) -> bool:
+        '''Value of a bool gpt setting (settings are stored as str)'''
+        return str(session.settings[setting][0]).lower() in ("true", "1", "yes")
+
+    async def _stream_completion(self, request: dict, reply: StreamingReply) -> str:
+        '''
+        Request the completion as a stream and push each text delta into reply as it arrives.
+        Returns the complete text.
+        '''
+        await reply.start()
+        try:
+            async with self.limiter.slot():
+                stream = await self.client.chat.completions.create(**request, stream=True)
+                async for chunk in stream:
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        await reply.push(chunk.choices[0].delta.content)
+            # the last edits wait on discord's rate limits, the request slot has been released by now
+            await reply.finish()
+        except Exception as e:
+            # same text runTryExcept replies with, the stream shows it instead of leaving the placeholder behind
+            await reply.fail(f'Encountered Error: {str(e)}')
+            raise
+        return reply.text
+
+    def _add_and_set_prompt(self, session : Session, promptName : str, promptStr : str, resetThread : bool = False) -> None:
         '''
         Set the current prompt (and add it into the available options if new) and
         if [resetThread] is passed as True, reset the current message thread, o.w. leave 
@@ -207,30 +365,33 @@ class OpenAI_LLM(LLM_Instance):
             self.all_gpt_available_prompts.append(promptName)
 
         # set current prompt to this prompt
-        self.curr_prompt_name = promptName
-        self.gpt_settings["prompt"][0] = self.curr_prompt_name
+        session.curr_prompt_name = promptName
+        session.settings["prompt"][0] = session.curr_prompt_name
 
         if resetThread:
-            # gpt_context_reset initializes new thread prompt based off of the self.curr_prompt_name
-            self._gpt_context_reset()
+            # gpt_context_reset initializes new thread prompt based off of the session.curr_prompt_name
+            self._gpt_context_reset(session)
         else:
-            self._set_prompt(self.curr_prompt_name)
+            self._set_prompt(session, session.curr_prompt_name)
     
-    def _set_prompt(self, promptName : str) -> None:
+    def _set_prompt(self, session : Session, promptName : str) -> None:
         '''
         Assuming that the first message in the system is the system/assistant, 
         modify the content (prompt) to the requested prompt.
         '''
         assert promptName in self.all_gpt_available_prompts, "Requested promptName is not in system."
-        self.curr_prompt_name = promptName
+        session.curr_prompt_name = promptName
 
         # update prompt in the actual thread
-        thread = self.gpt_settings["messages"][0]
+        thread = session.settings["messages"][0]
         systemPromptMsg = thread[0]
         assert systemPromptMsg["role"] == self.chatgpt_name, "First message in thread is NOT the system prompt message. It should be."
         thread[0]["content"][0]["text"] = self.map_promptname_to_prompt[promptName]
+        new_count = count_message_tokens(thread[0], session.settings["model"][0])
+        session.thread_tokens += new_count - session.thread_token_counts[0]
+        session.thread_token_counts[0] = new_count
         # and in the prompt note in the gptsettings
-        self.gpt_settings["prompt"][0] = self.curr_prompt_name
+        session.settings["prompt"][0] = session.curr_prompt_name
 
     async def _modify_prompts(self, usr_msg : str) -> str:
         '''
@@ -313,7 +474,7 @@ class OpenAI_LLM(LLM_Instance):
 
         return "Error: unexpected modify prompts state."
 
-    async def _modifyParams(self, usr_msg : str) -> str:
+    async def _modifyParams(self, usr_msg : str, session : Session) -> str:
         '''
         Modifies ChatGPT API params.
         Returns the output of an executed command or returns an error/help message.
@@ -330,35 +491,32 @@ class OpenAI_LLM(LLM_Instance):
         if usr_msg == "help":
             return self.commands_help_str
 
-        # save current msg log to file 
+        # save current msg log to the thread store
         if usr_msg == "save thread":
-            global time
-            # pickle the current thread from gptsettings["messages"][0]
-            msgs_to_save = self.gpt_settings["messages"][0]
-            # grab current time in nanoseconds
-            curr_time = time.time()
-            # pickle the msgs_to_save and name it the current time
-            with open(f"{self.pickled_threads_dir}/{curr_time}.pkl", "wb") as f:
-                pickle.dump(msgs_to_save, f, protocol=pickle.HIGHEST_PROTOCOL)
-            return f"Saved thread to file as {curr_time}.pkl"
+            thread_id = await self.thread_store.save(session.messages, session.curr_prompt_name, session.thread_tokens)
+            return f"Saved thread as {thread_id}"
  
-        # show old threads that have been saved
-        if usr_msg == "show old threads":
-            ret_str = ""
-            # for now, list all the threads...
-            for filename in os.listdir(self.pickled_threads_dir):
-                # read the file and unpickle it
-                with open(f"{self.pickled_threads_dir}/{filename}", "rb") as f:
-                    msgs_to_load = pickle.load(f)
-                    ret_str += f"Thread id: {filename[:-4]}\n" # hide the file extension when displayed, its ugly
-                    for tmp in msgs_to_load:
-                        tmp_role = tmp["role"]
-                        tmp_msg = tmp["content"]
-                        ret_str += f"###{tmp_role.capitalize()}###\n{tmp_msg}\n###################\n"
-                    ret_str += f"{'~ '*30}"
+        # list the threads that have been saved, a page at a time
+        if usr_msg[:16] == "show old threads":
+            tmp = usr_msg.split(",")
+            try:
+                page = int(tmp[1].strip()) if len(tmp) == 2 else 1
+            except ValueError:
+                return "usage: [show old threads, PAGE]"
+            page_size = 10
+            threads, total = await self.thread_store.list_threads(max(page, 1), page_size)
+            if total == 0:
+                return "No saved threads."
+            num_pages = (total + page_size - 1) // page_size
+            if page < 1 or page > num_pages:
+                return f"No page {page}, there are {num_pages} pages of saved threads."
+            ret_str = f"Saved threads (page {page}/{num_pages}, newest first):\n"
+            for t in threads:
+                created = time.strftime("%Y-%m-%d %H:%M", time.localtime(t["created"]))
+                ret_str += f"Thread id: {t['id']} | {created} | prompt: {t['prompt_name']} | {t['message_count']} messages, {t['token_count']} tokens | {t['preview']}\n"
             return ret_str
 
-        # load msg log from file
+        # load msg log from the thread store
         if usr_msg[:11] == "load thread":
             tmp = usr_msg.split(",")
             if len(tmp) != 2:
@@ -372,23 +530,29 @@ class OpenAI_LLM(LLM_Instance):
             if thread_id[-4:] == ".pkl":
                 thread_id = thread_id[:-4]
 
-            # read the file and unpickle it
-            with open(f"{self.pickled_threads_dir}/{thread_id}.pkl", "rb") as f:
-                msgs_to_load = pickle.load(f)
-                # set the current gptsettings messages to this 
-                self.gpt_settings["messages"][0] = msgs_to_load
-            return  f"Loaded thread {thread_id}.pkl"
+            msgs_to_load = await self.thread_store.load(thread_id)
+            if msgs_to_load is None:
+                return f"No saved thread {thread_id}"
+            # set the current gptsettings messages to this 
+            session.settings["messages"][0] = msgs_to_load
+            session.trimmed = 0
+            self._recount_thread_tokens(session)
+            return  f"Loaded thread {thread_id}"
         
         # delete a saved thread
         if usr_msg[:13] == "delete thread":
-            thread_id = usr_msg.split(",")[1].strip()
+            tmp = usr_msg.split(",")
+            thread_id = tmp[1].strip() if len(tmp) == 2 else ""
 
             if len(thread_id) == 0:
                 return "No thread id specified"
 
-            # delete the file
-            os.remove(f"{self.pickled_threads_dir}/{thread_id}.pkl")
-            return f"Deleted thread {thread_id}.pkl"
+            if not await self.thread_store.delete(thread_id):
+                return f"No saved thread {thread_id}"
+            return f"Deleted thread {thread_id}"
+
+        if usr_msg == "cache stats":
+            return f"{self.response_cache.stats()}\n{self.blobs.stats()}"
 
         # list available models of interest
         if usr_msg == "list models":
@@ -398,20 +562,20 @@ class OpenAI_LLM(LLM_Instance):
 
         # show the current gpt prompt
         if usr_msg == "current prompt":
-            return self.curr_prompt_name if self.curr_prompt_name is not None else "Current prompt is not initialized."
+            return session.curr_prompt_name if session.curr_prompt_name is not None else "Current prompt is not initialized."
 
         # just show current model
         if usr_msg == "current model":
-            return f"Current model: {self.gpt_settings['model'][0]}"
+            return f"Current model: {session.settings['model'][0]}"
 
         # toggle which model to use (toggle between the latest gpt4 turbo and the vision model)
         if usr_msg == "swap":
-            curr_model = self.gpt_settings["model"][0]
+            curr_model = session.settings["model"][0]
             if curr_model == "gpt-4-vision-preview":
-                await self._modifygptset("gptset model gpt-4-0125-preview")
+                await self._modifygptset(session, "gptset model gpt-4-0125-preview")
             else:
-                await self._modifygptset("gptset model gpt-4-vision-preview")
-            return f'Set to: {self.gpt_settings["model"][0]}'
+                await self._modifygptset(session, "gptset model gpt-4-vision-preview")
+            return f'Set to: {session.settings["model"][0]}'
 
         # add a command to add a new prompt to the list of prompts and save to file
         if usr_msg == "modify prompts":
@@ -431,7 +595,7 @@ class OpenAI_LLM(LLM_Instance):
                 reset_thread_bool = bool(reset_thread_bool)
             except Exception:
                 reset_thread_bool = False
-            self._add_and_set_prompt(prompt_name, prompt_str, reset_thread_bool)
+            self._add_and_set_prompt(session, prompt_name, prompt_str, reset_thread_bool)
 
         # change gpt prompt
         if usr_msg[:13] == "change prompt":
@@ -440,7 +604,7 @@ class OpenAI_LLM(LLM_Instance):
             new_prompt_name = list(map(str.strip, usr_msg.split(',')))[1]
             if new_prompt_name not in self.all_gpt_available_prompts:
                 return f"Prompt {new_prompt_name} not available. Available prompts: {' '.join(self.all_gpt_available_prompts)}"
-            self._set_prompt(promptName=new_prompt_name)
+            self._set_prompt(session, promptName=new_prompt_name)
             return "New current prompt set to: " + new_prompt_name
 
         # show available prompts as (ind. prompt)
@@ -449,31 +613,31 @@ class OpenAI_LLM(LLM_Instance):
 
         # show user current gpt settings
         if usr_msg == "gptsettings":
-            return self._gptsettings()
+            return self._gptsettings(session)
 
         # user wants to modify gpt settings
         if usr_msg[0:6] == "gptset":
-            await self._modifygptset(usr_msg)
-            return self._gptsettings()
+            await self._modifygptset(session, usr_msg)
+            return self._gptsettings(session)
 
         # show the current thread
         if usr_msg == "show thread":
-            return await self._get_curr_gpt_thread()
+            return await self._get_curr_gpt_thread(session)
 
         # reset the current convo with the curr prompt context
         if usr_msg == "reset thread":
-            self._gpt_context_reset()
-            return f"Thread Reset. {await self._get_curr_convo_len_and_approx_tokens()}"
+            self._gpt_context_reset(session)
+            return f"Thread Reset. {self._get_curr_convo_len_and_tokens(session)}"
 
         # check curr convo context length
         if usr_msg == "convo len":
-            return await self._get_curr_convo_len_and_approx_tokens()
+            return self._get_curr_convo_len_and_tokens(session)
 
         # format: `_add_msg_to_curr_thread<SEP>[role]<SEP>[content]`
         if usr_msg.startswith("_add_msg_to_curr_thread"):
             x = usr_msg.split("<SEP>")
             role, content = x[1], x[2]
-            self._add_msg_to_curr_thread(role, content)
+            self._add_msg_to_curr_thread(session, role, content)
             return "[assistant]: command completed."
 
         return "Unknown command."
@@ -505,15 +669,22 @@ class OpenAI_LLM(LLM_Instance):
         # not a shortcut command
         return usr_msg
 
-    async def _get_curr_convo_len_and_approx_tokens(self) -> str:
+    def _get_curr_convo_len_and_tokens(self, session : Session) -> str:
         '''
-        Returns a string of the current length of the conversation and the approximate number of tokens
+        Returns a string of the current length of the conversation (in messages) and its number of tokens
         as a single string
         '''
-        tmp = len(await self._get_curr_gpt_thread())
-        return f"len:{tmp} | tokens: ~{tmp/4}"
+        return f"len:{len(session.messages)} messages | tokens: {session.thread_tokens} / {self._get_context_budget(session)}"
+
+    def _get_context_budget(self, session : Session) -> int:
+        '''
+        Number of tokens the thread may use: the context length minus room for the reply.
+        Some models' max return tokens equal their context length, so at most half the context is reserved.
+        '''
+        context_length = int(session.settings["context_length"][0])
+        return context_length - min(int(session.settings["max_tokens"][0]), context_length // 2)
 
-    async def _modifygptset(self, usr_msg : str) -> None | str:
+    async def _modifygptset(self, session : Session, usr_msg : str) -> None | str:
         '''
         Executes both gptset and gptsettings (to print out the new gpt api params for the next call)
         expect format: gptset [setting_name] [new_value]
@@ -525,7 +696,7 @@ class OpenAI_LLM(LLM_Instance):
             usr_msg = usr_msg.replace(',', ' ')
 
         try:
-            self._gptset(usr_msg)
+            self._gptset(session, usr_msg)
         except Exception as _:
             return "gptset: gptset [setting_name] [new_value]"
         return None
@@ -572,36 +743,50 @@ class OpenAI_LLM(LLM_Instance):
             self.map_promptname_to_prompt['empty'] = ''
             self.all_gpt_available_prompts.append('empty')
 
-        # initialize thread with empty system/assistant prompt
-        self.curr_prompt_name = "empty" # Default to an empty prompt, if not present in user's prompts list, append it
-        self.gpt_settings["prompt"][0] = self.curr_prompt_name
-        self._gpt_context_reset(prompt_name=self.curr_prompt_name)
-
-    def _gpt_context_reset(self, prompt_name : str | None = None) -> None:
+        # initialize the default session's thread with empty system/assistant prompt
+        # Default to an empty prompt, if not present in user's prompts list, append it
+        session = Session("default", self.gpt_settings, "empty")
+        session.settings["prompt"][0] = session.curr_prompt_name
+        self._gpt_context_reset(session, prompt_name=session.curr_prompt_name)
+        self.sessions.default = session
+
+    def _new_session(self, key: str) -> Session:
+        '''A new session starts out with a copy of the default session's settings and prompt, and a fresh thread'''
+        default = self.sessions.default
+        if default is None:
+            raise Exception("OpenAI_LLM: default session is not initialized.")
+        settings = {k: ([[], v[1]] if k == "messages" else list(v)) for k, v in default.settings.items()}
+        session = Session(key, settings, default.curr_prompt_name)
+        self._gpt_context_reset(session)
+        return session
+
+    def _gpt_context_reset(self, session : Session, prompt_name : str | None = None) -> None:
         '''
         Resets the gpt context.
         Takes an optional argument that is the [prompt_name] used as a key to retrieve the 
         prompt string from the hashmap / dictionary [self.map_promptname_to_prompt] that seeds
         the new, empty thread (list of messages) as the system assistant's prompt. If the [prompt_name]
-        is not provided, the [self.curr_prompt_name] is used to retrieve the current set prompt's string.
+        is not provided, the [session.curr_prompt_name] is used to retrieve the current set prompt's string.
         '''
         if prompt_name is not None: 
-            self.curr_prompt_name = prompt_name
-            self.curr_prompt_str = self.map_promptname_to_prompt[self.curr_prompt_name]
+            session.curr_prompt_name = prompt_name
 
-        self.curr_prompt_str = self.map_promptname_to_prompt[self.curr_prompt_name]
-        self.gpt_settings["messages"][0] = [] # reset messages, old messages should be gc'd
+        curr_prompt_str = self.map_promptname_to_prompt[session.curr_prompt_name]
+        session.settings["messages"][0] = [] # reset messages, old messages should be gc'd
+        session.trimmed = 0
+        session.thread_token_counts = []
+        session.thread_tokens = 0
         # add the first message in thread: the system prompt
-        self._add_msg_to_curr_thread(self.chatgpt_name, self.curr_prompt_str) 
+        self._add_msg_to_curr_thread(session, self.chatgpt_name, curr_prompt_str) 
 
-    async def _get_curr_gpt_thread(self) -> str:
+    async def _get_curr_gpt_thread(self, session : Session) -> str:
         '''
         Generates the current gpt conversation thread as a string from the gptsettings messages list
         Notably, we know that images and pdf representations are in their raw string form (base64 encoded str for images,
         embedded text and ocr text for pdfs). Therefore, we shorten those to just [image] and [pdf] respectively.
         '''
         ret_str = ""
-        messages = self.gpt_settings["messages"][0]
+        messages = session.messages
 
         for msg in messages:
             content = msg["content"]
@@ -614,22 +799,76 @@ class OpenAI_LLM(LLM_Instance):
                 type = c["type"]
                 if type == "text":
                     currMsgTxt += f'{c["text"]}\n'
-                elif type == "image_url":
+                elif type == "image_url" or type == "image":
                     currMsgTxt += '[image]\n'
                 elif type == "pdf":
                     currMsgTxt += '[pdf]\n'
             ret_str += currMsgTxt
         return ret_str
 
-    def _gptsettings(self) -> str:
+    async def sweep_blobs(self) -> int:
+        '''
+        Delete the blobs that no session or saved thread refers to anymore, returns how many were deleted.
+        Every OpenAI_LLM storing its blobs in the same directory (main's and the personal assistant's) is
+        looked at, a blob in use by any of them is kept.
+        '''
+        sharing = [llm for llm in list(_openai_llms) if llm.blobs.data_dir == self.blobs.data_dir]
+        referenced = set()
+        for llm in sharing:
+            referenced |= referenced_blobs(llm.sessions.resident_messages())
+        def on_disk() -> set[str]:
+            hashes = set()
+            for llm in sharing:
+                hashes |= referenced_blobs(llm.sessions.evicted_messages())
+                hashes |= referenced_blobs(llm.thread_store.iter_messages())
+            return hashes
+        referenced |= await asyncio.to_thread(on_disk)
+        removed = await self.blobs.sweep(referenced)
+        if removed > 0:
+            print(f"[LOG] Deleted {removed} blobs no thread refers to anymore")
+        return removed
+
+    async def _materialize_messages(self, messages : list[dict]) -> list[dict]:
+        '''
+        The thread as openai expects it: image and pdf references (see BlobStore) are replaced with the image as a
+        data url and the pdf text. Messages without references are passed along as is, threads saved before
+        references existed hold their images inline and need no work.
+        '''
+        hashes = [part[part["type"]]["hash"] for m in messages if not isinstance(m["content"], str)
+                  for part in m["content"] if part["type"] in ("image", "pdf")]
+        if len(hashes) == 0:
+            return messages
+        blobs = await self.blobs.get_many(hashes)
+
+        materialized = []
+        for m in messages:
+            if isinstance(m["content"], str) or not any(part["type"] in ("image", "pdf") for part in m["content"]):
+                materialized.append(m)
+                continue
+            content = []
+            for part in m["content"]:
+                ref = part.get(part["type"])
+                if part["type"] not in ("image", "pdf"):
+                    content.append(part)
+                elif ref["hash"] not in blobs:
+                    content.append({"type": "text", "text": f"[{part['type']} no longer available]"})
+                elif part["type"] == "image":
+                    b64 = base64.b64encode(blobs[ref["hash"]]).decode('utf-8')
+                    content.append({"type": "image_url", "image_url": {"url": f"data:{ref['mime']};base64,{b64}"}})
+                else:
+                    content.append({"type": "text", "text": blobs[ref["hash"]].decode('utf-8')})
+            materialized.append({**m, "content": content})
+        return materialized
+
+    def _gptsettings(self, session : Session) -> str:
         '''
         returns the available gpt settings, their current values, and their data types
         excludes the possibly large messages list
         '''
-        gpt_settings = self.gpt_settings
+        gpt_settings = session.settings
         return "".join([f"{key} ({gpt_settings[key][1]}) = {gpt_settings[key][0]}\n" for key in gpt_settings.keys() if key != "messages"])
 
-    def _gptset(self, usr_msg : str) -> None:
+    def _gptset(self, session : Session, usr_msg : str) -> None:
         '''
         Updates the gpt settings object used for GPT completions. Format is GPTSET [setting_name] [new_value].
         Sets the specified gpt parameter to the new value.
@@ -638,13 +877,15 @@ class OpenAI_LLM(LLM_Instance):
         '''
         tmp = usr_msg.split()
         setting, new_val = tmp[1], tmp[2]
-        self.gpt_settings[setting][0] = new_val # always gonna store str
+        session.settings[setting][0] = new_val # always gonna store str
 
         # if setting a new model, update the max_tokens
         if setting == "model":
             x = self.gpt_models_info[new_val] # (max return tokens, date of latest date)
-            self.gpt_settings["max_tokens"][0] = x[0]
-            self.gpt_settings["knowledge_cutoff"][0] = x[2]
+            session.settings["max_tokens"][0] = x[0]
+            session.settings["context_length"][0] = x[1]
+            session.settings["knowledge_cutoff"][0] = x[2]
+            self._recount_thread_tokens(session) # the new model may use a different tokenizer
 
     def _get_all_gpt_prompts_as_str(self) -> str:
         '''
@@ -652,19 +893,67 @@ class OpenAI_LLM(LLM_Instance):
         '''
         return "".join([f"Name: {k}\nPrompt:{v}\n----\n" for k,v in self.map_promptname_to_prompt.items()])
 
-    def _add_msg_to_curr_thread(self, role:str, content:str) -> None:
+    def _add_msg_to_curr_thread(self, session : Session, role:str, content:str) -> None:
         '''
         Add the new message, formatted for openai's GPT API, to the current context thread.
         '''
         msg = {"role": role, "content": [{"type": "text", "text": content}]}
-        self.gpt_settings["messages"][0].append(msg)
+        self._append_to_thread(session, msg)
+
+    def _append_to_thread(self, session: Session, message: dict) -> None:
+        '''
+        Append message to the current thread. Its tokens are counted once, here, and added to the running total.
+        '''
+        tokens = count_message_tokens(message, session.settings["model"][0])
+        session.settings["messages"][0].append(message)
+        session.thread_token_counts.append(tokens)
+        session.thread_tokens += tokens
+
+    def _recount_thread_tokens(self, session: Session) -> None:
+        '''Recount every message, for when the thread is replaced wholesale or the tokenizer changes'''
+        session.compact()
+        model = session.settings["model"][0]
+        session.thread_token_counts = [count_message_tokens(m, model) for m in session.settings["messages"][0]]
+        session.thread_tokens = sum(session.thread_token_counts)
+
+    def _trim_thread(self, session: Session, budget: int) -> None:
+        '''
+        Drop the oldest messages until the thread (plus the reply priming) fits in budget tokens.
+        The system prompt (first message) and the newest message are always kept.
+        Dropped messages are only counted in session.trimmed, they are removed from the lists (session.compact)
+        once they are more than half of them. A thread at the budget trims on nearly every new message, this way
+        that doesn't shift the whole list every time.
+        '''
+        excess = session.thread_tokens + TOKENS_PER_REPLY - budget
+        if excess <= 0:
+            return
+        counts = session.thread_token_counts
+        end, removed = 1 + session.trimmed, 0
+        while end < len(counts) - 1 and removed < excess:
+            removed += counts[end]
+            end += 1
+        session.trimmed = end - 1
+        session.thread_tokens -= removed
+        if session.trimmed > len(counts) // 2:
+            session.compact()
 
     async def main(self, msg: Message) -> str:
         '''
         Entrance function for all ChatGPT API things.
         Either modifies the parameters or generates a response based off of current context and new user message.
         Returns the generation.
+
+        Works on the message's session, requests in the same session are handled one at a time.
         '''
+        session = await self.sessions.acquire(msg.session_key)
+        try:
+            async with session.lock:
+                return await self._handle(msg, session)
+        finally:
+            await self.sessions.release(session)
+
+    async def _handle(self, msg: Message, session: Session) -> str:
+        '''Handles msg within session, see main'''
         usr_msg = msg.content
         if len(usr_msg) > 0:
             # catch if is a command
@@ -672,39 +961,50 @@ class OpenAI_LLM(LLM_Instance):
                 if len(usr_msg) == 1:
                     return "Empty command provided."
                 # pass to PA block without the prefix
-                return await self._modifyParams(usr_msg[1:])
+                return await self._modifyParams(usr_msg[1:], session)
 
-        # check to see if we are running out of tokens for current msg log
-        # get the current thread length
-        curr_thread = await self._get_curr_gpt_thread()
-        curr_thread_len_in_tokens = len(curr_thread) / 4 # 1 token ~= 4 chars
-        while curr_thread_len_in_tokens > int(self.gpt_settings["context_length"][0]):
-            # remove the 2nd oldest message from the thread (first oldest is the prompt)
-            self.gpt_settings["messages"][0].pop(1)
-
-        # use usr_msg to generate new response from API
-        gpt_response = await self._gen_GPT_Response(msg)
+        # use usr_msg to generate new response from API (trims the thread to fit the context length if needed)
+        gpt_response = await self._gen_GPT_Response(msg, session)
 
         # add gpt response to current thread
-        self._add_msg_to_curr_thread(self.chatgpt_name, gpt_response)
+        self._add_msg_to_curr_thread(session, self.chatgpt_name, gpt_response)
 
         return gpt_response
 
+# every OpenAI_LLM, so a blob sweep can see the threads of all the ones that share a blob directory
+_openai_llms: weakref.WeakSet[OpenAI_LLM] = weakref.WeakSet()
+
+async def run_blob_sweeper(interval_s: float) -> None:
+    '''Sweep the unreferenced blobs of every blob directory in use, now and then every interval_s seconds'''
+    while True:
+        swept = set()
+        for llm in list(_openai_llms):
+            if llm.blobs.data_dir in swept:
+                continue
+            swept.add(llm.blobs.data_dir)
+            try:
+                await llm.sweep_blobs()
+            except Exception as e:
+                print(f"[LOG] Blob sweep of {llm.blobs.data_dir} failed: {e}")
+        await asyncio.sleep(interval_s)
+
 class Anthropic_LLM(LLM_Instance):
-    def __init__(self):
-        pass
+    def __init__(self, limiter: RequestLimiter | None = None):
+        self.limiter = limiter if limiter is not None else llm_limiters["anthropic"]
 
     async def main(self, msg: Message) -> str:
-        return "Anthropic LLM: TODO not yet implemented"
+        async with self.limiter.slot():
+            return "Anthropic LLM: TODO not yet implemented"
 
 #################### Control Classes #################### 
 
 class Image_Gen_Controller():
     def __init__(self, init_provider_name: str = "openai"):
         self.curr_provider = init_provider_name
+        # the limiters are shared app wide, see image_gen_limiters
         self.providers = {
-            "openai": Dalle(),
-            "stable diffusion": Stable_Diffusion()
+            "openai": Dalle(limiter=image_gen_limiters["openai"]),
+            "stable diffusion": Stable_Diffusion(limiter=image_gen_limiters["stable diffusion"])
         }
         self.command_prefix = "$"
 
@@ -712,20 +1012,27 @@ class Image_Gen_Controller():
     def swap_providers(self, new_provider: str) -> None:
         self.curr_provider = new_provider
 
+    def warm_up(self) -> None:
+        for provider in self.providers.values():
+            if hasattr(provider, "warm_up"):
+                provider.warm_up()
+
     async def main(self, msg: Message) -> Image.Image:
         return await self.providers[self.curr_provider].main(msg)
 
 class LLM_Controller():
-    def __init__(self, init_provider_name: str = "openai"):
+    def __init__(self, init_provider_name: str = "openai", app_data_dir: str = "./data"):
         self.curr_provider = init_provider_name
+        # the limiters are shared app wide, see llm_limiters
         self.providers = {
-            "openai": OpenAI_LLM(),
-            "anthropic": Anthropic_LLM()
+            "openai": OpenAI_LLM(app_data_dir=app_data_dir, limiter=llm_limiters["openai"]),
+            "anthropic": Anthropic_LLM(limiter=llm_limiters["anthropic"])
         }
         self.command_prefix = "$"
         self.commands = {
             "help": "show this message",
-            "providers": "shows a list of the available providers"
+            "providers": "shows a list of the available providers",
+            "stats": "shows the in flight and queued requests, and the discord messages sent"
         }
         self.help_msg = constructHelpMsg(self.commands)
 
@@ -733,6 +1040,18 @@ class LLM_Controller():
     def swap_providers(self, new_provider: str) -> None:
         self.curr_provider = new_provider
 
+    def warm_up(self) -> None:
+        for provider in self.providers.values():
+            if hasattr(provider, "warm_up"):
+                provider.warm_up()
+
+    async def rag_settings(self, msg: Message) -> tuple[str, int]:
+        '''(model, token budget for retrieved context) the current provider uses for msg's conversation'''
+        provider = self.providers[self.curr_provider]
+        if hasattr(provider, "rag_settings"):
+            return await provider.rag_settings(msg.session_key)
+        return "gpt-4o", 2000
+
     async def main(self, msg: Message) -> str:
         if msg.content.startswith("$"):
             cmd = msg.content[1:].strip().lower()
@@ -740,6 +1059,10 @@ class LLM_Controller():
                 return self.help_msg
             if cmd == "providers":
                 return "\n".join(list(self.providers.keys()))
+            if cmd == "stats":
+                limiters = "".join(f"{name}: {limiter.stats()}\n" for name, limiter in llm_limiters.items())
+                return f"{limiters}{outbound_queue.stats()}"
             return "[LLM Controller] -- Unknown command"
 
-        return await self.providers[self.curr_provider].main(msg)
+        with stage("llm_controller", msg.trace, provider=self.curr_provider):
+            return await self.providers[self.curr_provider].main(msg)
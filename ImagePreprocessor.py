@@ -0,0 +1,129 @@
+from __future__ import annotations
+import io
+import os
+import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from Metrics import IMAGE_BYTES
+
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048")) # the vision models scale anything bigger down to this anyway
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# formats the vision models accept as is, by the name PIL gives them
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+_heif_registered: bool | None = None
+
+class UnsupportedImageError(Exception):
+    '''An uploaded image that can't be decoded, and so can't be sent to a vision model either'''
+    pass
+
+def _register_heif() -> bool:
+    '''HEIC (iphone photos) decoding comes from the optional pillow-heif package, returns whether it is available'''
+    global _heif_registered
+    if _heif_registered is None:
+        try:
+            import pillow_heif
+            pillow_heif.register_heif_opener()
+            _heif_registered = True
+        except ImportError:
+            _heif_registered = False
+    return _heif_registered
+
+class MyImage:
+    '''An image attachment, encoded and ready to be sent to a vision model'''
+    def __init__(self, data: bytes, mime: str, width: int, height: int, original_bytes: int):
+        self.data = data
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self.original_bytes = original_bytes # size of the upload, before preprocessing
+
+    @property
+    def bytes(self) -> int:
+        return len(self.data)
+
+    @property
+    def b64(self) -> str:
+        return base64.b64encode(self.data).decode('utf-8')
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.b64}"
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+def preprocess_image(content: bytes, max_edge: int | None = None, quality: int | None = None) -> tuple[bytes, str, int, int]:
+    '''
+    Decode the image once, rotate it upright (EXIF orientation), shrink it to at most max_edge pixels on its
+    longest side and re-encode it: PNG for images with transparency and PNG uploads (screenshots, where jpeg
+    artifacts hurt text), JPEG at quality for everything else, e.g. HEIC photos.
+    The upload is kept as is when it is already in an accepted format and re-encoding wouldn't make it smaller.
+    Returns (bytes, mime type, width, height).
+    '''
+    max_edge = max_edge if max_edge is not None else IMAGE_MAX_EDGE
+    quality = quality if quality is not None else IMAGE_JPEG_QUALITY
+    _register_heif()
+    img = Image.open(io.BytesIO(content))
+    source_format = img.format
+    # let the jpeg decoder skip most of the pixels of a big photo instead of decoding all of them and resizing
+    img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    resized = max(img.size) > max_edge
+    if resized:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if _has_alpha(img) or source_format == "PNG":
+        img.save(out, format="PNG", optimize=True)
+        mime = "image/png"
+    else:
+        img.convert("RGB").save(out, format="JPEG", quality=quality, optimize=True)
+        mime = "image/jpeg"
+    encoded = out.getvalue()
+
+    if not resized and source_format in MIME_TYPES and len(content) <= len(encoded):
+        return content, MIME_TYPES[source_format], img.width, img.height
+    return encoded, mime, img.width, img.height
+
+class ImagePreprocessor:
+    '''
+    Runs preprocess_image in a pool of worker threads (Pillow releases the GIL while decoding, resizing and
+    encoding), so big photos don't block the event loop or wait on each other.
+    '''
+    def __init__(self, workers: int | None = None):
+        self.workers = workers if workers else min(4, os.cpu_count() or 1)
+        self._pool: ThreadPoolExecutor | None = None
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image")
+        return self._pool
+
+    async def process(self, content: bytes, filename: str = "") -> MyImage:
+        '''
+        Preprocess an uploaded image. Raises UnsupportedImageError for an image that can't be decoded (e.g. HEIC
+        without pillow-heif installed), the vision models would reject it as well.
+        '''
+        try:
+            encoded, mime, width, height = await asyncio.get_running_loop().run_in_executor(self._get_pool(), preprocess_image, content)
+        except Exception as e:
+            if filename.lower().endswith(".heic") and not _register_heif():
+                print(f"[LOG] Could not read HEIC image {filename}, pillow-heif is not installed")
+                raise UnsupportedImageError(f"{filename} is a HEIC image, which this bot can't read. Please send it as a JPG or PNG.")
+            print(f"[LOG] Could not preprocess image {filename}: {e}")
+            raise UnsupportedImageError(f"{filename} could not be read as an image.")
+        IMAGE_BYTES.inc(len(content), stage="in")
+        IMAGE_BYTES.inc(len(encoded), stage="out")
+        return MyImage(encoded, mime, width, height, len(content))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+image_preprocessor = ImagePreprocessor(workers=int(os.getenv("IMAGE_WORKERS", "0")) or None)
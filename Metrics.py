@@ -0,0 +1,173 @@
+from __future__ import annotations
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from Tracing import Span, span
+
+class _Metric:
+    '''One metric family: a value per combination of label values'''
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...], lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = lock
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if len(pairs) == 0:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        with self._lock:
+            samples = self._samples()
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + samples
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{self._labels(key)} {value:g}" for key, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...]):
+        super().__init__(*args)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[tuple[str, ...], list[int]] = {} # per bucket, not cumulative
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * len(self.buckets)
+                self._sums[key] = 0.0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._sums[key] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{self._labels(key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {self._sums[key]:g}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+# seconds, from a cache hit to a long completion or a big pdf OCR
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and histograms of the whole bot, rendered in the Prometheus text format.
+    Thread safe, some stages (pdf extraction, embeddings) run in worker threads.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"metric {metric.name} already registered as a different metric")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames, self._lock))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames, self._lock))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, self._lock, buckets=buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in list(self._metrics.values()) for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram("bot_stage_duration_seconds", "Time spent in each stage of handling a message", ("stage",))
+STAGE_ERRORS = metrics.counter("bot_stage_errors_total", "Stages that ended with an exception", ("stage",))
+IN_FLIGHT = metrics.gauge("bot_requests_in_flight", "Requests currently being handled, per limiter/scheduler", ("limiter",))
+QUEUED = metrics.gauge("bot_requests_queued", "Requests waiting for a slot, per limiter/scheduler", ("limiter",))
+TOKENS = metrics.counter("bot_llm_tokens_total", "Tokens sent to (prompt) and generated by (completion) the LLM", ("model", "kind"))
+CACHE_LOOKUPS = metrics.counter("bot_cache_lookups_total", "Cache lookups, per cache and result (hit, semantic_hit or miss)", ("cache", "result"))
+PDF_PAGES = metrics.counter("bot_pdf_pages_total", "Pdf pages extracted, and whether they were OCR'd", ("ocr",))
+IMAGE_BYTES = metrics.counter("bot_image_bytes_total", "Bytes of image attachments before (in) and after (out) preprocessing", ("stage",))
+
+@contextmanager
+def stage(name: str, parent: Span | None = None, **attributes: Any) -> Iterator[Any]:
+    '''
+    Time the block (sync or async code) as stage name, counting it as an error if it raises.
+    The block is also recorded as a span of the current trace (see Tracing.span), which is yielded to set attributes on.
+    '''
+    start = time.perf_counter()
+    try:
+        with span(name, parent, **attributes) as current:
+            yield current
+    except BaseException:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+async def start_metrics_server(host: str, port: int):
+    '''Serve the metrics in the Prometheus text format at http://host:port/metrics, returns the aiohttp runner'''
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,203 @@
+from __future__ import annotations
+import time
+import asyncio
+from collections import deque
+from typing import Any
+
+from Metrics import QUEUED
+
+#################### splitting ####################
+
+def _is_fence(stripped_line: str) -> bool:
+    '''opening or closing line of a fenced code block (```lang), not inline ```code```'''
+    return stripped_line.startswith("```") and stripped_line.count("```") == 1
+
+def _is_closing_fence(stripped_line: str) -> bool:
+    return stripped_line.startswith("```") and stripped_line.strip("`") == ""
+
+def _blocks(text: str) -> list[tuple[str, str | None]]:
+    '''
+    text cut into paragraphs (up to and including a blank line) and fenced code blocks, which are kept whole.
+    Returns (block, opening fence line) pairs, the fence line is None for paragraphs.
+    '''
+    blocks: list[tuple[str, str | None]] = []
+    current: list[str] = []
+    fence: str | None = None
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if fence is not None:
+            current.append(line)
+            if _is_closing_fence(stripped):
+                blocks.append(("".join(current), fence))
+                current, fence = [], None
+            continue
+        if _is_fence(stripped):
+            if len(current) > 0:
+                blocks.append(("".join(current), None))
+            current, fence = [line], line.rstrip("\r\n")
+            continue
+        current.append(line)
+        if stripped == "":
+            blocks.append(("".join(current), None))
+            current = []
+    if len(current) > 0:
+        blocks.append(("".join(current), fence)) # a code block may be left open
+    return blocks
+
+def _split_long(text: str, limit: int) -> list[str]:
+    '''text without a better boundary left: cut after the last space that fits, or right at limit if there is none'''
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind(" ", 0, limit)
+        cut = cut + 1 if cut > 0 else limit
+        parts.append(text[:cut])
+        text = text[cut:]
+    if len(text) > 0:
+        parts.append(text)
+    return parts
+
+def _pack(units: list[str], limit: int) -> list[str]:
+    '''greedily join consecutive units (each at most limit long) into chunks of at most limit characters'''
+    chunks: list[str] = []
+    current = ""
+    for unit in units:
+        if len(current) > 0 and len(current) + len(unit) > limit:
+            chunks.append(current)
+            current = ""
+        current += unit
+    if len(current) > 0:
+        chunks.append(current)
+    return chunks
+
+def split_message(text: str, limit: int) -> list[str]:
+    '''
+    Split text into messages of at most limit characters, preferring to split between paragraphs, then lines,
+    then words. Code blocks too long for one message are split between lines, the pieces are closed with ```
+    and re-opened (with the language) in the next message, so each message renders as a code block.
+    '''
+    units: list[str] = []
+    for block, fence in _blocks(text):
+        if len(block) <= limit:
+            units.append(block)
+        elif fence is None:
+            units.extend(part for line in block.splitlines(keepends=True) for part in _split_long(line, limit))
+        else:
+            lines = block.splitlines(keepends=True)[1:]
+            closed = len(lines) > 0 and _is_closing_fence(lines[-1].strip())
+            body = lines[:-1] if closed else lines
+            head, tail = fence + "\n", "```\n"
+            room = max(1, limit - len(head) - len(tail) - 1) # 1 for the newline a piece may need before tail
+            pieces = _pack([part for line in body for part in _split_long(line, room)], room)
+            units.extend(head + piece + ("" if piece.endswith("\n") else "\n") + tail for piece in pieces)
+    chunks = [chunk.rstrip() for chunk in _pack(units, limit)]
+    return [chunk for chunk in chunks if len(chunk) > 0] # discord rejects empty messages
+
+#################### sending ####################
+
+class TokenBucket:
+    '''Allows bursts of up to capacity sends, refilled at rate sends per second'''
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class _Outbound:
+    '''One queued send: text and/or a file, and the futures of the callers waiting for it'''
+    __slots__ = ("content", "file", "coalesce", "futures")
+
+    def __init__(self, content: str | None, file: Any, coalesce: bool, future: asyncio.Future):
+        self.content = content
+        self.file = file
+        self.coalesce = coalesce and file is None and content is not None
+        self.futures = [future]
+
+class OutboundQueue:
+    '''
+    Sends discord messages through one FIFO queue per channel, drained by a task that waits for the channel's
+    token bucket (discord allows about 5 messages per 5 seconds per channel), so a long reply is paced instead of
+    hitting the rate limit halfway through and arriving piecemeal. Consecutive small text messages waiting in the
+    same queue are coalesced into one message, as long as the result fits in limit characters.
+    '''
+    def __init__(self, rate: float = 1.0, burst: float = 5.0, limit: int = 2000):
+        self.rate = rate
+        self.burst = burst
+        self.limit = limit
+        self._queues: dict[Any, deque[_Outbound]] = {}
+        self._buckets: dict[Any, TokenBucket] = {}
+        self._workers: dict[Any, asyncio.Task] = {}
+        self.sent = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _key(channel: Any) -> Any:
+        return getattr(channel, "id", None) or id(channel)
+
+    def _enqueue(self, channel: Any, content: str | None, file: Any, coalesce: bool = True) -> asyncio.Future:
+        key = self._key(channel)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(_Outbound(content, file, coalesce, future))
+        QUEUED.inc(limiter="discord_send")
+        worker = self._workers.get(key)
+        if worker is None or worker.done() or worker.get_loop() is not asyncio.get_running_loop():
+            self._workers[key] = asyncio.create_task(self._drain(key, channel))
+        return future
+
+    async def send(self, channel: Any, content: str | None = None, file: Any = None, coalesce: bool = True) -> Any:
+        '''
+        Queue a message to channel and wait until it is sent, returns the sent discord message.
+        Messages that will be edited later must not be coalesced with others (coalesce=False).
+        '''
+        return await self._enqueue(channel, content, file, coalesce)
+
+    async def send_many(self, channel: Any, contents: list[str]) -> list[Any]:
+        '''Queue several messages back to back (nothing else gets in between) and wait until all are sent'''
+        futures = [self._enqueue(channel, content, None) for content in contents]
+        return list(await asyncio.gather(*futures))
+
+    def _next(self, queue: deque[_Outbound]) -> _Outbound:
+        '''pop the next send, with the small text messages right behind it merged in'''
+        item = queue.popleft()
+        QUEUED.dec(limiter="discord_send")
+        while item.coalesce and len(queue) > 0:
+            following = queue[0]
+            if not following.coalesce or len(item.content) + 1 + len(following.content) > self.limit:
+                break
+            queue.popleft()
+            QUEUED.dec(limiter="discord_send")
+            item.content = item.content + "\n" + following.content
+            item.futures.extend(following.futures)
+            self.coalesced += 1
+        return item
+
+    async def _drain(self, key: Any, channel: Any) -> None:
+        queue = self._queues[key]
+        bucket = self._buckets.setdefault(key, TokenBucket(self.rate, self.burst))
+        while len(queue) > 0:
+            await bucket.acquire()
+            if len(queue) == 0:
+                break
+            item = self._next(queue)
+            try:
+                sent = await channel.send(content=item.content, file=item.file)
+                self.sent += 1
+                for future in item.futures:
+                    if not future.done():
+                        future.set_result(sent)
+            except Exception as e:
+                for future in item.futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self) -> str:
+        return f"outbound: {self.sent} messages sent, {self.coalesced} coalesced, {sum(len(q) for q in self._queues.values())} queued"
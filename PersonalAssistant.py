@@ -1,12 +1,13 @@
 from GenerativeAI import LLM_Controller
 from CommandInterpreter import CommandInterpreter
 from Utils import constructHelpMsg, Message
+from Metrics import stage
 
 class PersonalAssistant:
     '''
     Personal assistant, interprets hard-coded and arbitrary user commands/messages
     '''
-    def __init__(self):
+    def __init__(self, app_data_dir: str = "./data"):
         self.DEBUG = False
         self.personal_assistant_state = None
         self.personal_assistant_modify_prompts_state = None
@@ -23,14 +24,37 @@ class PersonalAssistant:
         self.personal_assistant_command_options = self.personal_assistant_commands.keys()
         self.help_str = constructHelpMsg(self.personal_assistant_commands)
         self.cmd_prefix = "!"
+        # hard-coded commands (PA and gpt settings) that never call an API, these may skip the request queue
+        self.fast_commands = ["help", "chroma status", "remind me",
+                              "h", "cl", "convo len", "rt", "reset thread", "st", "show thread", "gptsettings", "gptset",
+                              "cp", "current prompt", "lp", "list prompts", "lm", "list models", "cm", "current model", "swap"]
 
-        self.gpt_interpreter = LLM_Controller()
+        self.gpt_interpreter = LLM_Controller(app_data_dir=app_data_dir)
 
         self.command_interpreter = CommandInterpreter(help_str=self.help_str, 
-                                                      gpt_interpreter=self.gpt_interpreter)
+                                                      gpt_interpreter=self.gpt_interpreter,
+                                                      app_data_dir=app_data_dir)
 
         self.setup_complete = False
 
+    def start_reminders(self, client) -> None:
+        '''Start delivering reminders (also the ones pending from before a restart) through the discord client'''
+        self.command_interpreter.start_reminders(client)
+
+    async def close(self) -> None:
+        await self.command_interpreter.close()
+
+    def warm_up(self) -> None:
+        self.gpt_interpreter.warm_up()
+        self.command_interpreter.warm_up()
+
+    def is_fast_command(self, usr_msg : str) -> bool:
+        '''True if usr_msg is a hard-coded command that is cheap to run (no LLM or image generation call)'''
+        if not usr_msg.startswith(self.cmd_prefix):
+            return False
+        cmd = usr_msg[len(self.cmd_prefix):]
+        return any(cmd == x or cmd.startswith(x + " ") or cmd.startswith(x + ",") for x in self.fast_commands)
+
     async def main(self, msg : Message) -> str | None:
         '''
         Handles the user input for one of the hard-coded commands, if unable to find a hard-coded command to fulfill request
@@ -41,6 +65,11 @@ class PersonalAssistant:
         2. GPT Interpreter Settings
         2. ChatGPT Response -> Try hard coded, otherwise send back to user
         '''
+        with stage("personal_assistant", msg.trace):
+            return await self._handle(msg)
+
+    async def _handle(self, msg : Message) -> str | None:
+        '''Handles msg, see main'''
         if not self.setup_complete:
             prompt = "You are a personal assistant who interprets users requests into either one of the hard coded commands that you will learn about in a second or respond accordingly to the best of your knowledge."
             prompt += f"The hard-coded commands are: {str(self.personal_assistant_commands)}"
@@ -0,0 +1,127 @@
+from __future__ import annotations
+import os
+import time
+import heapq
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, NamedTuple
+
+from Metrics import metrics
+
+REMINDERS_PENDING = metrics.gauge("bot_reminders_pending", "Reminders waiting to be delivered")
+
+class Reminder(NamedTuple):
+    '''What is kept of a reminder, ordered by due time (unix seconds) then id'''
+    due: float
+    id: int
+    channel_id: int
+    user_id: int
+    text: str
+
+class ReminderScheduler:
+    '''
+    Delivers reminders when they are due, from a single task sleeping until the earliest one.
+
+    Pending reminders are compact records in a min-heap (by due time), persisted in a sqlite database so they
+    survive restarts. A reminder is removed from the database once it has been handed to deliver, reminders that
+    came due while the bot was down are delivered as soon as it starts.
+    '''
+    MAX_SLEEP_S = 3600 # re-check at least this often, in case the wall clock jumped
+
+    def __init__(self, db_path: str, deliver: Callable[[Reminder], Awaitable[None]]):
+        self.db_path = db_path
+        self.deliver = deliver
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS reminders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    due REAL NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    text TEXT NOT NULL
+                )''')
+            rows = conn.execute("SELECT due, id, channel_id, user_id, text FROM reminders").fetchall()
+        self._heap = [Reminder(*row) for row in rows]
+        heapq.heapify(self._heap)
+        REMINDERS_PENDING.set(len(self._heap))
+        self.delivered = 0
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        '''a connection per call (calls come from different worker threads), committed and closed at the end of the block'''
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _insert(self, due: float, channel_id: int, user_id: int, text: str) -> int:
+        with self._connect() as conn:
+            return conn.execute("INSERT INTO reminders (due, channel_id, user_id, text) VALUES (?, ?, ?, ?)",
+                                (due, channel_id, user_id, text)).lastrowid
+
+    def _delete(self, reminder_id: int) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM reminders WHERE id = ?", (reminder_id,))
+
+    def start(self) -> None:
+        '''Start the delivery task on the running event loop, if it isn't running already'''
+        if self._task is not None and not self._task.done() and self._task.get_loop() is asyncio.get_running_loop():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, due: float, channel_id: int, user_id: int, text: str) -> Reminder:
+        '''Schedule text to be delivered at due (unix seconds)'''
+        reminder_id = await asyncio.to_thread(self._insert, due, channel_id, user_id, text)
+        reminder = Reminder(due, reminder_id, channel_id, user_id, text)
+        heapq.heappush(self._heap, reminder)
+        REMINDERS_PENDING.set(len(self._heap))
+        self.start()
+        if self._heap[0] is reminder and self._wakeup is not None:
+            self._wakeup.set() # sleep until this one instead
+        return reminder
+
+    async def _run(self) -> None:
+        wakeup = self._wakeup
+        while True:
+            if len(self._heap) == 0:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            delay = self._heap[0].due - time.time()
+            if delay > 0:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=min(delay, self.MAX_SLEEP_S))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            reminder = heapq.heappop(self._heap)
+            REMINDERS_PENDING.set(len(self._heap))
+            try:
+                await self.deliver(reminder)
+                self.delivered += 1
+            except Exception as e:
+                print(f"[LOG] Reminder {reminder.id} could not be delivered, dropping it: {e}")
+            await asyncio.to_thread(self._delete, reminder.id)
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> str:
+        return f"reminders: {len(self._heap)} pending, {self.delivered} delivered"
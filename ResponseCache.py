@@ -0,0 +1,136 @@
+from __future__ import annotations
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from Metrics import CACHE_LOOKUPS
+from VectorDB import SentenceTransformerEmbedder, shared_embedder
+
+class ResponseCache:
+    '''
+    Opt-in cache of LLM completions, sits in front of the API call.
+
+    Exact tier: keyed by a canonical hash of the whole request (model, sampling settings, messages).
+    Semantic tier (optional): for single-turn requests (system prompt + one text-only user message), a new question
+    whose embedding is at least similarity_threshold cosine-similar to a cached question under the same model,
+    settings and system prompt reuses that answer.
+
+    Entries expire after ttl_s seconds and each tier holds at most max_entries (least recently used are dropped).
+    Questions are embedded with embedder, by default the app wide embedder of embed_model the vector db uses too.
+    '''
+    def __init__(self, ttl_s: float, max_entries: int, semantic: bool = False,
+                 similarity_threshold: float = 0.95, embed_model: str = "all-MiniLM-L6-v2",
+                 embedder: SentenceTransformerEmbedder | None = None):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.semantic = semantic
+        self.similarity_threshold = similarity_threshold
+        self.embed_model = embed_model
+        self._exact: OrderedDict[str, tuple[float, str]] = OrderedDict() # key -> (expires at, completion)
+        # scope (everything but the question) -> question key -> (expires at, normalized embedding, completion)
+        self._semantic: dict[str, OrderedDict[str, tuple[float, np.ndarray, str]]] = {}
+        self._semantic_size = 0
+        self.embedder = embedder if embedder is not None else shared_embedder(embed_model)
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(obj: object) -> str:
+        return hashlib.sha256(json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        '''Canonical hash of a chat completion request, identical requests hash the same regardless of key order'''
+        return ResponseCache._hash(request)
+
+    @staticmethod
+    def _single_turn_question(request: dict) -> tuple[str, str] | None:
+        '''(scope, question) if request is a single-turn text-only question, else None'''
+        messages = request["messages"]
+        if len(messages) != 2 or messages[1]["role"] != "user":
+            return None
+        parts = messages[1]["content"]
+        if isinstance(parts, str):
+            question = parts
+        elif all(part["type"] == "text" for part in parts):
+            question = "".join(part["text"] for part in parts)
+        else:
+            return None # images can't be compared through a text embedding
+        scope = ResponseCache._hash({k: v for k, v in request.items() if k != "messages"} | {"system": messages[0]})
+        return scope, question
+
+    def _embed(self, text: str) -> np.ndarray:
+        embedding = np.asarray(self.embedder.embed([text])[0], dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    async def get(self, request: dict) -> str | None:
+        '''Returns the cached completion for request, or None'''
+        now = time.time()
+        key = self.make_key(request)
+        hit = self._exact.get(key)
+        if hit is not None:
+            if hit[0] > now:
+                self._exact.move_to_end(key)
+                self.exact_hits += 1
+                CACHE_LOOKUPS.inc(cache="response", result="hit")
+                return hit[1]
+            del self._exact[key]
+
+        if self.semantic:
+            single_turn = self._single_turn_question(request)
+            if single_turn is not None and single_turn[0] in self._semantic:
+                scope, question = single_turn
+                entries = self._semantic[scope]
+                for k in [k for k, (expires, _, _) in entries.items() if expires <= now]:
+                    del entries[k]
+                    self._semantic_size -= 1
+                if len(entries) > 0:
+                    embedding = await asyncio.to_thread(self._embed, question)
+                    keys = list(entries.keys())
+                    similarities = np.stack([entries[k][1] for k in keys]) @ embedding
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        entries.move_to_end(keys[best])
+                        self.semantic_hits += 1
+                        CACHE_LOOKUPS.inc(cache="response", result="semantic_hit")
+                        return entries[keys[best]][2]
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc(cache="response", result="miss")
+        return None
+
+    async def put(self, request: dict, completion: str) -> None:
+        '''Cache completion as the answer to request'''
+        expires = time.time() + self.ttl_s
+        key = self.make_key(request)
+        self._exact[key] = (expires, completion)
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)
+
+        if self.semantic:
+            single_turn = self._single_turn_question(request)
+            if single_turn is None:
+                return
+            scope, question = single_turn
+            embedding = await asyncio.to_thread(self._embed, question)
+            entries = self._semantic.setdefault(scope, OrderedDict())
+            if key not in entries:
+                self._semantic_size += 1
+            entries[key] = (expires, embedding, completion)
+            while self._semantic_size > self.max_entries:
+                # drop the least recently used entry of the largest scope
+                largest = max(self._semantic.values(), key=len)
+                largest.popitem(last=False)
+                self._semantic_size -= 1
+
+    def stats(self) -> str:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        hit_rate = (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0
+        return (f"response cache: {len(self._exact)} exact entries, {self._semantic_size} semantic entries | "
+                f"exact hits: {self.exact_hits} semantic hits: {self.semantic_hits} misses: {self.misses} hit rate: {hit_rate:.2%}")
@@ -0,0 +1,109 @@
+from __future__ import annotations
+import time
+import asyncio
+import contextvars
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from Metrics import STAGE_SECONDS, IN_FLIGHT, QUEUED
+
+class QueueFullException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+class RequestScheduler:
+    '''
+    Sits between on_message and the LLM / personal assistant handlers.
+
+    Every user gets a FIFO queue of pending requests. The dispatcher takes one request from each user with
+    pending requests in turn (round robin), so one user spamming long prompts can't starve everyone else,
+    and never runs more than max_in_flight requests at once. Cheap commands can skip the queues entirely
+    (fast lane) so that they aren't stuck behind slow completions.
+    '''
+    def __init__(self, max_in_flight: int, max_queued_per_user: int):
+        self.max_in_flight = max_in_flight
+        self.max_queued_per_user = max_queued_per_user
+        self.in_flight = 0
+        # (job, future, enqueued at, submitter's context), jobs run in the context of their submitter (e.g. its trace)
+        self._queues: dict[str, deque[tuple[Callable[[], Awaitable[Any]], asyncio.Future, float, contextvars.Context]]] = {}
+        self._ready: deque[str] = deque() # users with pending requests, in round robin order
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def submit(self, user: str, job: Callable[[], Awaitable[Any]], fast: bool = False,
+                     on_queued: Callable[[int], Awaitable[Any]] | None = None) -> Any:
+        '''
+        Run job() on behalf of user once it is its turn and return its result.
+        fast jobs run right away. If the job has to wait, on_queued is awaited with its position in line (1 = next).
+        Raises QueueFullException if user already has max_queued_per_user requests waiting.
+        '''
+        if fast:
+            return await job()
+
+        queue = self._queues.setdefault(user, deque())
+        if len(queue) >= self.max_queued_per_user:
+            raise QueueFullException(f"You already have {len(queue)} requests queued, please wait for them to finish.")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append((job, future, time.perf_counter(), contextvars.copy_context()))
+        if len(queue) == 1:
+            self._ready.append(user)
+        self._dispatch()
+
+        pending = [f for _, f, _, _ in self._queues.get(user, ())]
+        if future in pending and on_queued is not None:
+            await on_queued(self.position(user, pending.index(future)))
+        return await future
+
+    def position(self, user: str, index: int) -> int:
+        '''
+        Position in line (1 = next to be dispatched) of the index-th pending request of user,
+        taking the round robin order into account.
+        '''
+        if user not in self._ready:
+            return 0
+        user_turn = self._ready.index(user)
+        ahead = index # the user's own earlier requests
+        for turn, other in enumerate(self._ready):
+            if other == user:
+                continue
+            # users before us in this round get one more turn before our request than the ones after us
+            ahead += min(len(self._queues[other]), index + (1 if turn < user_turn else 0))
+        return ahead + 1
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_in_flight and len(self._ready) > 0:
+            user = self._ready.popleft()
+            queue = self._queues[user]
+            job, future, enqueued_at, context = queue.popleft()
+            if len(queue) > 0:
+                self._ready.append(user) # back of the line for this user's next request
+            else:
+                del self._queues[user]
+            if future.cancelled():
+                continue # the submitter went away while waiting
+            STAGE_SECONDS.observe(time.perf_counter() - enqueued_at, stage="scheduler_wait")
+            self.in_flight += 1
+            task = asyncio.create_task(self._run(job, future), context=context)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        IN_FLIGHT.set(self.in_flight, limiter="scheduler")
+        QUEUED.set(self.queued, limiter="scheduler")
+
+    async def _run(self, job: Callable[[], Awaitable[Any]], future: asyncio.Future) -> None:
+        try:
+            result = await job()
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def stats(self) -> str:
+        return f"scheduler: in flight: {self.in_flight}/{self.max_in_flight} | queued: {self.queued} across {len(self._queues)} users"
@@ -0,0 +1,206 @@
+from __future__ import annotations
+import os
+import json
+import hashlib
+import asyncio
+from collections import OrderedDict
+from typing import Callable, Iterator
+
+class Session:
+    '''
+    One conversation, e.g. one user in one channel: its own gpt settings (including the messages of the thread),
+    current prompt and token accounting. The lock serializes requests within the session, while requests
+    in different sessions run concurrently.
+    '''
+    def __init__(self, key: str, settings: dict, prompt_name: str):
+        self.key = key
+        self.settings = settings # same layout as OpenAI_LLM.gpt_settings, messages included
+        self.curr_prompt_name = prompt_name
+        self.thread_token_counts: list[int] = [] # tokens of each message in settings["messages"]
+        self.thread_tokens = 0 # running total of thread_token_counts, trimmed messages left out
+        self.trimmed = 0 # messages right after the system prompt that were trimmed off but are still in the lists, see compact
+        self.size_bytes = 0 # approximate memory used by the messages, updated by SessionStore.release
+        self.lock = asyncio.Lock()
+        self.pins = 0 # number of requests between SessionStore.acquire and release, pinned sessions are never evicted
+
+    @property
+    def messages(self) -> list[dict]:
+        '''
+        The live messages of the thread, system prompt first. While trimmed messages are waiting to be compacted
+        away this is a copy, messages are added with OpenAI_LLM._append_to_thread.
+        '''
+        thread = self.settings["messages"][0]
+        if self.trimmed == 0:
+            return thread
+        return thread[:1] + thread[1 + self.trimmed:]
+
+    def compact(self) -> None:
+        '''Remove the trimmed messages (and their token counts) from the lists'''
+        if self.trimmed > 0:
+            del self.settings["messages"][0][1:1 + self.trimmed]
+            del self.thread_token_counts[1:1 + self.trimmed]
+            self.trimmed = 0
+
+    def to_dict(self) -> dict:
+        self.compact()
+        return {
+            "key": self.key,
+            "settings": self.settings,
+            "curr_prompt_name": self.curr_prompt_name,
+            "thread_token_counts": self.thread_token_counts,
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> Session:
+        x = Session(d["key"], d["settings"], d["curr_prompt_name"])
+        x.thread_token_counts = d["thread_token_counts"]
+        x.thread_tokens = sum(x.thread_token_counts)
+        return x
+
+def _message_size(message: dict) -> int:
+    '''approximate number of bytes a message holds, dominated by text and base64 image urls'''
+    content = message["content"]
+    if isinstance(content, str):
+        return len(content)
+    size = 0
+    for part in content:
+        if part["type"] == "text":
+            size += len(part["text"])
+        elif part["type"] == "image_url":
+            size += len(part["image_url"]["url"])
+    return size
+
+class SessionStore:
+    '''
+    Sessions keyed by (guild, channel, user or thread), see Message.session_key.
+
+    Resident sessions are kept in LRU order. Once they hold more than max_bytes of messages (or there are more than
+    max_sessions of them), the least recently used idle sessions are written to json files under data_dir and dropped
+    from memory. They are transparently reloaded the next time they are needed.
+    The default session (key None) is the template new sessions are created from and is never evicted.
+
+    The json files are read and written in a worker thread to keep them off the event loop. Loads and evictions
+    take turns (io_lock), so a session being written out is only reloaded once its file is complete.
+    '''
+    def __init__(self, data_dir: str, new_session: Callable[[str], Session], max_bytes: int, max_sessions: int):
+        self.data_dir = data_dir
+        self.new_session = new_session
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.default: Session | None = None
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._evicting: dict[str, Session] = {} # dropped from memory, file not written yet
+        self._total_bytes = 0
+        self._io_lock = asyncio.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.data_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+    def _load(self, key: str) -> Session | None:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            session = Session.from_dict(json.load(f))
+        os.remove(path)
+        return session
+
+    def _write(self, sessions: list[Session]) -> None:
+        os.makedirs(self.data_dir, exist_ok=True)
+        for session in sessions:
+            tmp_path = self._path(session.key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(session.to_dict(), f)
+            os.replace(tmp_path, self._path(session.key))
+
+    async def acquire(self, key: str | None) -> Session:
+        '''
+        Returns the session for key: resident, reloaded from disk, or newly created.
+        The session is pinned in memory until it is given back with release.
+        '''
+        if key is None:
+            if self.default is None:
+                raise Exception("SessionStore: default session has not been set.")
+            return self.default
+
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+            session.pins += 1
+            return session
+
+        async with self._io_lock:
+            session = self._sessions.get(key) # loaded by another request while this one waited
+            if session is not None:
+                self._sessions.move_to_end(key)
+            else:
+                session = await asyncio.to_thread(self._load, key)
+                if session is None:
+                    session = self.new_session(key)
+                session.size_bytes = sum(_message_size(m) for m in session.messages)
+                self._sessions[key] = session
+                self._total_bytes += session.size_bytes
+            session.pins += 1
+        await self._evict()
+        return session
+
+    async def release(self, session: Session) -> None:
+        '''Unpin a session returned by acquire, updating its size and evicting idle sessions if over the cap'''
+        if session is self.default:
+            return
+        session.pins -= 1
+        new_size = sum(_message_size(m) for m in session.messages)
+        self._total_bytes += new_size - session.size_bytes
+        session.size_bytes = new_size
+        await self._evict()
+
+    async def _evict(self) -> None:
+        if self._total_bytes <= self.max_bytes and len(self._sessions) <= self.max_sessions:
+            return
+        async with self._io_lock:
+            victims = []
+            for key in list(self._sessions.keys()):
+                if self._total_bytes <= self.max_bytes and len(self._sessions) <= self.max_sessions:
+                    break
+                session = self._sessions[key]
+                if session.pins > 0:
+                    continue # in use, evicting it would lose the request's changes
+                del self._sessions[key]
+                self._evicting[key] = session
+                self._total_bytes -= session.size_bytes
+                victims.append(session)
+            if len(victims) == 0:
+                return
+            try:
+                await asyncio.to_thread(self._write, victims)
+            except Exception:
+                # keep them in memory rather than lose them
+                for session in victims:
+                    self._sessions[session.key] = session
+                    self._total_bytes += session.size_bytes
+                raise
+            finally:
+                for session in victims:
+                    del self._evicting[session.key]
+
+    def resident_messages(self) -> Iterator[dict]:
+        '''the messages of the sessions in memory, the default session and those being written out included'''
+        sessions = list(self._sessions.values()) + list(self._evicting.values()) + ([self.default] if self.default is not None else [])
+        for session in sessions:
+            yield from session.messages
+
+    def evicted_messages(self) -> Iterator[dict]:
+        '''the messages of the sessions written to data_dir (blocking, call from a worker thread)'''
+        if not os.path.isdir(self.data_dir):
+            return
+        for name in os.listdir(self.data_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.data_dir, name), "r") as f:
+                    yield from Session.from_dict(json.load(f)).messages
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue # reloaded (and removed) or being written right now
+
+    def stats(self) -> str:
+        return f"sessions: {len(self._sessions)} resident, ~{self._total_bytes} bytes of messages"
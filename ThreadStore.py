@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import asyncio
+import pickle
+import sqlite3
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+class ThreadStore:
+    '''
+    Saved gpt threads in a single sqlite database.
+
+    Every thread is one row holding its metadata (id, created, prompt name, token count, number of messages, preview)
+    next to its messages as json. Listings only read the metadata columns, so they stay cheap no matter how many
+    threads (or how many base64 images in them) have been saved.
+
+    The async methods run the queries in a worker thread to keep them off the event loop.
+    '''
+    PREVIEW_LEN = 80
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS threads (
+                    id TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    prompt_name TEXT,
+                    token_count INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    preview TEXT NOT NULL,
+                    messages TEXT NOT NULL
+                )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS threads_created ON threads (created)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        '''a connection per call (calls come from different worker threads), committed and closed at the end of the block'''
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _preview(messages: list[dict]) -> str:
+        '''first bit of text of the first user message'''
+        for msg in messages:
+            if msg["role"] != "user":
+                continue
+            content = msg["content"]
+            text = content if isinstance(content, str) else " ".join(c["text"] for c in content if c["type"] == "text")
+            text = " ".join(text.split())
+            return text[:ThreadStore.PREVIEW_LEN] + ("..." if len(text) > ThreadStore.PREVIEW_LEN else "")
+        return ""
+
+    def _save(self, messages: list[dict], prompt_name: str | None, token_count: int) -> str:
+        created = time.time()
+        thread_id = str(created)
+        with self._connect() as conn:
+            conn.execute("INSERT INTO threads VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (thread_id, created, prompt_name, token_count, len(messages), self._preview(messages), json.dumps(messages)))
+        return thread_id
+
+    def import_pickled_threads(self, pickle_dir: str, count_tokens: Callable[[list[dict]], int]) -> int:
+        '''
+        One-time import of the threads 'save thread' used to write as pickle_dir/<time>.pkl, keeping their ids.
+        The directory is renamed to pickle_dir.imported afterwards, so pickle is never touched again once the
+        import has run. Returns the number of threads imported.
+        '''
+        if not os.path.isdir(pickle_dir):
+            return 0
+        rows = []
+        for filename in sorted(os.listdir(pickle_dir)):
+            if not filename.endswith(".pkl"):
+                continue
+            path = os.path.join(pickle_dir, filename)
+            try:
+                with open(path, "rb") as f:
+                    messages = pickle.load(f) # written by this bot, see the docstring
+            except Exception as e:
+                print(f"[LOG] Could not import saved thread {filename}, skipping it: {e}")
+                continue
+            thread_id = filename[:-4]
+            try:
+                created = float(thread_id)
+            except ValueError:
+                created = os.path.getmtime(path)
+            rows.append((thread_id, created, None, count_tokens(messages), len(messages), self._preview(messages), json.dumps(messages)))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO threads VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        os.replace(pickle_dir, pickle_dir + ".imported")
+        print(f"[LOG] Imported {len(rows)} saved threads from {pickle_dir}")
+        return len(rows)
+
+    def _list(self, page: int, page_size: int) -> tuple[list[dict], int]:
+        with self._connect() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+            rows = conn.execute('''
+                SELECT id, created, prompt_name, token_count, message_count, preview FROM threads
+                ORDER BY created DESC LIMIT ? OFFSET ?''', (page_size, (page - 1) * page_size)).fetchall()
+        keys = ["id", "created", "prompt_name", "token_count", "message_count", "preview"]
+        return [dict(zip(keys, row)) for row in rows], total
+
+    def _load(self, thread_id: str) -> list[dict] | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT messages FROM threads WHERE id = ?", (thread_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def iter_messages(self) -> Iterator[dict]:
+        '''every message of every saved thread, one thread in memory at a time (blocking, call from a worker thread)'''
+        with self._connect() as conn:
+            for (messages,) in conn.execute("SELECT messages FROM threads"):
+                yield from json.loads(messages)
+
+    def _delete(self, thread_id: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM threads WHERE id = ?", (thread_id,)).rowcount > 0
+
+    async def save(self, messages: list[dict], prompt_name: str | None, token_count: int) -> str:
+        '''Save a thread, returns its id'''
+        # snapshot now, the live thread may keep changing while the worker thread serializes it
+        return await asyncio.to_thread(self._save, list(messages), prompt_name, token_count)
+
+    async def list_threads(self, page: int = 1, page_size: int = 10) -> tuple[list[dict], int]:
+        '''Metadata of the threads on page (1-indexed, newest first) and the total number of threads'''
+        return await asyncio.to_thread(self._list, page, page_size)
+
+    async def load(self, thread_id: str) -> list[dict] | None:
+        '''The messages of a thread, or None if there is no thread with that id'''
+        return await asyncio.to_thread(self._load, thread_id)
+
+    async def delete(self, thread_id: str) -> bool:
+        '''Delete a thread, returns False if there was no thread with that id'''
+        return await asyncio.to_thread(self._delete, thread_id)
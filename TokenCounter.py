@@ -0,0 +1,102 @@
+import base64
+import binascii
+import io
+import math
+import os
+import time
+
+import tiktoken
+from PIL import Image
+
+# every message costs a few tokens of framing on top of its content, see openai's cookbook
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3 # every reply is primed with <|start|>assistant<|message|>
+
+# vision pricing: an image is scaled to fit in 2048x2048, then its shortest side to 768,
+# and costs a base amount plus a fixed amount per 512x512 tile
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_LOW_DETAIL_TOKENS = 85
+
+# after a tokenizer fails to load, the 1 token ~= 4 chars estimate is used for this many seconds before retrying
+TOKENIZER_RETRY_S = float(os.getenv("TOKENIZER_RETRY_S", "300"))
+
+_encodings: dict[str, tiktoken.Encoding] = {}
+_encoding_failed_at: dict[str, float] = {}
+
+def _get_encoding(model: str) -> tiktoken.Encoding | None:
+    '''
+    Tokenizer for model, None if it can't be loaded (e.g. the bpe file can't be downloaded).
+    Only loaded tokenizers are cached, a failure is retried after TOKENIZER_RETRY_S.
+    '''
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    failed_at = _encoding_failed_at.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < TOKENIZER_RETRY_S:
+        return None
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # newer model names than the installed tiktoken knows about use the gpt-4o tokenizer
+            encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"[LOG] Could not load the tokenizer for {model}, estimating tokens from characters: {e}")
+        _encoding_failed_at[model] = time.monotonic()
+        return None
+    _encoding_failed_at.pop(model, None)
+    _encodings[model] = encoding
+    return encoding
+
+def count_text_tokens(text: str, model: str) -> int:
+    '''Number of tokens text is for model'''
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / 4) # 1 token ~= 4 chars
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_image_tokens(image_b64: str, detail: str = "auto") -> int:
+    '''Number of tokens a base64 encoded image costs as a vision input'''
+    if detail == "low":
+        return IMAGE_LOW_DETAIL_TOKENS
+    try:
+        # only the header is parsed to get the size, the pixels are never decoded
+        width, height = Image.open(io.BytesIO(base64.b64decode(image_b64))).size
+    except (binascii.Error, OSError, ValueError):
+        return IMAGE_BASE_TOKENS + 4 * IMAGE_TILE_TOKENS # assume a typical 1024x1024 image
+    return count_image_size_tokens(width, height, detail)
+
+def count_image_size_tokens(width: int, height: int, detail: str = "auto") -> int:
+    '''Number of tokens a width x height image costs as a vision input'''
+    if detail == "low":
+        return IMAGE_LOW_DETAIL_TOKENS
+    if width <= 0 or height <= 0:
+        return IMAGE_BASE_TOKENS + 4 * IMAGE_TILE_TOKENS # size unknown, assume a typical 1024x1024 image
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+def count_message_tokens(message: dict, model: str) -> int:
+    '''Number of tokens a single openai chat message (role + list of content parts) costs'''
+    tokens = TOKENS_PER_MESSAGE + count_text_tokens(message["role"], model)
+    content = message["content"]
+    if isinstance(content, str):
+        return tokens + count_text_tokens(content, model)
+    for part in content:
+        if part["type"] == "text":
+            tokens += count_text_tokens(part["text"], model)
+        elif part["type"] == "image_url":
+            url = part["image_url"]["url"]
+            detail = part["image_url"].get("detail", "auto")
+            tokens += count_image_tokens(url.split(",", 1)[1] if url.startswith("data:") else "", detail)
+        elif part["type"] == "image":
+            # reference to an image in the BlobStore, its size was recorded when it was stored
+            tokens += count_image_size_tokens(part["image"].get("width", 0), part["image"].get("height", 0))
+        elif part["type"] == "pdf":
+            # reference to extracted pdf text in the BlobStore, counted once when it was stored
+            tokens += part["pdf"]["tokens"]
+    return tokens
@@ -0,0 +1,243 @@
+'''
+Per-message traces: every message handled by the bot gets a trace id, and the subsystems it goes through record
+nested spans (start, end and attributes like the model, tokens, pages OCR'd or k) into it. Completed traces are
+appended to a jsonl file, one trace per line.
+
+The current span lives in a contextvar, so it follows the request through awaits, asyncio tasks and
+asyncio.to_thread. Messages also carry the span they were created under (Message.trace), for the places where
+the context doesn't follow on its own.
+
+View traces as a timeline / flame graph (chrome://tracing or https://ui.perfetto.dev), or see which spans take
+the time of the slowest traces:
+    python Tracing.py data/traces.jsonl --chrome trace.json [--slowest 0.01]
+    python Tracing.py data/traces.jsonl --summary [--slowest 0.01]
+'''
+from __future__ import annotations
+import os
+import json
+import time
+import secrets
+import argparse
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+class Span:
+    '''A timed piece of work within a trace, a child of parent (None for the root span of the trace)'''
+    def __init__(self, trace: Trace, name: str, parent: Span | None, attributes: dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.error: str | None = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+        self.trace._finished(self)
+
+    def to_dict(self) -> dict:
+        end = self.end if self.end is not None else time.perf_counter()
+        return {
+            "id": self.span_id,
+            "parent": self.parent.span_id if self.parent is not None else None,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class _NoSpan:
+    '''Stands in for a span outside of any trace, so callers can always set attributes'''
+    trace = None
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+NO_SPAN = _NoSpan()
+
+class Trace:
+    '''The spans of one message, written to sink once the root span ends'''
+    def __init__(self, sink: TraceSink | None):
+        self.trace_id = secrets.token_hex(16)
+        self.sink = sink
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans: list[Span] = [] # finished spans
+        self._lock = threading.Lock() # spans may end in worker threads
+
+    def _finished(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+        if span.parent is None and self.sink is not None:
+            self.sink.write(self)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        root = next((s for s in spans if s.parent is None), None)
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name if root is not None else None,
+            "timestamp": self.wall_start,
+            "duration_ms": root.to_dict()["duration_ms"] if root is not None else None,
+            "spans": [s.to_dict() for s in sorted(spans, key=lambda s: s.start)],
+        }
+
+class TraceSink:
+    '''
+    Appends completed traces to a jsonl file, rotating it to path.1 once it grows past max_bytes.
+    Only traces of at least min_duration_ms are kept, to keep just the slow ones around.
+    '''
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, min_duration_ms: float = 0.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.min_duration_ms = min_duration_ms
+        self._lock = threading.Lock()
+
+    def write(self, trace: Trace) -> None:
+        record = trace.to_dict()
+        if record["duration_ms"] is not None and record["duration_ms"] < self.min_duration_ms:
+            return
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a") as f:
+                f.write(line)
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+def _default_sink() -> TraceSink | None:
+    path = os.getenv("TRACES_PATH", os.path.join(os.getenv("APP_DATA_DIR", "./data"), "traces.jsonl"))
+    if path == "":
+        return None
+    return TraceSink(path, int(os.getenv("TRACES_MAX_BYTES", str(64 * 1024 * 1024))), float(os.getenv("TRACES_MIN_DURATION_MS", "0")))
+
+trace_sink = _default_sink() # TRACES_PATH="" turns tracing off
+
+@contextmanager
+def start_trace(name: str, sink: TraceSink | None = None, **attributes: Any) -> Iterator[Span | _NoSpan]:
+    '''Start a new trace whose root span is the block, it is written to sink (default trace_sink) when the block ends'''
+    sink = sink if sink is not None else trace_sink
+    if sink is None:
+        yield NO_SPAN
+        return
+    root = Span(Trace(sink), name, None, attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        root.finish()
+
+@contextmanager
+def span(name: str, parent: Span | None = None, **attributes: Any) -> Iterator[Span | _NoSpan]:
+    '''
+    Record the block as a child of the current span, or of parent (e.g. a Message's trace) if the current span
+    is not part of parent's trace.
+    Outside of any trace this does nothing.
+    '''
+    current = current_span()
+    if parent is None or (current is not None and current.trace is parent.trace):
+        parent = current
+    if parent is None:
+        yield NO_SPAN
+        return
+    child = Span(parent.trace, name, parent, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+#################### viewing ####################
+
+def read_traces(path: str) -> list[dict]:
+    traces = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                traces.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue # torn last line
+    return traces
+
+def slowest(traces: list[dict], fraction: float) -> list[dict]:
+    '''the slowest fraction of traces (at least one), slowest first'''
+    traces = sorted((t for t in traces if t["duration_ms"] is not None), key=lambda t: t["duration_ms"], reverse=True)
+    return traces[:max(1, round(len(traces) * fraction))] if traces else []
+
+def to_chrome_trace(traces: list[dict]) -> dict:
+    '''
+    Chrome trace event format: one row (thread) per trace, spans as complete events nested by time,
+    so each trace shows as a flame graph on a shared timeline.
+    '''
+    events = []
+    start = min((t["timestamp"] for t in traces), default=0.0)
+    for row, t in enumerate(traces):
+        offset_us = (t["timestamp"] - start) * 1e6
+        events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": row,
+                       "args": {"name": f"{t['name']} {t['trace_id'][:8]} ({t['duration_ms']:.0f}ms)"}})
+        for s in t["spans"]:
+            events.append({
+                "ph": "X", "pid": 1, "tid": row, "name": s["name"],
+                "ts": offset_us + s["start_ms"] * 1000, "dur": s["duration_ms"] * 1000,
+                "args": {**s["attributes"], **({"error": s["error"]} if s["error"] else {})},
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def self_times(traces: list[dict]) -> dict[str, float]:
+    '''
+    Total self time (ms, duration minus the children's) of each span name across traces, i.e. where the time went.
+    Children running concurrently can add up to more than their parent, the self time is then 0.
+    '''
+    totals: dict[str, float] = defaultdict(float)
+    for t in traces:
+        children: dict[str, float] = defaultdict(float)
+        for s in t["spans"]:
+            if s["parent"] is not None:
+                children[s["parent"]] += s["duration_ms"]
+        for s in t["spans"]:
+            totals[s["name"]] += max(0.0, s["duration_ms"] - children[s["id"]])
+    return dict(sorted(totals.items(), key=lambda x: x[1], reverse=True))
+
+def main():
+    parser = argparse.ArgumentParser(description="view the traces written by the bot")
+    parser.add_argument("path", help="traces jsonl file")
+    parser.add_argument("--slowest", type=float, default=1.0, help="only the slowest fraction of traces, e.g. 0.01")
+    parser.add_argument("--chrome", help="write a chrome trace (chrome://tracing, ui.perfetto.dev) to this file")
+    parser.add_argument("--summary", action="store_true", help="print the self time of each span name")
+    args = parser.parse_args()
+
+    traces = slowest(read_traces(args.path), args.slowest)
+    print(f"{len(traces)} traces")
+    if args.chrome:
+        with open(args.chrome, "w") as f:
+            json.dump(to_chrome_trace(traces), f)
+    if args.summary or not args.chrome:
+        total = sum(t["duration_ms"] for t in traces) or 1.0
+        for name, ms in self_times(traces).items():
+            print(f"{name:<28} {ms:>12.1f}ms  {ms / total:>7.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,50 @@ from __future__ import annotations
 import discord
 import re
 import os
-import fitz # PyMuPDF
-import base64
-import pytesseract # OCR engine
 from PIL import Image
 import io
 import datetime
+import time
 from typing import Callable, Any
 import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
-import requests
+import aiohttp
+
+from AttachmentCache import AttachmentCache
+from Metrics import stage, PDF_PAGES
+from Tracing import Span, current_span
+from OutboundQueue import OutboundQueue, split_message
+from ImagePreprocessor import MyImage, UnsupportedImageError, image_preprocessor
+
+if TYPE_CHECKING:
+    import fitz
+
+# fitz (PyMuPDF) and pytesseract are only imported once a pdf actually needs reading, see warm_up_pdf_reader
 
 DISCORD_MSGLEN_CAP=2000
+# replies that would take more messages than this are sent as a file instead
+DISCORD_MAX_REPLY_MESSAGES = int(os.getenv("DISCORD_MAX_REPLY_MESSAGES", "5"))
+
+# every message the bot sends goes through a per channel queue paced to discord's rate limits
+outbound_queue = OutboundQueue(rate=float(os.getenv("DISCORD_SEND_RATE", "1.0")), # messages per second per channel
+                               burst=float(os.getenv("DISCORD_SEND_BURST", "5")),
+                               limit=DISCORD_MSGLEN_CAP)
 
 class MyCustomException(Exception):
     def __init__(self, message):
         super().__init__(message)
 
 class MyPDF:
-    def __init__(self, url : str, embedded_text : str, ocr_text : str, raw_bytes : bytes):
+    def __init__(self, url : str, embedded_text : str, ocr_text : str, raw_bytes : bytes, extraction : PDFExtraction | None = None):
         self.url = url
         self.embedded_text = embedded_text
         self.ocr_text = ocr_text
         self.raw_bytes = raw_bytes
+        self.extraction = extraction # per page texts and ocr decisions, if available
 
 '''
 This acts as a common data structure for messages, which will allow me to 
@@ -40,7 +61,7 @@ class Message:
         dict[str -> list[str | object]]
     where the contents of the lists varies for key:
         1. texts: str
-        2. images: base64 encoded str
+        2. images: MyImage Class Objects
         3. pdfs: MyPDF Class Objects
 
     Methods whose name begins with _test are used for unit testing
@@ -52,6 +73,10 @@ class Message:
         self.author: discord.User | discord.Member | None = None
         self.discordMsg: discord.message.Message | None = None # obj needed for sending msgs back to the user
         self.attachments = None
+        self.reply_stream: StreamingReply | None = None # if set, generators may stream their reply into it
+        self.session_key: str | None = None # which conversation this message belongs to, None is the default conversation
+        self.trace: Span | None = None # trace context, the span this message was created under (see Tracing)
+        self.attachment_errors: list[str] = [] # why attachments were left out, to tell the user
  
     def _import_from_bare_text(self, msg: str) -> None:
         """
@@ -64,15 +89,19 @@ class Message:
         self.msgType = "bare"
         self.content = msg
 
-    def _import_from_discord(self, msg: discord.message.Message) -> None:
+    async def _import_from_discord(self, msg: discord.message.Message) -> None:
         """
         Imports the parts of the discord message that I actually use.
         Mutates the current instance.
+
+        All attachments are downloaded concurrently through the shared AttachmentDownloader
+        and PDF extraction runs in a worker thread, so nothing here blocks the event loop.
         """
 
         self.content = msg.content # str
         self.author = msg.author   # discord.User | discord.Member
         self.discordMsg = msg      # discord.message.Message
+        self.session_key = Message._discord_session_key(msg)
 
         self.attachments = None
 
@@ -82,45 +111,29 @@ class Message:
             self.attachments['images'] = []
             self.attachments['pdfs'] = []
 
-            text_file_formats = ['.txt', '.c', '.cpp', '.py', '.ipynb', '.java', '.js', '.html', '.css', '.json', '.xml', '.yaml', '.yml', '.md']
-            image_file_formats = ['.jpg', '.png', '.heic']
-
-            for attachment in msg.attachments:
-                # text files (plain text and code)
-                # text files are stored as strings
-                for file_format in text_file_formats:
-                    if attachment.filename.endswith(file_format):
-                        # Download the attachment
-                        response = requests.get(attachment.url)
-                        if response.status_code != 200: 
-                            raise MyCustomException(f'request got status code: {response.status_code}')
-                        file_content = response.text
-                        self.attachments['texts'].append(file_content)
-
-                # images (allow .jpg, .png, .heic)
-                # images are stored as base64 encoded strings
-                for image_format in image_file_formats:
-                    if attachment.filename.endswith(image_format):
-                        response = requests.get(attachment.url)
-                        if response.status_code != 200:
-                            raise MyCustomException(f'request got status code: {response.status_code}')
-                        encodedImage = base64.b64encode(response.content).decode('utf-8')
-                        self.attachments['images'].append(encodedImage)
-
-                # pdfs (save as a MyPDF object)
-                if attachment.filename.endswith('.pdf'):
-                    response = requests.get(attachment.url)
-                    if response.status_code != 200:
-                        raise MyCustomException(f'request got status code: {response.status_code}')
-                    embedded_text, ocr_text = read_pdf_from_memory(response.content)
-                    mypdf = MyPDF(attachment.url, embedded_text, ocr_text, response.content) 
-                    self.attachments['pdfs'].append(mypdf)
+            wanted = [(kind, attachment) for attachment in msg.attachments 
+                      if (kind := _classify_attachment(attachment.filename)) is not None]
+            results = await asyncio.gather(*[_ingest_attachment(kind, attachment) for kind, attachment in wanted], return_exceptions=True)
+
+            # keep the upload order within each kind of attachment
+            for (kind, attachment), result in zip(wanted, results):
+                if isinstance(result, UnsupportedImageError):
+                    self.attachment_errors.append(str(result)) # leave it out rather than send an invalid payload
+                elif isinstance(result, MyCustomException):
+                    # download failed (too big, timed out, bad status), the rest of the message is still handled
+                    self.attachment_errors.append(f"{attachment.filename}: {result}")
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    self.attachments[kind].append(result)
 
     @staticmethod
     async def send_msg_to_usr(msg: Message, usr_msg: str | None) -> None: 
         '''
         in case msg is longer than the DISCORD_MSGLEN_CAP, this abstracts away worrying about that and just sends 
         the damn message (whether it be one or multiple messages)
+        Long messages are split between paragraphs / lines (see split_message), if that takes more than
+        DISCORD_MAX_REPLY_MESSAGES messages the whole reply is sent as a file instead.
         '''
         if usr_msg is None:
             return
@@ -129,14 +142,13 @@ class Message:
             discordMsg = msg.discordMsg
             if discordMsg is None:
                 raise Exception("Unexpected discordMsg is None.")
-            diff = len(usr_msg)
-            start = 0
-            end = DISCORD_MSGLEN_CAP
-            while diff > 0:
-                await discordMsg.channel.send(usr_msg[start:end])
-                start = end
-                end += DISCORD_MSGLEN_CAP
-                diff -= DISCORD_MSGLEN_CAP
+            chunks = split_message(usr_msg, DISCORD_MSGLEN_CAP)
+            with stage("send_text", chars=len(usr_msg), messages=len(chunks)):
+                if len(chunks) > DISCORD_MAX_REPLY_MESSAGES:
+                    reply = discord.File(fp=io.BytesIO(usr_msg.encode()), filename="reply.md")
+                    await outbound_queue.send(discordMsg.channel, f"The reply is {len(usr_msg)} characters long, see the attached file.", file=reply)
+                else:
+                    await outbound_queue.send_many(discordMsg.channel, chunks)
         elif msg.msgType == 'test':
             print(usr_msg)
         else:
@@ -149,10 +161,10 @@ class Message:
             discordMsg = msg.discordMsg
             if discordMsg is None:
                 raise Exception("Unexpected discordMsg is None.")
-            with io.BytesIO() as image_binary:
+            with stage("send_image"), io.BytesIO() as image_binary:
                 image.save(image_binary, format='PNG')
                 image_binary.seek(0)
-                await discordMsg.channel.send(file=discord.File(fp=image_binary, filename='image.png'))
+                await outbound_queue.send(discordMsg.channel, file=discord.File(fp=image_binary, filename='image.png'))
         elif msg.msgType == 'test':
             print('Image sent')
         else: 
@@ -168,24 +180,262 @@ class Message:
                 raise Exception("Unexpected discordMsg is None.")
             completeFilename = f"{filename}.{fileExtension}"
             fileToSend = discord.File(fp=io.BytesIO(fileBytes), filename=completeFilename)
-            await msg.discordMsg.channel.send(file=fileToSend)
+            with stage("send_file"):
+                await outbound_queue.send(msg.discordMsg.channel, file=fileToSend)
         elif msg.msgType == 'test':
             print(f"File sent: {filename}.{fileExtension}")
         else:
             print('Unknown msgType')
 
     @staticmethod
-    def from_text(msg: str) -> Message:
+    def _discord_session_key(msg: discord.message.Message) -> str:
+        '''
+        Conversations are per user per channel, except in discord threads where everyone in the thread shares one.
+        '''
+        guild_id = msg.guild.id if msg.guild is not None else "dm"
+        if isinstance(msg.channel, discord.Thread):
+            return f"{guild_id}:{msg.channel.id}:thread"
+        return f"{guild_id}:{msg.channel.id}:{msg.author.id}"
+
+    @staticmethod
+    def from_text(msg: str, parent: Message | None = None) -> Message:
+        '''
+        Wrap a bare string. If it is derived from another message (parent), e.g. a prompt built
+        by a command, it stays in the parent's conversation and trace.
+        '''
         x = Message(msgType="bare")
         x._import_from_bare_text(msg)
+        x.trace = current_span()
+        if parent is not None:
+            x.session_key = parent.session_key
+            x.trace = parent.trace if parent.trace is not None else x.trace
         return x
 
     @staticmethod
-    def from_discord(msg: discord.message.Message) -> Message:
+    async def from_discord(msg: discord.message.Message) -> Message:
         x = Message(msgType="discord")
-        x._import_from_discord(msg)
+        x.trace = current_span()
+        with stage("from_discord"):
+            await x._import_from_discord(msg)
         return x
 
+class StreamingReply:
+    '''
+    Shows a reply while it is still being generated.
+    A placeholder message is posted right away and then edited with the text received so far, at most once
+    every edit_interval seconds to stay well within discord's edit rate limits. Once the text outgrows
+    DISCORD_MSGLEN_CAP, it rolls over into additional messages, up to DISCORD_MAX_REPLY_MESSAGES of them. A reply
+    longer than that stops rolling over and the complete text is attached as a file once it is finished.
+
+    The edits and new messages are sent from a background task, so push never waits on discord's rate limits
+    (the caller may be holding an API request slot while it pushes).
+    '''
+    def __init__(self, msg: Message, edit_interval: float = 1.0, placeholder: str = "...", max_messages: int | None = None):
+        self.msg = msg
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.max_messages = max_messages if max_messages is not None else DISCORD_MAX_REPLY_MESSAGES
+        self.used = False # True once anything was shown to the user
+        self.finished = False
+        self._parts: list[str] = []
+        self._sent: list[discord.message.Message] = []
+        self._shown: list[str] = [] # the content currently displayed by each message in _sent
+        self._last_flush = 0.0
+        self._flushing: asyncio.Task | None = None
+        self.error: str | None = None # set by fail
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def start(self) -> None:
+        '''Post the placeholder message'''
+        self.used = True
+        if self.msg.msgType == 'discord':
+            if self.msg.discordMsg is None:
+                raise Exception("Unexpected discordMsg is None.")
+            self._sent.append(await outbound_queue.send(self.msg.discordMsg.channel, self.placeholder, coalesce=False))
+            self._shown.append(self.placeholder)
+        self._last_flush = time.monotonic()
+
+    async def push(self, delta: str) -> None:
+        '''Append newly generated text, the displayed message(s) are only updated if edit_interval has passed'''
+        if not self.used:
+            await self.start()
+        self._parts.append(delta)
+        if time.monotonic() - self._last_flush >= self.edit_interval and (self._flushing is None or self._flushing.done()):
+            self._last_flush = time.monotonic()
+            self._flushing = asyncio.create_task(self._flush())
+
+    async def finish(self) -> None:
+        '''Display the complete text'''
+        if not self.used:
+            await self.start()
+        self.finished = True
+        if self.msg.msgType == 'test':
+            print(self.text)
+            return
+        if self._flushing is not None:
+            await self._flushing
+        if len(self.text) == 0:
+            await self._notice("(the model returned an empty reply)")
+            return
+        await self._flush(final=True)
+
+    async def fail(self, error: str) -> None:
+        '''
+        The reply could not be completed: error replaces the placeholder, or is added after the partial reply.
+        The caller is expected to re-raise, delivered(error) is then True so the error isn't posted twice.
+        '''
+        self.error = error
+        self.finished = True
+        if self._flushing is not None:
+            try:
+                await self._flushing
+            except Exception:
+                pass # the error being reported is what matters now
+        if self.msg.msgType == 'test':
+            print(error)
+            return
+        try:
+            await self._notice(error)
+        except Exception as e:
+            print(f"[LOG] Could not show the error in the streamed reply: {e}")
+
+    async def _notice(self, notice: str) -> None:
+        '''show notice in place of the placeholder, or after the text shown so far'''
+        if self.msg.msgType != 'discord' or self.msg.discordMsg is None or len(self._sent) == 0:
+            return
+        shown = self._shown[-1]
+        content = notice if shown == self.placeholder else f"{shown}\n\n{notice}"
+        if len(content) <= DISCORD_MSGLEN_CAP:
+            await self._sent[-1].edit(content=content)
+            self._shown[-1] = content
+        else:
+            self._sent.append(await outbound_queue.send(self.msg.discordMsg.channel, notice[:DISCORD_MSGLEN_CAP], coalesce=False))
+            self._shown.append(notice[:DISCORD_MSGLEN_CAP])
+
+    def delivered(self, usr_msg: str | None) -> bool:
+        '''True if usr_msg has already been completely shown to the user through this stream'''
+        if self.error is not None:
+            return usr_msg == self.error
+        return self.finished and usr_msg == self.text
+
+    async def _flush(self, final: bool = False) -> None:
+        self._last_flush = time.monotonic()
+        if self.msg.msgType != 'discord' or self.msg.discordMsg is None:
+            return
+        text = self.text
+        if len(text) == 0:
+            return
+        chunks = split_message(text, DISCORD_MSGLEN_CAP)
+        overflow = len(chunks) > self.max_messages
+        with stage("send_stream", messages=min(len(chunks), self.max_messages), overflow=overflow):
+            # past max_messages the messages keep showing the start of the reply, the rest comes as a file
+            for i, chunk in enumerate(chunks[:self.max_messages]):
+                if i < len(self._sent):
+                    # only the last (still growing) messages actually change
+                    if self._shown[i] != chunk:
+                        await self._sent[i].edit(content=chunk)
+                        self._shown[i] = chunk
+                else:
+                    self._sent.append(await outbound_queue.send(self.msg.discordMsg.channel, chunk, coalesce=False))
+                    self._shown.append(chunk)
+            if overflow and final:
+                reply = discord.File(fp=io.BytesIO(text.encode()), filename="reply.md")
+                await outbound_queue.send(self.msg.discordMsg.channel, f"The reply is {len(text)} characters long, see the attached file.", file=reply)
+
+TEXT_FILE_FORMATS = ['.txt', '.c', '.cpp', '.py', '.ipynb', '.java', '.js', '.html', '.css', '.json', '.xml', '.yaml', '.yml', '.md']
+IMAGE_FILE_FORMATS = ['.jpg', '.jpeg', '.png', '.webp', '.heic']
+
+def _classify_attachment(filename: str) -> str | None:
+    '''Returns which attachments list (texts, images, pdfs) a file belongs in, or None if unsupported'''
+    filename = filename.lower() # phones upload IMG_0001.JPG / .HEIC
+    if any(filename.endswith(file_format) for file_format in TEXT_FILE_FORMATS):
+        return 'texts'
+    if any(filename.endswith(image_format) for image_format in IMAGE_FILE_FORMATS):
+        return 'images'
+    if filename.endswith('.pdf'):
+        return 'pdfs'
+    return None
+
+async def _ingest_attachment(kind: str, attachment: discord.Attachment) -> str | MyImage | MyPDF:
+    '''
+    Download a single attachment and convert it into its standard attachments format:
+        texts -> str, images -> MyImage, pdfs -> MyPDF
+    '''
+    with stage("attachment_download", kind=kind) as span:
+        content = await attachment_downloader.fetch(attachment.url, expected_size=attachment.size)
+        span.set(bytes=len(content))
+    if kind == 'texts':
+        return content.decode('utf-8', errors='replace')
+    if kind == 'images':
+        # downsized and re-encoded in the image worker pool, uploads are often 12MP phone photos
+        with stage("image_preprocessing") as span:
+            image = await image_preprocessor.process(content, attachment.filename)
+            span.set(mime=image.mime, width=image.width, height=image.height, bytes_in=image.original_bytes,
+                     bytes_out=image.bytes, bytes_saved=image.original_bytes - image.bytes)
+        return image
+    # pdf extraction is CPU bound, keep it off the event loop
+    with stage("pdf_extraction") as span:
+        extraction = await asyncio.to_thread(extract_pdf_cached, content)
+        span.set(pages=extraction.page_count, pages_ocrd=extraction.pages_ocrd, ocr_mode=extraction.ocr_mode)
+    return MyPDF(attachment.url, extraction.embedded_text, extraction.ocr_text, content, extraction)
+
+class AttachmentDownloader:
+    '''
+    Downloads discord attachments through one pooled aiohttp session (keep-alive connections are reused
+    across messages), enforcing a per-file size cap and a per-file timeout.
+
+    The session is created lazily because it must be bound to the running event loop.
+    '''
+    def __init__(self, max_bytes: int, timeout_s: float, max_connections: int = 16):
+        self.max_bytes = max_bytes
+        self.timeout_s = timeout_s
+        self.max_connections = max_connections
+        self._session: aiohttp.ClientSession | None = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def fetch(self, url: str, expected_size: int | None = None) -> bytes:
+        '''
+        Download url and return its raw bytes.
+        Raises MyCustomException on a bad status code, a file over the size cap, or a timeout.
+        '''
+        if expected_size is not None and expected_size > self.max_bytes:
+            raise MyCustomException(f'attachment is {expected_size} bytes, the limit is {self.max_bytes} bytes')
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout_s)
+        try:
+            async with self._get_session().get(url, timeout=timeout) as response:
+                if response.status != 200:
+                    raise MyCustomException(f'request got status code: {response.status}')
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise MyCustomException(f'attachment is {response.content_length} bytes, the limit is {self.max_bytes} bytes')
+
+                # the advertised size can't be trusted, so also enforce the cap while streaming
+                buff = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    buff.extend(chunk)
+                    if len(buff) > self.max_bytes:
+                        raise MyCustomException(f'attachment exceeded the limit of {self.max_bytes} bytes')
+                return bytes(buff)
+        except asyncio.TimeoutError:
+            raise MyCustomException(f'attachment download timed out after {self.timeout_s}s')
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+attachment_downloader = AttachmentDownloader(
+    max_bytes=int(os.getenv("ATTACHMENT_MAX_BYTES", str(25 * 1024 * 1024))),
+    timeout_s=float(os.getenv("ATTACHMENT_TIMEOUT_S", "30")),
+)
+
 def debug_log(s: object)->None:
     '''
     Print object s to log, where s could be a string or any object that can be viewed as a str.
@@ -233,24 +483,199 @@ def find_text_between_markers(text:str, start_marker:str="<START>", end_marker:s
     matches = re.findall(pattern, text, re.DOTALL)
     return matches
 
-def read_pdf_from_memory(pdf_bytes: bytes) -> tuple[str, str]:
-    '''Reads the PDF from bytes and returns both the embedded text and the OCR'd text separately'''
+def _ocr_image(png_bytes: bytes) -> str:
+    '''OCR a single rasterized page. Module level so that it can be pickled into the OCR worker processes'''
+    import pytesseract # OCR engine
+    return pytesseract.image_to_string(Image.open(io.BytesIO(png_bytes)))
+
+class OCR_Engine:
+    '''
+    Fans the OCR of rasterized pdf pages out across a pool of worker processes (tesseract is CPU bound,
+    so threads would not help) and returns the text of each page in page order.
+
+    The pool is started lazily on first use and kept around for subsequent pdfs.
+    '''
+    def __init__(self, workers: int | None = None):
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn instead of fork: forking a process that is running the discord event loop and
+            # helper threads can deadlock the child
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def submit(self, png_bytes: bytes) -> Future:
+        '''Queue the OCR of one page image, returns a future resolving to the page's text'''
+        if self.workers <= 1:
+            # no point paying for inter-process communication with a single worker
+            future = Future()
+            future.set_result(_ocr_image(png_bytes))
+            return future
+        return self._get_pool().submit(_ocr_image, png_bytes)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+ocr_engine = OCR_Engine(workers=int(os.getenv("OCR_WORKERS", "0")) or None)
+
+OCR_MODE = os.getenv("OCR_MODE", "auto")
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_MIN_TEXT_DENSITY = float(os.getenv("OCR_MIN_TEXT_DENSITY", "1.0")) # non-whitespace chars per square inch
+OCR_MAX_IMAGE_COVERAGE = float(os.getenv("OCR_MAX_IMAGE_COVERAGE", "0.5")) # fraction of the page covered by images
+
+OCR_MODES = ("always", "never", "auto")
+
+class PDFExtraction:
+    '''
+    Result of extracting a pdf: the embedded and OCR'd text of every page, plus the OCR decision
+    (and the measurements it was based on) for each page.
+    '''
+    def __init__(self, ocr_mode: str):
+        self.ocr_mode = ocr_mode
+        self.embedded_pages: list[str] = []
+        self.ocr_pages: list[str] = []
+        self.page_stats: list[dict] = [] # one dict per page: page, chars, text_density, image_coverage, ocr
+
+    @property
+    def embedded_text(self) -> str:
+        return "".join(self.embedded_pages)
+
+    @property
+    def ocr_text(self) -> str:
+        return "".join(self.ocr_pages)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_stats)
+
+    @property
+    def pages_ocrd(self) -> int:
+        return sum(1 for stats in self.page_stats if stats["ocr"])
+
+    def to_dict(self) -> dict:
+        return {
+            "ocr_mode": self.ocr_mode,
+            "embedded_pages": self.embedded_pages,
+            "ocr_pages": self.ocr_pages,
+            "page_stats": self.page_stats,
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> PDFExtraction:
+        x = PDFExtraction(d["ocr_mode"])
+        x.embedded_pages = d["embedded_pages"]
+        x.ocr_pages = d["ocr_pages"]
+        x.page_stats = d["page_stats"]
+        return x
+
+    def summary(self) -> str:
+        return f"ocr mode {self.ocr_mode}: OCR'd {self.pages_ocrd}/{self.page_count} pages, skipped {self.page_count - self.pages_ocrd}"
+
+def _page_needs_ocr(page: fitz.Page, embedded_text: str) -> dict:
+    '''
+    Measure how much of the page is covered by an embedded text layer vs images.
+    A page is worth OCRing if it has (almost) no embedded text or is mostly an image, e.g. a scan
+    with a text layer only for a header.
+    '''
+    import fitz # PyMuPDF
+    rect = page.rect
+    page_area = max(rect.width * rect.height, 1.0)
+    chars = len("".join(embedded_text.split()))
+    text_density = chars / (page_area / (72 * 72)) # non-whitespace chars per square inch
+
+    image_area = 0.0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info["bbox"]) & rect
+        if not bbox.is_empty:
+            image_area += bbox.width * bbox.height
+    image_coverage = min(image_area / page_area, 1.0)
+
+    return {
+        "chars": chars,
+        "text_density": round(text_density, 3),
+        "image_coverage": round(image_coverage, 3),
+        "ocr": text_density < OCR_MIN_TEXT_DENSITY or image_coverage > OCR_MAX_IMAGE_COVERAGE,
+    }
+
+def extract_pdf(pdf_bytes: bytes, ocr_mode: str | None = None, engine: OCR_Engine | None = None) -> PDFExtraction:
+    '''
+    Reads the PDF from bytes, extracting the embedded text of every page and OCRing pages according to ocr_mode:
+        always: OCR every page
+        never: never OCR
+        auto: only OCR pages without a usable embedded text layer (see _page_needs_ocr)
+    Only pages that get OCR'd are rasterized, and they are rasterized at OCR_DPI.
+    Pages are handed to the OCR engine as they are produced, so OCR of earlier
+    pages overlaps with rasterizing the later ones.
+    '''
+    ocr_mode = ocr_mode if ocr_mode is not None else OCR_MODE
+    if ocr_mode not in OCR_MODES:
+        raise MyCustomException(f"unknown ocr mode '{ocr_mode}', expected one of {OCR_MODES}")
+    engine = engine if engine is not None else ocr_engine
+    import fitz # PyMuPDF
     pdf_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
 
-    all_embedded_text = ""
-    all_ocr_text = ""
-    for page in pdf_doc:
+    extraction = PDFExtraction(ocr_mode)
+    ocr_futures = []
+    for i, page in enumerate(pdf_doc):
         # Embedded text
         embedded_text = page.get_text()
-        all_embedded_text += embedded_text
+        extraction.embedded_pages.append(embedded_text)
 
-        # OCR
-        pix = page.get_pixmap()
-        img = Image.open(io.BytesIO(pix.tobytes()))
-        ocr_text = pytesseract.image_to_string(img)
-        all_ocr_text += ocr_text
+        stats = _page_needs_ocr(page, embedded_text)
+        if ocr_mode != "auto":
+            stats["ocr"] = ocr_mode == "always"
+        stats["page"] = i + 1
+        extraction.page_stats.append(stats)
 
-    return all_embedded_text, all_ocr_text
+        # OCR
+        if stats["ocr"]:
+            pix = page.get_pixmap(dpi=OCR_DPI)
+            ocr_futures.append(engine.submit(pix.tobytes()))
+        else:
+            ocr_futures.append(None)
+
+    extraction.ocr_pages = [future.result() if future is not None else "" for future in ocr_futures]
+    PDF_PAGES.inc(extraction.pages_ocrd, ocr="true")
+    PDF_PAGES.inc(extraction.page_count - extraction.pages_ocrd, ocr="false")
+    return extraction
+
+_attachment_cache: AttachmentCache | None = None
+
+def get_attachment_cache() -> AttachmentCache:
+    '''The shared cache of extracted attachment text, created on first use under APP_DATA_DIR'''
+    global _attachment_cache
+    if _attachment_cache is None:
+        cache_dir = os.path.join(os.getenv("APP_DATA_DIR", "./data"), "attachment_cache")
+        max_bytes = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        _attachment_cache = AttachmentCache(cache_dir, max_bytes)
+    return _attachment_cache
+
+def extract_pdf_cached(pdf_bytes: bytes, ocr_mode: str | None = None) -> PDFExtraction:
+    '''extract_pdf, but re-posted pdfs are served from the attachment cache instead of being re-extracted and re-OCR'd'''
+    ocr_mode = ocr_mode if ocr_mode is not None else OCR_MODE
+    cache = get_attachment_cache()
+    # every setting that changes the extraction is part of the key, auto mode decides what to OCR with the thresholds
+    key = AttachmentCache.make_key(pdf_bytes, "pdf", ocr_mode, OCR_DPI, OCR_MIN_TEXT_DENSITY, OCR_MAX_IMAGE_COVERAGE)
+    entry = cache.get(key)
+    if entry is not None:
+        return PDFExtraction.from_dict(entry)
+    extraction = extract_pdf(pdf_bytes, ocr_mode)
+    cache.put(key, extraction.to_dict())
+    return extraction
+
+def warm_up_pdf_reader() -> None:
+    '''Import the pdf / OCR libraries ahead of the first pdf, they are otherwise imported on first use'''
+    import fitz # PyMuPDF
+    import pytesseract # OCR engine
+
+def read_pdf_from_memory(pdf_bytes: bytes, engine: OCR_Engine | None = None, ocr_mode: str | None = None) -> tuple[str, str]:
+    '''Reads the PDF from bytes and returns both the embedded text and the OCR'd text separately'''
+    extraction = extract_pdf(pdf_bytes, ocr_mode, engine)
+    return extraction.embedded_text, extraction.ocr_text
 
 async def runTryExcept(foo : Callable, **kwargs) -> Any:
     # given a function and the input params, 
@@ -264,3 +689,32 @@ async def runTryExcept(foo : Callable, **kwargs) -> Any:
             return foo(**kwargs)
     except Exception as e:
         return f'Encountered Error: {str(e)}'
+
+class StartupTimer:
+    '''
+    Records how long each phase of starting the bot takes (imports, building the controllers, connecting to discord,
+    warming up the lazily loaded subsystems...) so we can see where the cold start time goes.
+    '''
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.phases: list[tuple[str, float]] = [] # (name, seconds) in the order they finished
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name: str):
+        '''Time the block as the phase name'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self) -> str:
+        width = max((len(name) for name, _ in self.phases), default=0)
+        lines = [f"{name.ljust(width)}  {seconds:7.3f}s" for name, seconds in self.phases]
+        lines.append(f"{'since start'.ljust(width)}  {time.perf_counter() - self.t0:7.3f}s")
+        return "\n".join(lines)
+
+startup_timer = StartupTimer()
@@ -1,47 +1,462 @@
-import chromadb
-from chromadb.utils import embedding_functions
-import uuid
+from __future__ import annotations
+import os
+import re
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from EmbeddingCache import EmbeddingCache
+from BM25Index import BM25Index
+from VectorStores import VectorStore, ChromaStore, NumpyStore, VECTOR_STORE_BACKENDS
+from Metrics import metrics, stage
+
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+    from sentence_transformers import SentenceTransformer
+
+QUERY_BATCH_SIZE = metrics.histogram("bot_vectordb_query_batch_size", "Queries answered per VectorDB batch",
+                                     buckets=(1, 2, 4, 8, 16, 32, 64))
+
+class SentenceTransformerEmbedder:
+    '''
+    The embedding model (and its tokenizer) shared by the store and the ingestion pipeline, loaded on first use.
+    '''
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._model: SentenceTransformer | None = None
+        self._func: SentenceTransformerEmbeddingFunction | None = None
+        self._lock = threading.RLock()
+
+    @property
+    def model(self) -> SentenceTransformer:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    @property
+    def func(self) -> SentenceTransformerEmbeddingFunction:
+        '''chromadb embedding function for the chroma collection, only imports chromadb when asked for'''
+        if self._func is None:
+            with self._lock:
+                if self._func is None:
+                    from chromadb.utils import embedding_functions
+                    # chromadb caches its models by name, hand it ours so the model is only loaded once
+                    embedding_functions.SentenceTransformerEmbeddingFunction.models.setdefault(self.model_name, self.model)
+                    self._func = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=self.model_name)
+        return self._func
+
+    def embed(self, texts: list[str]) -> list:
+        '''one embedding per text, computed in a single call to the model'''
+        return list(self.model.encode(texts, convert_to_numpy=True))
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        '''(start, end) character offsets of every model token in text'''
+        encoding = self.model.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+        return [(start, end) for start, end in encoding["offset_mapping"] if end > start]
+
+_shared_embedders: dict[str, SentenceTransformerEmbedder] = {}
+_shared_embedders_lock = threading.Lock()
+
+def shared_embedder(model_name: str) -> SentenceTransformerEmbedder:
+    '''The one embedder of model_name for the whole app (vector dbs, response caches), so the model is loaded once'''
+    with _shared_embedders_lock:
+        if model_name not in _shared_embedders:
+            _shared_embedders[model_name] = SentenceTransformerEmbedder(model_name)
+        return _shared_embedders[model_name]
+
+def word_spans(text: str) -> list[tuple[int, int]]:
+    '''(start, end) character offsets of every whitespace separated word, a rough stand in for model tokens'''
+    return [m.span() for m in re.finditer(r"\S+", text)]
+
+QUERY_MODES = ("vector", "lexical", "hybrid")
+
+def reciprocal_rank_fusion(rankings:list[list[str]], k:int=60) -> list[str]:
+    '''
+    Fuse several rankings of ids (best first) into one: every id scores the sum of 1 / (k + rank) over the
+    rankings it appears in. Only ranks matter, so scores on different scales (cosine distance, BM25) fuse fine.
+    '''
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
+
+def mmr(query_embedding, candidate_embeddings:list, k:int, mmr_lambda:float=0.5) -> list[int]:
+    '''
+    Maximal marginal relevance: greedily pick k of the candidates (indices, in pick order), each time the one
+    maximizing mmr_lambda * similarity to the query - (1 - mmr_lambda) * max similarity to the already picked ones.
+    mmr_lambda = 1 is plain relevance order, lower values favor diversity.
+    '''
+    if len(candidate_embeddings) == 0:
+        return []
+    candidates = np.asarray(candidate_embeddings, dtype=np.float32)
+    candidates /= np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    picked = [int(np.argmax(relevance))]
+    redundancy = similarity[picked[0]].copy() # max similarity of every candidate to the picked ones
+    while len(picked) < min(k, len(candidates)):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return picked
+
+MIN_OVERLAP_CHARS = 16
+
+def dedupe_chunks(chunks:list[str]) -> list[str]:
+    '''
+    Drop chunks contained in an earlier one and trim the text a chunk shares with the end of an earlier one
+    (neighbouring chunks of a document overlap, see chunk_text), so the same text isn't pasted twice.
+    '''
+    kept: list[str] = []
+    for chunk in chunks:
+        if any(chunk in other for other in kept):
+            continue
+        for other in kept:
+            # longest prefix of chunk that is a suffix of other, shorter matches are likely coincidences
+            for size in range(min(len(chunk), len(other)) - 1, MIN_OVERLAP_CHARS - 1, -1):
+                if other.endswith(chunk[:size]):
+                    chunk = chunk[size:]
+                    break
+        chunk = chunk.strip()
+        if len(chunk) > 0:
+            kept.append(chunk)
+    return kept
+
+def pack_chunks(chunks:list[str], budget_tokens:int, count_tokens:Callable[[str], int]) -> list[str]:
+    '''the chunks (best first) that fit in budget_tokens, skipping any that would overflow it'''
+    packed, used = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if used + tokens <= budget_tokens:
+            packed.append(chunk)
+            used += tokens
+    return packed
+
+def chunk_text(text: str, max_tokens: int, overlap: int, token_spans: Callable[[str], list[tuple[int, int]]]) -> list[str]:
+    '''
+    Split text into chunks of at most max_tokens tokens, consecutive chunks sharing overlap tokens
+    so that a passage cut at a chunk boundary is still whole in one of the two chunks.
+    '''
+    if overlap >= max_tokens:
+        raise ValueError(f"chunk overlap ({overlap}) must be smaller than the chunk size ({max_tokens})")
+    spans = token_spans(text)
+    chunks = []
+    start = 0
+    while start < len(spans):
+        end = min(start + max_tokens, len(spans))
+        chunks.append(text[spans[start][0]:spans[end - 1][1]])
+        if end == len(spans):
+            break
+        start = end - overlap
+    return chunks
 
 class VectorDB:
-    def __init__(self, data_path:str, embed_model:str, collection_name:str):
+    '''
+    The chunks live in a VectorStore picked by backend: "chroma" (chromadb's persistent collection) or "numpy"
+    (exact search over a memory-mapped matrix, see NumpyStore). The store and the embedding model take seconds
+    to import and load, so they are only loaded on first use, or ahead of time by warm_up.
+
+    Documents are ingested with upload_many: split into overlapping chunks of at most chunk_tokens model tokens
+    (the embedding model truncates anything longer), embedded embed_batch_size chunks at a time and
+    added to the store one batch at a time. Every chunk is also added to a BM25 index persisted next to
+    the store, for lexical and hybrid queries. Chunks are identified by the hash of their text, so uploading
+    the same text again neither re-embeds it nor stores a duplicate vector.
+    '''
+    def __init__(self, data_path:str, embed_model:str, collection_name:str,
+                 chunk_tokens:int=200, chunk_overlap:int=32, embed_batch_size:int=64,
+                 embedder:SentenceTransformerEmbedder|None=None, embedding_cache:EmbeddingCache|None=None,
+                 fusion_candidates:int=20, backend:str="chroma", numpy_dtype:str="float32"):
         self.data_path = data_path
         self.embed_model = embed_model
         self.collection_name = collection_name
-        self.collection = self._getOrCreateChromaDB()
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.embed_batch_size = embed_batch_size
+        self.embedder = embedder if embedder is not None else shared_embedder(embed_model)
+        self.embedding_cache = embedding_cache # chunk embeddings that survive re-uploads and restarts, optional
+        if backend not in VECTOR_STORE_BACKENDS:
+            raise ValueError(f"unknown vector db backend '{backend}', expected one of {VECTOR_STORE_BACKENDS}")
+        self.backend = backend
+        self.numpy_dtype = numpy_dtype
+        self._store: VectorStore | None = None
+        self._store_lock = threading.RLock() # warm_up runs in a worker thread while requests may come in
+        self._lexical_index: BM25Index | None = None # kept next to the store, updated on every upload
+        self.fusion_candidates = fusion_candidates
+
+    @property
+    def store(self) -> VectorStore:
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = self._open_store()
+        return self._store
+
+    @property
+    def lexical_index(self) -> BM25Index:
+        if self._lexical_index is None:
+            with self._store_lock:
+                if self._lexical_index is None:
+                    index = BM25Index(self._lexical_index_path())
+                    self._backfill_lexical_index(index)
+                    self._lexical_index = index
+        return self._lexical_index
+
+    def _lexical_index_path(self) -> str:
+        if self.backend == "numpy":
+            return os.path.join(self._numpy_store_dir(), "bm25.jsonl")
+        return os.path.join(self.data_path, f"{self.collection_name}.bm25.jsonl")
+
+    def _numpy_store_dir(self) -> str:
+        return os.path.join(self.data_path, f"{self.collection_name}.numpy")
+
+    def _backfill_lexical_index(self, index:BM25Index, page_size:int=1000) -> None:
+        '''index the chunks that were stored before the index existed (or while it was missing)'''
+        total = self.store.count()
+        if len(index) >= total:
+            return
+        for offset in range(0, total, page_size):
+            index.add_many(self.store.scan(offset, page_size))
 
-    def _getOrCreateChromaDB(self) -> chromadb.Collection:
+    def warm_up(self) -> None:
+        '''Load the store, the embedding model and the lexical index now instead of on the first request'''
+        self.store.count()
+        self.embedder.model
+        if isinstance(self.store, ChromaStore):
+            self.embedder.func # chromadb is only imported for the chroma backend
+        self.lexical_index
+
+    def _open_store(self) -> VectorStore:
         '''
-        Create a new ChromaDB collection with the given data path, collection name, and embedding model
+        Open (or create) the collection with the given data path, collection name, and embedding model in the backend
         '''
-        client = chromadb.PersistentClient(path=self.data_path)
-        embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=self.embed_model)
-        collection = client.get_or_create_collection(name=self.collection_name, embedding_function=embedding_func, metadata={"hnsw:space": "cosine"})
-        return collection
+        if self.backend == "numpy":
+            return NumpyStore(self._numpy_store_dir(), dtype=self.numpy_dtype)
+        return ChromaStore(self.data_path, self.collection_name, embedding_function=self.embedder.func)
+
+    @staticmethod
+    def chunk_id(chunk:str) -> str:
+        '''documents are identified by the hash of their content, so the same text is only ever stored once'''
+        return hashlib.sha256(chunk.encode()).hexdigest()
 
     def upload(self, document:str, metadata:dict|None=None) -> None:
         '''
         Insert into the db the document (just a str) and any metadata (optional json/dict of values)
         '''
-        self.collection.add(
+        key = self.chunk_id(document)
+        self.store.upsert(
             documents=[document],
-            ids=[str(uuid.uuid4())],
+            ids=[key],
+            embeddings=self._embed([document]),
             metadatas=[metadata] if metadata is not None else None
         )
+        self.lexical_index.add_many([(key, document)])
+
+    def _embed(self, texts:list[str]) -> list:
+        with stage("embedding"):
+            if self.embedding_cache is None:
+                return self.embedder.embed(texts)
+            return self.embedding_cache.embed(self.embed_model, texts, self.embedder.embed)
+
+    def upload_many(self, documents:list[str], metadatas:list[dict]|None=None) -> tuple[int, int]:
+        '''
+        Chunk, embed and insert the documents. Every chunk gets a copy of its document's metadata
+        (e.g. source and page) plus its index within the document under "chunk".
+        Chunks already in the collection (or repeated within the upload) are skipped.
+        Returns (chunks inserted, duplicate chunks skipped).
+        '''
+        metadatas = metadatas if metadatas is not None else [{} for _ in documents]
+        chunks: dict[str, tuple[str, dict]] = {} # id -> (chunk, metadata), first occurrence wins
+        total = 0
+        for document, metadata in zip(documents, metadatas):
+            for i, chunk in enumerate(chunk_text(document, self.chunk_tokens, self.chunk_overlap, self.embedder.token_spans)):
+                total += 1
+                chunks.setdefault(self.chunk_id(chunk), (chunk, {**metadata, "chunk": i}))
+
+        ids = list(chunks.keys())
+        inserted = 0
+        for start in range(0, len(ids), self.embed_batch_size):
+            batch_ids = ids[start:start + self.embed_batch_size]
+            existing = self.store.existing(batch_ids)
+            batch_ids = [key for key in batch_ids if key not in existing]
+            if len(batch_ids) == 0:
+                continue
+            batch = [chunks[key][0] for key in batch_ids]
+            # upsert, so a concurrent upload of the same chunk can't fail the batch
+            self.store.upsert(
+                ids=batch_ids,
+                documents=batch,
+                embeddings=self._embed(batch),
+                metadatas=[chunks[key][1] for key in batch_ids]
+            )
+            self.lexical_index.add_many(list(zip(batch_ids, batch)))
+            inserted += len(batch_ids)
+        return inserted, total - inserted
 
-    def query(self, prompt:str, k:int=1) -> list[str]:
+    def query(self, prompt:str, k:int=1, mode:str="vector") -> list[str]:
         '''
         Query db and return the top k (default 1) responses
         responses are ordered by increasing distance 
         NOTE: optionally can use metadata and a constraint that says response must contain a particular string
+        mode is one of QUERY_MODES, see query_many
         '''
-        response = self.collection.query(
-            query_texts=[prompt],
-            n_results=k 
-        )
-        return response['documents'][0]
+        return self.query_many([prompt], k, mode)[0]
+
+    def query_many(self, prompts:list[str], k:int=1, mode:str="vector",
+                   candidates:int|None=None, mmr_lambda:float=0.5) -> list[list[str]]:
+        '''
+        query for several prompts at once: one embedding call for all the prompts and one search of the collection.
+        Returns the top k responses of every prompt, in the order of prompts
+            vector: nearest chunks by embedding
+            lexical: best BM25 matches in the inverted index
+            hybrid: both rankings of fusion_candidates chunks each, fused with reciprocal rank fusion
+        With candidates, the k responses are picked out of the top candidates by maximal marginal relevance
+        (see mmr), so they don't all say the same thing.
+        '''
+        if mode not in QUERY_MODES:
+            raise ValueError(f"unknown query mode '{mode}', expected one of {QUERY_MODES}")
+        diversify = candidates is not None and candidates > k
+        n = candidates if diversify else k
+        query_embeddings = None
+        if mode != "lexical" or diversify:
+            with stage("embedding"):
+                query_embeddings = self.embedder.embed(prompts)
+
+        with stage("vector_search"):
+            if mode == "lexical":
+                rankings = [[key for key, _ in self.lexical_index.query(prompt, n)] for prompt in prompts]
+            else:
+                n_results = n if mode == "vector" else max(n, self.fusion_candidates)
+                vector_rankings = self.store.search(query_embeddings, n_results)
+                if mode == "vector":
+                    rankings = vector_rankings
+                else:
+                    rankings = [reciprocal_rank_fusion([ranking, [key for key, _ in self.lexical_index.query(prompt, n_results)]])[:n]
+                                for prompt, ranking in zip(prompts, vector_rankings)]
+
+        # one fetch of the documents (and embeddings, for mmr) of every prompt's ranking
+        ids = list(dict.fromkeys(key for ranking in rankings for key in ranking))
+        if len(ids) == 0:
+            return [[] for _ in prompts]
+        documents, embeddings = self.store.get(ids, include_embeddings=diversify)
+        if not diversify:
+            return [[documents[key] for key in ranking if key in documents] for ranking in rankings]
+
+        results = []
+        for query_embedding, ranking in zip(query_embeddings, rankings):
+            ranking = [key for key in ranking if key in documents]
+            picked = mmr(query_embedding, [embeddings[key] for key in ranking], k, mmr_lambda)
+            results.append([documents[ranking[i]] for i in picked])
+        return results
 
     def size(self) -> int:
-        return self.collection.count()
+        return self.store.count()
+
+class AsyncVectorDB:
+    '''
+    Async front for a VectorDB, so embedding and searching never block the event loop.
+
+    All the work runs on one dedicated worker thread. Queries that come in within batch_window_s of each other
+    (up to max_batch of them) are coalesced into a single query_many, i.e. one embedding call and one collection
+    search, and every caller gets its own slice of the result.
+    '''
+    def __init__(self, db: VectorDB, batch_window_s: float = 0.01, max_batch: int = 32):
+        self.db = db
+        self.batch_window_s = batch_window_s
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vectordb")
+        # (prompt, k, (mode, candidates, mmr_lambda), future) waiting for the next batch
+        self._pending: list[tuple[str, int, tuple, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.queries = 0
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def query(self, prompt: str, k: int = 1, mode: str = "vector",
+                    candidates: int | None = None, mmr_lambda: float = 0.5) -> list[str]:
+        '''top k responses for prompt, best first (see VectorDB.query_many for the modes and candidates)'''
+        if mode not in QUERY_MODES:
+            raise ValueError(f"unknown query mode '{mode}', expected one of {QUERY_MODES}")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, k, (mode, candidates, mmr_lambda), future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window_s, self._flush)
+        with stage("vector_query", k=k, mode=mode, candidates=candidates):
+            return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _query_batch(self, batch: list[tuple[str, int, tuple, asyncio.Future]]) -> list[list[str]]:
+        '''one query_many per distinct set of query options in the batch, results in the order of batch'''
+        results: list[list[str]] = [[] for _ in batch]
+        for options in dict.fromkeys(options for _, _, options, _ in batch):
+            positions = [i for i, (_, _, o, _) in enumerate(batch) if o == options]
+            documents = self.db.query_many([batch[i][0] for i in positions], max(batch[i][1] for i in positions), *options)
+            for i, docs in zip(positions, documents):
+                results[i] = docs
+        return results
+
+    async def _run_batch(self, batch: list[tuple[str, int, tuple, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.queries += len(batch)
+        QUERY_BATCH_SIZE.observe(len(batch))
+        try:
+            results = await self._run(self._query_batch, batch)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, k, _, future), documents in zip(batch, results):
+            if not future.done(): # the caller may have gone away
+                future.set_result(documents[:k])
+
+    async def upload_many(self, documents: list[str], metadatas: list[dict] | None = None) -> tuple[int, int]:
+        '''see VectorDB.upload_many'''
+        with stage("vector_upload", documents=len(documents)) as span:
+            inserted, skipped = await self._run(self.db.upload_many, documents, metadatas)
+            span.set(chunks=inserted, duplicates=skipped)
+            return inserted, skipped
+
+    async def size(self) -> int:
+        return await self._run(self.db.size)
+
+    def warm_up(self) -> None:
+        self.db.warm_up()
+
+    def stats(self) -> str:
+        stats = f"vector db: {self.queries} queries in {self.batches} batches"
+        if self.db.embedding_cache is not None:
+            stats += f" | {self.db.embedding_cache.stats()}"
+        return stats
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
 
 if __name__ == '__main__':
     CHROMA_DATA_PATH = "chroma_data/"
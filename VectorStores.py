@@ -0,0 +1,251 @@
+from __future__ import annotations
+import os
+import json
+import threading
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import chromadb
+
+#################### Abstract Class defining the common interface ####################
+
+class VectorStore(ABC):
+    '''
+    Where VectorDB keeps its chunks: id, text, metadata and (normalized) embedding of each, plus nearest neighbour
+    search over the embeddings. Embedding the text is VectorDB's job, stores only ever see vectors.
+    '''
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    @abstractmethod
+    def existing(self, ids: list[str]) -> set[str]:
+        '''the ids that are already stored'''
+        pass
+
+    @abstractmethod
+    def upsert(self, ids: list[str], documents: list[str], embeddings: list, metadatas: list[dict] | None) -> None:
+        pass
+
+    @abstractmethod
+    def search(self, query_embeddings: list, n: int) -> list[list[str]]:
+        '''ids of the n nearest chunks (by cosine similarity) of every query embedding, nearest first'''
+        pass
+
+    @abstractmethod
+    def get(self, ids: list[str], include_embeddings: bool = False) -> tuple[dict[str, str], dict[str, Any]]:
+        '''(id -> document, id -> embedding) of the stored ids, embeddings only if include_embeddings'''
+        pass
+
+    @abstractmethod
+    def scan(self, offset: int, limit: int) -> list[tuple[str, str]]:
+        '''(id, document) of up to limit stored chunks starting at offset, to walk the whole store'''
+        pass
+
+#################### Specific implementations ####################
+
+class ChromaStore(VectorStore):
+    '''chromadb persistent collection (sqlite + HNSW index), with cosine distance'''
+    def __init__(self, data_path: str, collection_name: str, embedding_function: Any = None):
+        import chromadb
+        client = chromadb.PersistentClient(path=data_path)
+        # the embedding function is kept on the collection for compatibility with collections created before
+        # VectorDB embedded the chunks itself, it is not called since every call passes embeddings
+        self.collection: chromadb.Collection = client.get_or_create_collection(
+            name=collection_name, embedding_function=embedding_function, metadata={"hnsw:space": "cosine"})
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def existing(self, ids: list[str]) -> set[str]:
+        return set(self.collection.get(ids=ids, include=[])["ids"])
+
+    def upsert(self, ids: list[str], documents: list[str], embeddings: list, metadatas: list[dict] | None) -> None:
+        self.collection.upsert(ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+
+    def search(self, query_embeddings: list, n: int) -> list[list[str]]:
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n, include=[])["ids"]
+
+    def get(self, ids: list[str], include_embeddings: bool = False) -> tuple[dict[str, str], dict[str, Any]]:
+        response = self.collection.get(ids=ids, include=["documents", "embeddings"] if include_embeddings else ["documents"])
+        documents = dict(zip(response["ids"], response["documents"]))
+        embeddings = dict(zip(response["ids"], response["embeddings"])) if include_embeddings else {}
+        return documents, embeddings
+
+    def scan(self, offset: int, limit: int) -> list[tuple[str, str]]:
+        response = self.collection.get(include=["documents"], limit=limit, offset=offset)
+        return list(zip(response["ids"], response["documents"]))
+
+class NumpyStore(VectorStore):
+    '''
+    Exact search over a memory-mapped matrix of normalized embeddings, for collections small enough that a brute
+    force matrix product beats maintaining an HNSW index (tens to hundreds of thousands of chunks).
+
+    Files, under store_dir:
+        vectors.bin: the embeddings, one row per chunk, float32 or float16, grown in place by doubling
+        rows.jsonl: one line per row with the chunk's id and where its document is in documents.jsonl
+        documents.jsonl: the text and metadata of the chunks, only read for the results of a query
+        index.json: dimension, dtype and capacity of vectors.bin
+    Opening only maps the matrix and reads the (small) rows file, so it is near instant.
+    Rows are committed in order vectors, documents, rows, so a crash mid-write leaves at most unreferenced data.
+    '''
+    SEARCH_BLOCK_ROWS = 16384 # rows scored per matrix product, bounds the float32 copy of a float16 matrix
+
+    def __init__(self, store_dir: str, dtype: str = "float32", initial_capacity: int = 1024):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"unsupported dtype '{dtype}', expected float32 or float16")
+        self.store_dir = store_dir
+        self.dtype = np.dtype(dtype)
+        self.initial_capacity = initial_capacity
+        self.dim: int | None = None
+        self.capacity = 0
+        self._vectors: np.memmap | None = None
+        self._ids: list[str] = [] # row -> id
+        self._rows: dict[str, int] = {} # id -> row
+        self._offsets: list[tuple[int, int]] = [] # row -> (offset, length) of its line in documents.jsonl
+        self._lock = threading.RLock()
+        os.makedirs(store_dir, exist_ok=True)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.store_dir, name)
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path("index.json")):
+            return
+        with open(self._path("index.json"), "r") as f:
+            index = json.load(f)
+        if np.dtype(index["dtype"]) != self.dtype:
+            raise ValueError(f"{self.store_dir} holds {index['dtype']} vectors, not {self.dtype}")
+        self.dim, self.capacity = index["dim"], index["capacity"]
+        self._vectors = np.memmap(self._path("vectors.bin"), dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+        if os.path.exists(self._path("rows.jsonl")):
+            with open(self._path("rows.jsonl"), "r") as f:
+                for line in f:
+                    try:
+                        key, row, offset, length = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # torn last line of a crash mid-write
+                    if row == len(self._ids):
+                        self._ids.append(key)
+                        self._offsets.append((offset, length))
+                    else:
+                        self._offsets[row] = (offset, length) # the chunk was upserted again
+                    self._rows[key] = row
+
+    def _write_index(self) -> None:
+        tmp_path = self._path("index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype.name, "capacity": self.capacity}, f)
+        os.replace(tmp_path, self._path("index.json"))
+
+    def _reserve(self, rows: int) -> None:
+        '''make room for rows rows in vectors.bin'''
+        if rows <= self.capacity:
+            return
+        capacity = max(self.capacity, self.initial_capacity)
+        while capacity < rows:
+            capacity *= 2
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self._path("vectors.bin"), "ab") as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self._vectors = np.memmap(self._path("vectors.bin"), dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+        self.capacity = capacity
+        self._write_index()
+
+    @staticmethod
+    def _normalize(embeddings: list) -> np.ndarray:
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    def count(self) -> int:
+        return len(self._ids)
+
+    def existing(self, ids: list[str]) -> set[str]:
+        return {key for key in ids if key in self._rows}
+
+    def upsert(self, ids: list[str], documents: list[str], embeddings: list, metadatas: list[dict] | None) -> None:
+        if len(ids) == 0:
+            return
+        metadatas = metadatas if metadatas is not None else [None for _ in ids]
+        vectors = self._normalize(embeddings)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"embeddings have dimension {vectors.shape[1]}, the store holds {self.dim}")
+            rows = []
+            next_row = len(self._ids)
+            for key in ids:
+                row = self._rows.get(key)
+                if row is None:
+                    row, next_row = next_row, next_row + 1
+                rows.append(row)
+            self._reserve(next_row)
+            self._vectors[rows] = vectors.astype(self.dtype)
+            self._vectors.flush()
+
+            with open(self._path("documents.jsonl"), "ab") as f:
+                offset = f.tell()
+                lines = []
+                for document, metadata in zip(documents, metadatas):
+                    line = (json.dumps({"document": document, "metadata": metadata}) + "\n").encode()
+                    lines.append((offset, len(line)))
+                    offset += len(line)
+                    f.write(line)
+            with open(self._path("rows.jsonl"), "a") as f:
+                for key, row, (offset, length) in zip(ids, rows, lines):
+                    f.write(json.dumps([key, row, offset, length]) + "\n")
+                    if row == len(self._ids):
+                        self._ids.append(key)
+                        self._offsets.append((offset, length))
+                    else:
+                        self._offsets[row] = (offset, length)
+                    self._rows[key] = row
+
+    def search(self, query_embeddings: list, n: int) -> list[list[str]]:
+        count = len(self._ids)
+        queries = self._normalize(query_embeddings)
+        if count == 0 or n <= 0:
+            return [[] for _ in queries]
+        n = min(n, count)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, count, self.SEARCH_BLOCK_ROWS):
+            block = np.asarray(self._vectors[start:min(start + self.SEARCH_BLOCK_ROWS, count)], dtype=np.float32)
+            scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+            if scores.shape[1] > n:
+                top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+                scores, rows = np.take_along_axis(scores, top, axis=1), np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [[self._ids[row] for row in rows] for rows in best_rows.tolist()]
+
+    def _read_documents(self, rows: list[int]) -> list[str]:
+        documents = []
+        with open(self._path("documents.jsonl"), "rb") as f:
+            for row in rows:
+                offset, length = self._offsets[row]
+                f.seek(offset)
+                documents.append(json.loads(f.read(length))["document"])
+        return documents
+
+    def get(self, ids: list[str], include_embeddings: bool = False) -> tuple[dict[str, str], dict[str, Any]]:
+        keys = [key for key in dict.fromkeys(ids) if key in self._rows]
+        rows = [self._rows[key] for key in keys]
+        documents = dict(zip(keys, self._read_documents(rows)))
+        embeddings = {key: np.asarray(self._vectors[row], dtype=np.float32) for key, row in zip(keys, rows)} if include_embeddings else {}
+        return documents, embeddings
+
+    def scan(self, offset: int, limit: int) -> list[tuple[str, str]]:
+        rows = list(range(offset, min(offset + limit, len(self._ids))))
+        return list(zip([self._ids[row] for row in rows], self._read_documents(rows)))
+
+VECTOR_STORE_BACKENDS = ("chroma", "numpy")
@@ -0,0 +1,239 @@
+'''
+Offline CPU microbenchmarks of the bot's hot paths, no api keys, network or discord needed:
+    pdf reading (read_pdf_from_memory) on generated pdfs of increasing page counts
+    splitting long replies into discord messages (split_message, and Message.send_msg_to_usr through an unthrottled
+    outbound queue against a fake channel)
+    find_text_between_markers on big LLM outputs
+    thread rendering (_get_curr_gpt_thread) and token accounting on long threads
+    VectorDB upload / query at 1k, 10k and 100k chunks, with a stub embedder instead of the model
+
+Results are printed and, with --json, written as json (with the git commit) so runs can be compared between commits.
+
+usage: python benchHotPaths.py [--quick] [--only pdf send markers thread vectordb] [--sizes 1000 10000 100000]
+                               [--backends chroma numpy] [--json results.json]
+'''
+import os
+import sys
+import json
+import hashlib
+import time
+import asyncio
+import argparse
+import tempfile
+import platform
+import statistics
+import subprocess
+from types import SimpleNamespace
+from typing import Any, Callable
+
+import numpy as np
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark") # OpenAI_LLM requires one, nothing is ever sent
+os.environ.setdefault("APP_DATA_DIR", tempfile.mkdtemp(prefix="bench_data_"))
+
+import Utils
+from Utils import Message, OCR_Engine, find_text_between_markers, read_pdf_from_memory
+from OutboundQueue import OutboundQueue, split_message
+from VectorDB import VectorDB, SentenceTransformerEmbedder, word_spans
+
+def measure(func: Callable[[], Any], repeat: int) -> dict:
+    '''wall time of repeat calls to func, in milliseconds'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": repeat,
+        "mean_ms": round(statistics.mean(times), 4),
+        "p50_ms": round(statistics.median(times), 4),
+        "min_ms": round(min(times), 4),
+        "max_ms": round(max(times), 4),
+    }
+
+class Results:
+    def __init__(self):
+        self.rows: list[dict] = []
+
+    def add(self, name: str, params: dict, timing: dict) -> None:
+        row = {"name": name, "params": params, **timing}
+        self.rows.append(row)
+        print(f"{name:<28} {json.dumps(params):<48} mean {timing['mean_ms']:>10.3f}ms  p50 {timing['p50_ms']:>10.3f}ms  ({timing['runs']} runs)")
+
+#################### pdf ####################
+
+def make_pdf(pages: int) -> bytes:
+    import fitz
+    doc = fitz.open()
+    paragraph = "The quick brown fox jumps over the lazy dog. " * 12
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), f"Page {i + 1}\n" + paragraph * 4, fontsize=10)
+    return doc.tobytes()
+
+def bench_pdf(results: Results, quick: bool) -> None:
+    engine = OCR_Engine(workers=1) # text pages never reach the OCR engine in auto mode
+    for pages in ([1, 10] if quick else [1, 10, 50, 200]):
+        pdf = make_pdf(pages)
+        for mode in ("never", "auto"):
+            timing = measure(lambda: read_pdf_from_memory(pdf, engine=engine, ocr_mode=mode), 3 if quick else 5)
+            results.add("read_pdf_from_memory", {"pages": pages, "ocr_mode": mode}, timing)
+
+#################### sending ####################
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+def bench_send(results: Results, quick: bool) -> None:
+    # no pacing and no file fallback, so this measures the splitting and queueing
+    Utils.outbound_queue = OutboundQueue(rate=1e9, burst=1e9, limit=Utils.DISCORD_MSGLEN_CAP)
+    Utils.DISCORD_MAX_REPLY_MESSAGES = 10**9
+    channel = FakeChannel()
+    msg = Message(msgType="discord")
+    msg.discordMsg = SimpleNamespace(channel=channel)
+    line = "Here is a line of a long reply, with some `code` and words in it.\n"
+    code = "```python\n" + "    result = compute(value) + other_value\n" * 40 + "```\n\n"
+    for size in ([10_000, 100_000] if quick else [10_000, 100_000, 1_000_000]):
+        text = (line * (size // len(line) + 1))[:size]
+        mixed = ((line * 10 + "\n" + code) * (size // (len(line) * 10 + len(code)) + 1))[:size]
+        results.add("split_message", {"chars": size, "text": "lines"}, measure(lambda: split_message(text, 2000), 5 if quick else 20))
+        results.add("split_message", {"chars": size, "text": "code"}, measure(lambda: split_message(mixed, 2000), 5 if quick else 20))
+        timing = measure(lambda: asyncio.run(Message.send_msg_to_usr(msg, text)), 5 if quick else 20)
+        results.add("send_msg_to_usr", {"chars": size}, timing)
+
+#################### markers ####################
+
+def bench_markers(results: Results, quick: bool) -> None:
+    block = "Some commentary about the code.\n<CODESTART>\ndef f(x):\n    return x * 2\n<CODEEND>\n"
+    for blocks in ([100, 1000] if quick else [100, 1000, 10000]):
+        text = block * blocks
+        timing = measure(lambda: find_text_between_markers(text, "<CODESTART>", "<CODEEND>"), 5 if quick else 20)
+        results.add("find_text_between_markers", {"chars": len(text), "blocks": blocks}, timing)
+
+#################### threads ####################
+
+def bench_thread(results: Results, quick: bool) -> None:
+    from GenerativeAI import OpenAI_LLM
+    from SessionStore import Session
+    from TokenCounter import TOKENS_PER_REPLY
+    llm = OpenAI_LLM(app_data_dir=os.environ["APP_DATA_DIR"])
+    text = "A reasonably long message in a conversation about software, performance and discord bots. " * 8
+    for n in ([100, 1000] if quick else [100, 1000, 10000]):
+        session = llm._new_session(f"bench:{n}")
+        messages = [{"role": "user" if i % 2 else "assistant", "content": [{"type": "text", "text": f"{i} {text}"}]} for i in range(n)]
+
+        def append_all():
+            session.settings["messages"][0] = [session.settings["messages"][0][0]] if session.settings["messages"][0] else []
+            llm._recount_thread_tokens(session)
+            for message in messages:
+                llm._append_to_thread(session, message)
+        results.add("append_to_thread", {"messages": n}, measure(append_all, 3))
+        results.add("recount_thread_tokens", {"messages": n}, measure(lambda: llm._recount_thread_tokens(session), 3))
+        results.add("get_curr_gpt_thread", {"messages": n}, measure(lambda: asyncio.run(llm._get_curr_gpt_thread(session)), 5))
+
+        def trim_half():
+            trimmed = Session(session.key, dict(session.settings), session.curr_prompt_name)
+            trimmed.settings["messages"] = [list(session.messages), "list of dicts"]
+            trimmed.thread_token_counts = list(session.thread_token_counts)
+            trimmed.thread_tokens = session.thread_tokens
+            llm._trim_thread(trimmed, session.thread_tokens // 2)
+        results.add("trim_thread", {"messages": n}, measure(trim_half, 5))
+
+        def append_at_budget():
+            # a thread at the budget trims on every new message
+            at_budget = llm._new_session(f"bench:{n}:budget")
+            budget = at_budget.thread_tokens + TOKENS_PER_REPLY + session.thread_tokens // 10
+            for message in messages:
+                llm._append_to_thread(at_budget, message)
+                llm._trim_thread(at_budget, budget)
+        results.add("append_at_budget", {"messages": n}, measure(append_at_budget, 3))
+
+#################### vector db ####################
+
+class StubEmbedder(SentenceTransformerEmbedder):
+    '''deterministic pseudo random unit vectors per text instead of the model, so the numbers are about the db'''
+    def __init__(self, dim: int = 384):
+        super().__init__("stub")
+        self.dim = dim
+
+    @property
+    def func(self):
+        return None
+
+    def embed(self, texts: list[str]) -> list:
+        seeds = [int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little") for text in texts]
+        vectors = np.stack([np.random.default_rng(seed).standard_normal(self.dim) for seed in seeds]).astype(np.float32)
+        return list(vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        return word_spans(text)
+
+def bench_vectordb(results: Results, sizes: list[int], backends: list[str]) -> None:
+    rng = np.random.default_rng(0)
+    words = [f"term{i}" for i in range(5000)]
+    for backend in backends:
+        for n in sizes:
+            with tempfile.TemporaryDirectory() as path:
+                db = VectorDB(path, "stub", "bench", chunk_tokens=200, embed_batch_size=256, embedder=StubEmbedder(), backend=backend)
+                documents = [" ".join(rng.choice(words, 40)) + f" id{i}" for i in range(n)]
+                start = time.perf_counter()
+                db.upload_many(documents)
+                upload_ms = (time.perf_counter() - start) * 1000
+                results.add("vectordb_upload_many", {"backend": backend, "chunks": n},
+                            {"runs": 1, "mean_ms": round(upload_ms, 4), "p50_ms": round(upload_ms, 4), "min_ms": round(upload_ms, 4), "max_ms": round(upload_ms, 4)})
+                results.add("vectordb_upload", {"backend": backend, "chunks": n}, measure(lambda: db.upload(" ".join(rng.choice(words, 40))), 10))
+                prompts = [" ".join(rng.choice(words, 8)) for _ in range(20)]
+                for mode in ("vector", "lexical", "hybrid"):
+                    queries = iter(prompts * 2)
+                    results.add("vectordb_query", {"backend": backend, "chunks": n, "mode": mode, "k": 8},
+                                measure(lambda: db.query(next(queries), k=8, mode=mode), 20))
+                results.add("vectordb_query_many", {"backend": backend, "chunks": n, "prompts": 20, "k": 8},
+                            measure(lambda: db.query_many(prompts, k=8, candidates=32), 3))
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smaller inputs and fewer runs")
+    parser.add_argument("--only", nargs="+", choices=["pdf", "send", "markers", "thread", "vectordb"])
+    parser.add_argument("--sizes", type=int, nargs="+", help="vector db chunk counts (default 1000 10000 100000)")
+    parser.add_argument("--backends", nargs="+", default=["numpy", "chroma"])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    suites = args.only or ["pdf", "send", "markers", "thread", "vectordb"]
+    sizes = args.sizes or ([1000] if args.quick else [1000, 10000, 100000])
+    results = Results()
+    if "pdf" in suites:
+        bench_pdf(results, args.quick)
+    if "send" in suites:
+        bench_send(results, args.quick)
+    if "markers" in suites:
+        bench_markers(results, args.quick)
+    if "thread" in suites:
+        bench_thread(results, args.quick)
+    if "vectordb" in suites:
+        bench_vectordb(results, sizes, args.backends)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "results": results.rows,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
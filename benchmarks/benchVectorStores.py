@@ -0,0 +1,92 @@
+'''
+Compare the VectorDB backends (chroma vs the numpy mmap store, float32 and float16) on synthetic embeddings:
+insert throughput, time to reopen, single and batched query latency, and recall@k against exact search.
+
+usage: python benchVectorStores.py [--sizes 1000 10000] [--dim 384] [--queries 100] [--k 10] [--json results.json]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from VectorStores import ChromaStore, NumpyStore
+
+def make_embeddings(rng: np.random.Generator, n: int, dim: int, clusters: int = 100) -> np.ndarray:
+    '''normalized vectors around a few cluster centers, closer to real text embeddings than uniform noise'''
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def open_store(backend: str, path: str):
+    if backend == "chroma":
+        return ChromaStore(path, "bench")
+    return NumpyStore(os.path.join(path, "bench.numpy"), dtype=backend.split("-")[1])
+
+def bench_backend(backend: str, vectors: np.ndarray, queries: np.ndarray, truth: list[set[int]], k: int, batch: int = 1000) -> dict:
+    with tempfile.TemporaryDirectory() as path:
+        store = open_store(backend, path)
+        ids = [str(i) for i in range(len(vectors))]
+        start = time.perf_counter()
+        for i in range(0, len(vectors), batch):
+            store.upsert(ids[i:i + batch], [f"document {j}" for j in range(i, min(i + batch, len(vectors)))],
+                         list(vectors[i:i + batch]), [{"n": j} for j in range(i, min(i + batch, len(vectors)))])
+        insert_s = time.perf_counter() - start
+        del store
+
+        start = time.perf_counter()
+        store = open_store(backend, path)
+        store.count()
+        open_s = time.perf_counter() - start
+
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            result = store.search([query], k)[0]
+            latencies.append(time.perf_counter() - start)
+            hits += len(expected & {int(x) for x in result})
+        start = time.perf_counter()
+        store.search(list(queries), k)
+        batch_s = time.perf_counter() - start
+
+    return {
+        "backend": backend,
+        "n": len(vectors),
+        "insert_per_s": round(len(vectors) / insert_s),
+        "open_ms": round(open_s * 1000, 2),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+        "batch_query_ms": round(batch_s * 1000, 2),
+        f"recall@{k}": round(hits / (k * len(queries)), 4),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--dim", type=int, default=384) # all-MiniLM-L6-v2
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--backends", nargs="+", default=["chroma", "numpy-float32", "numpy-float16"])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = []
+    for n in args.sizes:
+        vectors = make_embeddings(rng, n, args.dim)
+        queries = make_embeddings(rng, args.queries, args.dim)
+        # exact float32 search is the ground truth
+        truth = [set(np.argsort(-(vectors @ query))[:args.k].tolist()) for query in queries]
+        for backend in args.backends:
+            result = bench_backend(backend, vectors, queries, truth, args.k)
+            results.append(result)
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
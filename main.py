@@ -1,11 +1,19 @@
+import time
+_imports_start = time.perf_counter()
 import discord
 import os
+import asyncio
 from dotenv import load_dotenv
 
-from GenerativeAI import LLM_Controller
+from GenerativeAI import LLM_Controller, run_blob_sweeper
 from PersonalAssistant import PersonalAssistant
 import argparse
-from Utils import runTryExcept, Message
+from Utils import runTryExcept, Message, StreamingReply, startup_timer, warm_up_pdf_reader, attachment_downloader, ocr_engine
+from ImagePreprocessor import image_preprocessor
+from Scheduler import RequestScheduler, QueueFullException
+from Metrics import stage, start_metrics_server
+from Tracing import start_trace
+startup_timer.record("imports", time.perf_counter() - _imports_start)
 
 class Main:
     def __init__(self, debug: bool):
@@ -22,21 +30,85 @@ class Main:
         self.TOKEN = discord_token
         self.chatgpt_channel = chatgpt_channel
         self.personal_assistant_channel =  personal_assistant_channel
+        # everything the bot keeps across restarts (reminders, threads, blobs, caches, traces) lives under here
+        self.app_data_dir = os.getenv("APP_DATA_DIR", "./data")
 
-        self.LLM_API = LLM_Controller()
-        self.PersonalAssistant = PersonalAssistant()
+        with startup_timer.phase("init LLM controller"):
+            self.LLM_API = LLM_Controller(app_data_dir=self.app_data_dir)
+        with startup_timer.phase("init personal assistant"):
+            self.PersonalAssistant = PersonalAssistant(app_data_dir=self.app_data_dir)
+
+        # fair queueing and a global concurrency cap for everything that may call an API
+        self.scheduler = RequestScheduler(max_in_flight=int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "4")),
+                                          max_queued_per_user=int(os.getenv("SCHEDULER_MAX_QUEUED_PER_USER", "5")))
 
         # discord
         self.intents = discord.Intents.all()
         self.client = discord.Client(intents=self.intents)
 
+        # openai, chromadb + the embedding model and the pdf libraries are loaded on first use.
+        # with WARM_UP they are loaded in the background once we're connected, so the first request doesn't pay for it.
+        self.warm_up = os.getenv("WARM_UP", "True").lower() in ("true", "1", "yes")
+        self._warm_up_task: asyncio.Task | None = None
+        self._started = False # on_ready fires again after reconnects, the background tasks are started once
+
+        # prometheus text format metrics at http://METRICS_HOST:METRICS_PORT/metrics, METRICS_PORT=0 turns it off
+        self.metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(os.getenv("METRICS_PORT", "9108"))
+        self._metrics_runner = None
+
+        # images and pdf text no thread refers to anymore are deleted every BLOB_SWEEP_INTERVAL_S seconds
+        self.blob_sweep_interval_s = float(os.getenv("BLOB_SWEEP_INTERVAL_S", str(6 * 3600)))
+        self._blob_sweeper: asyncio.Task | None = None
+
+    async def _warm_up(self) -> None:
+        '''Load the lazily initialized subsystems in worker threads, then print the full startup report'''
+        for name, warm_up in [("warm up LLM controller", self.LLM_API.warm_up),
+                              ("warm up personal assistant", self.PersonalAssistant.warm_up),
+                              ("warm up pdf reader", warm_up_pdf_reader)]:
+            try:
+                with startup_timer.phase(name):
+                    await asyncio.to_thread(warm_up)
+            except Exception as e:
+                print(f"[LOG] {name} failed, it will be retried on first use: {e}")
+        print(f"[LOG] Warm up done:\n{startup_timer.report()}")
+
+    async def shutdown(self) -> None:
+        '''Stop the background tasks and release the worker pools and connections, once the client has stopped'''
+        for task in (self._blob_sweeper, self._warm_up_task):
+            if task is not None:
+                task.cancel()
+        await self.PersonalAssistant.close()
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+        await attachment_downloader.close()
+        ocr_engine.shutdown()
+        image_preprocessor.shutdown()
+        print("[LOG] Shut down.")
+
     def run(self):
         '''Main function'''
         ########################### INIT ############################
+        connect_start = time.perf_counter()
+
         @self.client.event
         async def on_ready():
             '''When ready, load all looping functions if any.'''
             print(f'{self.client.user} running!')
+            if not self._started:
+                self._started = True
+                self.PersonalAssistant.start_reminders(self.client)
+                self._blob_sweeper = asyncio.create_task(run_blob_sweeper(self.blob_sweep_interval_s))
+                startup_timer.record("connect to discord", time.perf_counter() - connect_start)
+                print(f"[LOG] Startup times:\n{startup_timer.report()}")
+                if self.warm_up:
+                    self._warm_up_task = asyncio.create_task(self._warm_up())
+            if self._metrics_runner is None and self.metrics_port != 0:
+                try:
+                    self._metrics_runner = await start_metrics_server(self.metrics_host, self.metrics_port)
+                    print(f"[LOG] Serving metrics at http://{self.metrics_host}:{self.metrics_port}/metrics")
+                except OSError as e:
+                    print(f"[LOG] Could not start the metrics server: {e}")
 
         ########################### ON ANY MSG ############################
 
@@ -50,27 +122,68 @@ class Main:
             if discordMsg.author == self.client.user:
                 return 
 
-            msg = Message.from_discord(discordMsg)
+            # only the bot's channels, so other messages don't download attachments or show up in the metrics
+            if channel not in (self.chatgpt_channel, self.personal_assistant_channel):
+                return
+
+            # everything done for the message is recorded as one trace, see Tracing
+            with start_trace("discord_message", channel=channel, user=str(discordMsg.author.id)), stage("on_message"):
+                await handle_message(discordMsg, channel)
+
+        async def handle_message(discordMsg : discord.message.Message, channel : str):
+            '''Handles a message sent to one of the bot's channels, timed as the on_message stage'''
+            msg = await Message.from_discord(discordMsg)
+            user = str(discordMsg.author.id)
+            if len(msg.attachment_errors) > 0:
+                await Message.send_msg_to_usr(msg, "Skipped attachments:\n" + "\n".join(msg.attachment_errors))
+
+            async def notify_queued(position: int) -> None:
+                await Message.send_msg_to_usr(msg, f"You're queued (position {position}).")
 
             ############################## LLM API (OpenAI models, Anthropic Models, etc.) ##############################
             if channel == self.chatgpt_channel:
-                if self.DEBUG:
-                    chatgptresp = await self.LLM_API.main(msg=msg)
-                else:
-                    chatgptresp = await runTryExcept(self.LLM_API.main, msg=msg)
-
+                # long answers are streamed into the channel as they are generated
+                msg.reply_stream = StreamingReply(msg)
+                # commands only change or show settings, they don't need to wait behind completions
+                fast = msg.content.startswith(("!", "$"))
+                try:
+                    if self.DEBUG:
+                        chatgptresp = await self.scheduler.submit(user, lambda: self.LLM_API.main(msg=msg), fast, notify_queued)
+                    else:
+                        chatgptresp = await self.scheduler.submit(user, lambda: runTryExcept(self.LLM_API.main, msg=msg), fast, notify_queued)
+                except QueueFullException as e:
+                    chatgptresp = str(e)
+
+                if msg.reply_stream.delivered(chatgptresp):
+                    return
                 return await Message.send_msg_to_usr(msg, chatgptresp)
 
             ############################## Personal Assistant Channel ##############################
             if channel == self.personal_assistant_channel:
-                if self.DEBUG:
-                    paresp = await self.PersonalAssistant.main(msg=msg)
-                else:
-                    paresp = await runTryExcept(self.PersonalAssistant.main, msg=msg)
+                fast = self.PersonalAssistant.is_fast_command(msg.content)
+                try:
+                    if self.DEBUG:
+                        paresp = await self.scheduler.submit(user, lambda: self.PersonalAssistant.main(msg=msg), fast, notify_queued)
+                    else:
+                        paresp = await self.scheduler.submit(user, lambda: runTryExcept(self.PersonalAssistant.main, msg=msg), fast, notify_queued)
+                except QueueFullException as e:
+                    paresp = str(e)
 
                 return await Message.send_msg_to_usr(msg, paresp)
 
-        self.client.run(self.TOKEN)
+        # what client.run does, plus the shutdown once the client is closed (or interrupted with ctrl-c)
+        async def runner():
+            async with self.client:
+                try:
+                    await self.client.start(self.TOKEN)
+                finally:
+                    await self.shutdown()
+
+        discord.utils.setup_logging()
+        try:
+            asyncio.run(runner())
+        except KeyboardInterrupt:
+            pass
 
 if __name__ == "__main__":
     # parse cli args
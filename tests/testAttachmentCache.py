@@ -0,0 +1,69 @@
+'''
+Test the on-disk cache of extracted attachment text: hits, misses, LRU eviction under the byte cap and the pdf keys.
+'''
+import unittest
+import tempfile
+import os
+import sys
+sys.path.append('..')
+from AttachmentCache import AttachmentCache
+import Utils
+
+class TestAttachmentCache(unittest.TestCase):
+    '''Test lookups and eviction.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_hit_miss(self):
+        cache = AttachmentCache(self.dir.name, max_bytes=10_000)
+        key = AttachmentCache.make_key(b"file", "pdf", "auto")
+        self.assertNotEqual(key, AttachmentCache.make_key(b"file", "pdf", "always"))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {"text": "hello"})
+        self.assertEqual(cache.get(key), {"text": "hello"})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # the index is rebuilt from the files
+        self.assertEqual(AttachmentCache(self.dir.name, max_bytes=10_000).get(key), {"text": "hello"})
+
+    def test_lru_eviction(self):
+        entry = {"text": "x" * 100} # ~113 bytes of json
+        cache = AttachmentCache(self.dir.name, max_bytes=300)
+        cache.put("a", entry)
+        cache.put("b", entry)
+        cache.get("a") # b is now the least recently used
+        cache.put("c", entry)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), entry)
+        self.assertEqual(cache.get("c"), entry)
+        self.assertLessEqual(cache._total_bytes, 300)
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["a.json", "c.json"])
+
+class TestExtractPdfCached(unittest.TestCase):
+    '''Test changing an extraction setting doesn't serve extractions made with the old one.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved = Utils._attachment_cache, Utils.OCR_MIN_TEXT_DENSITY
+        Utils._attachment_cache = AttachmentCache(self.dir.name, max_bytes=1_000_000)
+
+    def tearDown(self):
+        Utils._attachment_cache, Utils.OCR_MIN_TEXT_DENSITY = self.saved
+        self.dir.cleanup()
+
+    def test_thresholds_in_key(self):
+        import fitz
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "cached page")
+        pdf = doc.tobytes()
+
+        self.assertIn("cached page", Utils.extract_pdf_cached(pdf, "never").embedded_text)
+        Utils.extract_pdf_cached(pdf, "never")
+        self.assertEqual((Utils._attachment_cache.hits, Utils._attachment_cache.misses), (1, 1))
+        Utils.OCR_MIN_TEXT_DENSITY = 50.0
+        Utils.extract_pdf_cached(pdf, "never")
+        self.assertEqual(Utils._attachment_cache.misses, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+'''
+Test discord messages are imported with the attachments that could be downloaded, the others are reported.
+'''
+import unittest
+import sys
+from types import SimpleNamespace
+sys.path.append('..')
+import Utils
+from Utils import Message, MyCustomException
+
+class FakeDownloader:
+    '''stands in for AttachmentDownloader, attachments with "big" in their url are over the size cap'''
+    async def fetch(self, url: str, expected_size: int | None = None) -> bytes:
+        if "big" in url:
+            raise MyCustomException(f'attachment is {expected_size} bytes, the limit is 100 bytes')
+        return b"hello"
+
+def attachment(filename: str, size: int) -> SimpleNamespace:
+    return SimpleNamespace(filename=filename, url=f"https://cdn.example/{filename}", size=size)
+
+class TestImportFromDiscord(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.saved = Utils.attachment_downloader
+        Utils.attachment_downloader = FakeDownloader()
+
+    def tearDown(self):
+        Utils.attachment_downloader = self.saved
+
+    async def test_failed_download_is_skipped(self):
+        discord_msg = SimpleNamespace(content="summarize these", author=SimpleNamespace(id=1), guild=SimpleNamespace(id=2),
+                                      channel=SimpleNamespace(id=3), attachments=[attachment("big.txt", 1000), attachment("notes.txt", 5)])
+        msg = await Message.from_discord(discord_msg)
+        self.assertEqual(msg.content, "summarize these")
+        self.assertEqual(msg.attachments["texts"], ["hello"])
+        self.assertEqual(msg.attachment_errors, ["big.txt: attachment is 1000 bytes, the limit is 100 bytes"])
+
+if __name__ == '__main__':
+    unittest.main()
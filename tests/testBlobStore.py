@@ -0,0 +1,82 @@
+'''
+Test threads keep references to images and pdf text in the blob store, and get them back when a request is made.
+'''
+import unittest
+import tempfile
+import base64
+import json
+import time
+import os
+import sys
+sys.path.append('..')
+from BlobStore import BlobStore
+from GenerativeAI import OpenAI_LLM
+from TokenCounter import count_message_tokens
+
+class TestBlobStore(unittest.IsolatedAsyncioTestCase):
+    '''Test the memory LRU in front of the blob files.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_put_get(self):
+        store = BlobStore(self.dir.name, max_bytes=150)
+        refs = [await store.put(bytes([i]) * 100, "image/png", width=10, height=10) for i in range(3)]
+        self.assertEqual(set(refs[0]), {"hash", "mime", "size", "width", "height"})
+        self.assertEqual(len(store._memory), 1) # the older blobs were dropped from memory, not lost
+        blobs = await store.get_many([ref["hash"] for ref in refs])
+        self.assertEqual([blobs[ref["hash"]] for ref in refs], [bytes([i]) * 100 for i in range(3)])
+        self.assertEqual(store.misses, 2)
+        # a new store over the same directory finds them on disk, an unknown hash is left out
+        blobs = await BlobStore(self.dir.name, max_bytes=0).get_many([refs[1]["hash"], "0" * 64])
+        self.assertEqual(list(blobs), [refs[1]["hash"]])
+
+class TestThreadReferences(unittest.IsolatedAsyncioTestCase):
+    '''Test the thread stays compact and is materialized for openai.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.environ.setdefault("OPENAI_API_KEY", "test") # the client is never created
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_materialize(self):
+        llm = OpenAI_LLM(app_data_dir=self.dir.name)
+        image = await llm.blobs.put(b"\x89PNG fake image" * 1000, "image/png", width=1024, height=512)
+        pdf = await llm.blobs.put(b"<PDFCONTENTSTART>text<PDFCONTENTEND>", "text/plain", tokens=7)
+        thread = [
+            {"role": "assistant", "content": [{"type": "text", "text": "system prompt"}]},
+            {"role": "user", "content": [{"type": "text", "text": "look"}, {"type": "image", "image": image}, {"type": "pdf", "pdf": pdf}]},
+        ]
+        self.assertLess(len(json.dumps(thread)), 1000)
+        self.assertEqual(count_message_tokens(thread[1], "gpt-4o") - count_message_tokens(
+            {"role": "user", "content": [{"type": "text", "text": "look"}]}, "gpt-4o"), 85 + 170 * 2 + 7)
+
+        materialized = await llm._materialize_messages(thread)
+        self.assertIs(materialized[0], thread[0])
+        _, image_part, pdf_part = materialized[1]["content"]
+        self.assertEqual(image_part["image_url"]["url"], "data:image/png;base64," + base64.b64encode(b"\x89PNG fake image" * 1000).decode())
+        self.assertEqual(pdf_part, {"type": "text", "text": "<PDFCONTENTSTART>text<PDFCONTENTEND>"})
+        self.assertEqual(thread[1]["content"][1]["type"], "image") # the thread itself is left alone
+
+    async def test_sweep(self):
+        '''blobs are kept while a session or a saved thread refers to them'''
+        llm = OpenAI_LLM(app_data_dir=self.dir.name)
+        in_session, in_saved, dropped = [await llm.blobs.put(bytes([i]) * 10, "image/png", width=1, height=1) for i in range(3)]
+        session = await llm.sessions.acquire("k")
+        session.messages.append({"role": "user", "content": [{"type": "image", "image": in_session}]})
+        await llm.thread_store.save([{"role": "user", "content": [{"type": "image", "image": in_saved}]}], None, 0)
+
+        self.assertEqual(await llm.sweep_blobs(), 0) # all of them are too new to be swept
+        old = time.time() - 2 * 3600
+        for ref in (in_session, in_saved, dropped):
+            os.utime(llm.blobs._path(ref["hash"]), (old, old))
+        self.assertEqual(await llm.sweep_blobs(), 1)
+        blobs = await llm.blobs.get_many([in_session["hash"], in_saved["hash"], dropped["hash"]])
+        self.assertEqual(set(blobs), {in_session["hash"], in_saved["hash"]})
+        await llm.sessions.release(session)
+
+if __name__ == '__main__':
+    unittest.main()
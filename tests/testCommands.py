@@ -3,6 +3,7 @@ Test that the command line prefix commands work in their respective settings
 and classes.
 '''
 import unittest
+import asyncio
 import sys
 sys.path.append('..')
 from GenerativeAI import LLM_Controller
@@ -58,6 +59,14 @@ class TestChatGPT(unittest.IsolatedAsyncioTestCase):
         knowledgeCutoff = gptparams[8].split('=')[1].strip()
         self.assertEqual(knowledgeCutoff, 'Dec 2023')
 
+    async def test_shared_limiter(self):
+        '''every controller goes through the same limiter per provider, so LLM_MAX_IN_FLIGHT is the app wide cap'''
+        other = LLM_Controller()
+        for name, provider in other.providers.items():
+            self.assertIs(provider.limiter, self.chatgpt.providers[name].limiter)
+        self.message.content = '$stats'
+        self.assertIn('anthropic: in flight', await self.chatgpt.main(self.message))
+
     async def test_swap(self):
         '''test swapping models'''
         self.message.content = '!cm'
@@ -119,7 +128,12 @@ class TestCommandInterpreter(unittest.IsolatedAsyncioTestCase):
         sys.stdout = captured_output
 
         self.message.content = 'remind me, call grandma, 0.01, s'
-        await self.cmdInterp.main(self.message) # this is awaited, so reminder will finish
+        await self.cmdInterp.main(self.message) # returns once the reminder is scheduled
+        for _ in range(200): # wait for the reminder task to deliver it
+            if len(self.cmdInterp.reminders) == 0:
+                break
+            await asyncio.sleep(0.01)
+        await self.cmdInterp.reminders.close()
 
         sys.stdout = sys.__stdout__ # reset stdout for other tests
 
@@ -0,0 +1,63 @@
+'''
+Test image attachments are downsized, rotated upright and re-encoded with the right mime type before being sent.
+'''
+import unittest
+import base64
+import io
+import sys
+sys.path.append('..')
+from PIL import Image
+from ImagePreprocessor import preprocess_image, ImagePreprocessor, UnsupportedImageError
+
+def encode(img: Image.Image, format: str, **params) -> bytes:
+    out = io.BytesIO()
+    img.save(out, format=format, **params)
+    return out.getvalue()
+
+class TestPreprocessImage(unittest.TestCase):
+    '''Test the decode, resize and re-encode of a single image.'''
+    def test_downsize_photo(self):
+        photo = Image.effect_noise((3000, 2000), 40).convert("RGB")
+        content = encode(photo, "JPEG", quality=95)
+        data, mime, width, height = preprocess_image(content, max_edge=1024, quality=80)
+        self.assertEqual((mime, width, height), ("image/jpeg", 1024, 683))
+        self.assertLess(len(data), len(content))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (1024, 683))
+
+    def test_keeps_mime_and_alpha(self):
+        screenshot = Image.new("RGB", (800, 600), (255, 255, 255))
+        data, mime, _, _ = preprocess_image(encode(screenshot, "PNG"), max_edge=1024)
+        self.assertEqual(mime, "image/png")
+        transparent = Image.new("RGBA", (2000, 100), (0, 0, 0, 0))
+        data, mime, width, _ = preprocess_image(encode(transparent, "WEBP", lossless=True), max_edge=1024)
+        self.assertEqual((mime, width), ("image/png", 1024))
+        self.assertEqual(Image.open(io.BytesIO(data)).mode, "RGBA")
+
+    def test_small_upload_kept(self):
+        content = encode(Image.effect_noise((100, 100), 40).convert("RGB"), "JPEG", quality=50)
+        data, mime, _, _ = preprocess_image(content, max_edge=1024, quality=95)
+        self.assertIs(data, content)
+        self.assertEqual(mime, "image/jpeg")
+
+    def test_exif_rotation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6 # rotated 90 degrees
+        content = encode(Image.new("RGB", (400, 200)), "JPEG", exif=exif)
+        _, _, width, height = preprocess_image(content, max_edge=1024)
+        self.assertEqual((width, height), (200, 400))
+
+class TestImagePreprocessor(unittest.IsolatedAsyncioTestCase):
+    '''Test the worker pool wrapper.'''
+    async def test_process(self):
+        preprocessor = ImagePreprocessor(workers=2)
+        image = await preprocessor.process(encode(Image.new("RGB", (3000, 300)), "PNG"), "wide.png")
+        self.assertEqual((image.mime, image.width, image.height), ("image/png", 2048, 205))
+        self.assertTrue(image.data_url.startswith("data:image/png;base64,"))
+        self.assertEqual(len(base64.b64decode(image.b64)), image.bytes)
+        # undecodable images are refused instead of being sent as an invalid payload
+        with self.assertRaises(UnsupportedImageError):
+            await preprocessor.process(b"not an image", "photo.HEIC")
+        preprocessor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+'''
+Test the metrics registry and its Prometheus text endpoint.
+'''
+import unittest
+import sys
+import aiohttp
+sys.path.append('..')
+from Metrics import MetricsRegistry, start_metrics_server, metrics, stage
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    '''Test counters, gauges and histograms render in the text format, and the endpoint serves them.'''
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("test_requests_total", "requests", ("channel",))
+        in_flight = registry.gauge("test_in_flight", "in flight")
+        latency = registry.histogram("test_latency_seconds", "latency", buckets=(0.1, 1.0))
+        requests.inc(channel="llm")
+        requests.inc(2, channel="llm")
+        in_flight.inc()
+        in_flight.inc()
+        in_flight.dec()
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE test_requests_total counter", lines)
+        self.assertIn('test_requests_total{channel="llm"} 3', lines)
+        self.assertIn("test_in_flight 1", lines)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("test_latency_seconds_count 3", lines)
+        with self.assertRaises(ValueError):
+            requests.inc(user="someone")
+
+    async def test_endpoint(self):
+        with self.assertRaises(RuntimeError):
+            with stage("test_stage"):
+                raise RuntimeError("boom")
+        runner = await start_metrics_server("127.0.0.1", 0)
+        try:
+            port = runner.addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    self.assertEqual(response.status, 200)
+                    text = await response.text()
+        finally:
+            await runner.cleanup()
+        self.assertEqual(text, metrics.render())
+        self.assertIn('bot_stage_duration_seconds_count{stage="test_stage"} 1', text)
+        self.assertIn('bot_stage_errors_total{stage="test_stage"} 1', text)
+
+if __name__ == '__main__':
+    unittest.main()
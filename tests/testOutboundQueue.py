@@ -0,0 +1,134 @@
+'''
+Test splitting long replies into discord messages and the paced, coalescing outbound queue.
+'''
+import unittest
+import asyncio
+import time
+import sys
+sys.path.append('..')
+from OutboundQueue import OutboundQueue, split_message
+from Utils import Message, StreamingReply
+
+class FakeChannel:
+    def __init__(self, id: int = 1):
+        self.id = id
+        self.sent: list[tuple[float, str | None]] = []
+
+    async def send(self, content=None, file=None):
+        self.sent.append((time.monotonic(), content))
+        return len(self.sent)
+
+class FakeSentMessage:
+    def __init__(self, channel, content, file):
+        self.channel, self.content, self.file = channel, content, file
+
+    async def edit(self, content=None):
+        self.content = content
+
+class FakeStreamChannel:
+    def __init__(self):
+        self.id = 3
+        self.messages: list[FakeSentMessage] = []
+
+    async def send(self, content=None, file=None):
+        self.messages.append(FakeSentMessage(self, content, file))
+        return self.messages[-1]
+
+class TestSplitMessage(unittest.TestCase):
+    '''Test messages are split between paragraphs, lines and words, with code blocks re-opened.'''
+    def test_paragraphs(self):
+        first, second = "a " * 30, "b " * 30
+        chunks = split_message(f"{first}\n\n{second}", 100)
+        self.assertEqual(chunks, [first.rstrip(), second.rstrip()])
+        self.assertEqual(split_message("short", 100), ["short"])
+        self.assertEqual(split_message("", 100), [])
+
+    def test_long_words(self):
+        chunks = split_message("word " * 100 + "x" * 250, 100)
+        self.assertTrue(all(len(c) <= 100 for c in chunks))
+        self.assertTrue(all(not c.startswith("ord") for c in chunks)) # words are not cut
+        self.assertEqual("".join(chunks).count("x"), 250)
+
+    def test_code_fences(self):
+        code = "```python\n" + "".join(f"x_{i} = {i}\n" for i in range(100)) + "```\n"
+        chunks = split_message("Here is the code:\n\n" + code + "\nThat's it.", 200)
+        self.assertGreater(len(chunks), 3)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 200)
+            self.assertEqual(chunk.count("```") % 2, 0) # every chunk closes the code blocks it opens
+        code_chunks = [c for c in chunks if "x_" in c]
+        self.assertTrue(all("```python\n" in c for c in code_chunks))
+        self.assertEqual(sum(c.count("x_") for c in chunks), 100)
+
+class TestOutboundQueue(unittest.IsolatedAsyncioTestCase):
+    '''Test pacing, ordering and coalescing of the sends to a channel.'''
+    async def test_coalesce(self):
+        queue = OutboundQueue(rate=1000, burst=1, limit=20)
+        channel = FakeChannel()
+        sends = [asyncio.create_task(queue.send(channel, text)) for text in ["one", "two", "three", "x" * 15]]
+        await asyncio.gather(*sends)
+        self.assertEqual([content for _, content in channel.sent], ["one\ntwo\nthree", "x" * 15])
+        self.assertEqual(queue.coalesced, 2)
+        # a message that will be edited keeps to itself
+        await asyncio.gather(queue.send(channel, "a", coalesce=False), queue.send(channel, "b"))
+        self.assertEqual([content for _, content in channel.sent[2:]], ["a", "b"])
+
+    async def test_pacing(self):
+        queue = OutboundQueue(rate=50, burst=2, limit=20)
+        channel = FakeChannel()
+        other = FakeChannel(id=2)
+        start = time.monotonic()
+        await asyncio.gather(queue.send_many(channel, ["x" * 15 for _ in range(5)]), queue.send(other, "y"))
+        times = [t - start for t, _ in channel.sent]
+        self.assertEqual(len(times), 5)
+        self.assertLess(times[1], 0.03) # the burst goes out right away
+        self.assertGreaterEqual(times[4], 3 / 50 - 0.005) # then 50 per second
+        self.assertLess(other.sent[0][0] - start, 0.03) # channels don't wait for each other
+
+class TestStreamingReply(unittest.IsolatedAsyncioTestCase):
+    '''Test a streamed reply is capped at max_messages, with the complete text attached as a file.'''
+    async def test_overflow_to_file(self):
+        channel, reply = self.stream()
+        reply.max_messages = 2
+        words = [f"word{i} " for i in range(1500)] # about 4 messages worth
+        start = time.monotonic()
+        for word in words:
+            await reply.push(word)
+        self.assertLess(time.monotonic() - start, 0.5) # pushing never waits on discord
+        await reply.finish()
+
+        texts = [m for m in channel.messages if m.file is None]
+        files = [m for m in channel.messages if m.file is not None]
+        self.assertEqual(len(texts), 2)
+        self.assertTrue(texts[0].content.startswith("word0 word1"))
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].file.fp.getvalue().decode(), "".join(words))
+        self.assertTrue(reply.delivered("".join(words)))
+
+    def stream(self) -> tuple[FakeStreamChannel, StreamingReply]:
+        channel = FakeStreamChannel()
+        msg = Message(msgType="discord")
+        msg.discordMsg = type("DiscordMessage", (), {"channel": channel})()
+        return channel, StreamingReply(msg, edit_interval=0.0)
+
+    async def test_empty_and_error(self):
+        '''the placeholder never stays behind'''
+        channel, reply = self.stream()
+        await reply.start()
+        await reply.finish()
+        self.assertEqual([m.content for m in channel.messages], ["(the model returned an empty reply)"])
+
+        channel, reply = self.stream()
+        await reply.start()
+        await reply.fail("Encountered Error: boom")
+        self.assertEqual([m.content for m in channel.messages], ["Encountered Error: boom"])
+        self.assertTrue(reply.delivered("Encountered Error: boom"))
+
+        channel, reply = self.stream()
+        await reply.push("partial answer")
+        await asyncio.sleep(0) # let the background flush show it
+        await reply.fail("Encountered Error: boom")
+        self.assertEqual([m.content for m in channel.messages], ["partial answer\n\nEncountered Error: boom"])
+
+if __name__ == '__main__':
+    unittest.main()
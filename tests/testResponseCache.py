@@ -0,0 +1,75 @@
+'''
+Test the exact and semantic tiers of the response cache, expiry and LRU eviction.
+'''
+import unittest
+import time
+import sys
+sys.path.append('..')
+import numpy as np
+from ResponseCache import ResponseCache
+
+class FakeEmbedder:
+    '''bag of words over a tiny vocabulary, so similar questions get similar embeddings'''
+    VOCAB = ["what", "is", "the", "capital", "of", "france", "germany", "paris"]
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed(self, texts: list[str]) -> list:
+        self.calls += 1
+        return [np.array([text.lower().replace("?", "").split().count(w) for w in self.VOCAB], dtype=np.float32) + 0.01 for text in texts]
+
+def request(question: str, model: str = "gpt-4o", system: str = "be helpful") -> dict:
+    return {
+        "model": model,
+        "temperature": 0.0,
+        "messages": [
+            {"role": "assistant", "content": [{"type": "text", "text": system}]},
+            {"role": "user", "content": [{"type": "text", "text": question}]},
+        ],
+    }
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+    '''Test lookups hit, miss and expire as expected.'''
+    async def test_exact(self):
+        cache = ResponseCache(ttl_s=60, max_entries=2)
+        self.assertIsNone(await cache.get(request("hi")))
+        await cache.put(request("hi"), "hello")
+        reordered = dict(reversed(list(request("hi").items())))
+        self.assertEqual(await cache.get(reordered), "hello") # key order doesn't matter
+        self.assertIsNone(await cache.get(request("hi", model="gpt-4"))) # neither does anything else differ
+        self.assertEqual((cache.exact_hits, cache.misses), (1, 2))
+
+    async def test_lru_and_ttl(self):
+        cache = ResponseCache(ttl_s=60, max_entries=2)
+        await cache.put(request("a"), "A")
+        await cache.put(request("b"), "B")
+        await cache.get(request("a")) # a is now the most recently used
+        await cache.put(request("c"), "C")
+        self.assertIsNone(await cache.get(request("b")))
+        self.assertEqual(await cache.get(request("a")), "A")
+
+        expiring = ResponseCache(ttl_s=0.05, max_entries=2)
+        await expiring.put(request("a"), "A")
+        time.sleep(0.06)
+        self.assertIsNone(await expiring.get(request("a")))
+        self.assertEqual(len(expiring._exact), 0)
+
+    async def test_semantic(self):
+        embedder = FakeEmbedder()
+        cache = ResponseCache(ttl_s=60, max_entries=10, semantic=True, similarity_threshold=0.9, embedder=embedder)
+        await cache.put(request("What is the capital of France?"), "Paris")
+        self.assertEqual(await cache.get(request("what is the capital of france")), "Paris")
+        self.assertEqual(cache.semantic_hits, 1)
+        self.assertIsNone(await cache.get(request("What is the capital of Germany?"))) # not similar enough
+        self.assertIsNone(await cache.get(request("what is the capital of france", system="be terse"))) # other scope
+
+        # only single-turn text questions go into the semantic tier
+        with_image = request("What is the capital of France?")
+        with_image["messages"][1]["content"].append({"type": "image", "image": {"hash": "0" * 64}})
+        calls = embedder.calls
+        await cache.put(with_image, "an image")
+        self.assertEqual(embedder.calls, calls)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+Test the fair queueing of the request scheduler that sits in front of the LLM / PA handlers.
+'''
+import unittest
+import asyncio
+import sys
+sys.path.append('..')
+from Scheduler import RequestScheduler, QueueFullException
+
+class TestRequestScheduler(unittest.IsolatedAsyncioTestCase):
+    '''Test round robin dispatch, the in flight cap, the fast lane and backpressure.'''
+    async def test_round_robin(self):
+        '''a user with many queued requests doesn't starve a user who shows up later'''
+        scheduler = RequestScheduler(max_in_flight=1, max_queued_per_user=10)
+        order = []
+        gate = asyncio.Event()
+
+        def job(name):
+            async def run():
+                await gate.wait()
+                order.append(name)
+            return run
+
+        tasks = [asyncio.create_task(scheduler.submit("alice", job(f"a{i}"))) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(scheduler.submit("bob", job("b0"))))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.in_flight, 1)
+        gate.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["a0", "a1", "b0", "a2"])
+
+    async def test_queue_position_and_fast_lane(self):
+        '''queued requests are told their position, fast requests skip the line'''
+        scheduler = RequestScheduler(max_in_flight=1, max_queued_per_user=1)
+        gate = asyncio.Event()
+        positions = []
+
+        async def slow():
+            await gate.wait()
+            return "slow"
+
+        async def on_queued(position):
+            positions.append(position)
+
+        first = asyncio.create_task(scheduler.submit("alice", slow, on_queued=on_queued))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(scheduler.submit("bob", slow, on_queued=on_queued))
+        await asyncio.sleep(0)
+        self.assertEqual(positions, [1])
+
+        async def fast():
+            return "fast"
+        self.assertEqual(await scheduler.submit("bob", fast, fast=True), "fast")
+
+        with self.assertRaises(QueueFullException):
+            await scheduler.submit("bob", slow)
+
+        gate.set()
+        self.assertEqual(await asyncio.gather(first, second), ["slow", "slow"])
+
+if __name__ == '__main__':
+    unittest.main()
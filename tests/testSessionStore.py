@@ -0,0 +1,88 @@
+'''
+Test sessions are kept apart per conversation, evicted to disk over the cap and restored intact.
+'''
+import unittest
+import tempfile
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+sys.path.append('..')
+import discord
+from SessionStore import Session, SessionStore
+from Utils import Message
+
+def new_session(key: str) -> Session:
+    return Session(key, {"model": ["gpt-4o", "str"], "messages": [[], "list"]}, "empty")
+
+def message(text: str) -> dict:
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+def discord_message(guild_id: int | None, channel, author_id: int):
+    guild = SimpleNamespace(id=guild_id) if guild_id is not None else None
+    return SimpleNamespace(guild=guild, channel=channel, author=SimpleNamespace(id=author_id))
+
+class TestSessionKeys(unittest.TestCase):
+    '''Test which discord messages share a conversation.'''
+    def test_keys(self):
+        key = Message._discord_session_key
+        channel = SimpleNamespace(id=10)
+        self.assertEqual(key(discord_message(1, channel, 100)), key(discord_message(1, channel, 100)))
+        keys = {
+            key(discord_message(1, channel, 100)),
+            key(discord_message(1, channel, 101)), # other user
+            key(discord_message(1, SimpleNamespace(id=11), 100)), # other channel
+            key(discord_message(2, channel, 100)), # other guild
+            key(discord_message(None, channel, 100)), # dm
+        }
+        self.assertEqual(len(keys), 5)
+
+        thread = discord.Thread.__new__(discord.Thread)
+        thread.id = 20
+        # everyone in a discord thread shares it
+        self.assertEqual(key(discord_message(1, thread, 100)), key(discord_message(1, thread, 101)))
+        self.assertNotEqual(key(discord_message(1, thread, 100)), key(discord_message(1, SimpleNamespace(id=20), 100)))
+
+class TestSessionStore(unittest.IsolatedAsyncioTestCase):
+    '''Test eviction to disk and reloading.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_evict_and_restore(self):
+        store = SessionStore(self.dir.name, new_session, max_bytes=250, max_sessions=10)
+        a = await store.acquire("a")
+        a.messages.append(message("a" * 200))
+        a.thread_token_counts.append(60)
+        await store.release(a)
+        b = await store.acquire("b")
+        self.assertIsNot(a, b)
+        b.messages.append(message("b" * 200))
+        await store.release(b) # over the cap, a is the least recently used
+        self.assertEqual(list(store._sessions), ["b"])
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
+        self.assertEqual(list(store.evicted_messages()), [message("a" * 200)])
+
+        restored = await store.acquire("a")
+        self.assertEqual(restored.messages, [message("a" * 200)])
+        self.assertEqual(restored.thread_tokens, 60)
+        self.assertEqual(list(store._sessions), ["a"]) # b was evicted to make room, a is pinned
+        await store.release(restored)
+        self.assertEqual((await store.acquire("b")).messages, [message("b" * 200)])
+
+    async def test_pinned_sessions_stay(self):
+        store = SessionStore(self.dir.name, new_session, max_bytes=0, max_sessions=0)
+        sessions = await asyncio.gather(*[store.acquire(key) for key in ["a", "b", "a"]])
+        self.assertIs(sessions[0], sessions[2]) # the same key is loaded once
+        sessions[0].messages.append(message("kept"))
+        await store.release(sessions[0])
+        self.assertEqual(set(store._sessions), {"a", "b"}) # a is still pinned by the third acquire
+        for session in sessions[1:]:
+            await store.release(session)
+        self.assertEqual(len(store._sessions), 0)
+        self.assertEqual((await store.acquire("a")).messages, [message("kept")])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+'''
+Test saving, listing and loading threads, and the import of the threads that used to be pickled.
+'''
+import unittest
+import tempfile
+import pickle
+import os
+import sys
+sys.path.append('..')
+from ThreadStore import ThreadStore
+
+class TestThreadStore(unittest.IsolatedAsyncioTestCase):
+    '''Test the sqlite thread store.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = ThreadStore(os.path.join(self.dir.name, "threads.sqlite3"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_save_load(self):
+        messages = [{"role": "user", "content": [{"type": "text", "text": "hello there"}]}]
+        thread_id = await self.store.save(messages, "default", 12)
+        self.assertEqual(await self.store.load(thread_id), messages)
+        threads, total = await self.store.list_threads()
+        self.assertEqual((total, threads[0]["preview"], threads[0]["token_count"]), (1, "hello there", 12))
+        self.assertTrue(await self.store.delete(thread_id))
+        self.assertIsNone(await self.store.load(thread_id))
+
+    async def test_import_pickled_threads(self):
+        pickle_dir = os.path.join(self.dir.name, "pickled_threads")
+        os.makedirs(pickle_dir)
+        messages = [{"role": "user", "content": [{"type": "text", "text": "old thread"}]}]
+        with open(os.path.join(pickle_dir, "1700000000.5.pkl"), "wb") as f:
+            pickle.dump(messages, f)
+        with open(os.path.join(pickle_dir, "broken.pkl"), "wb") as f:
+            f.write(b"not a pickle")
+
+        self.assertEqual(self.store.import_pickled_threads(pickle_dir, lambda msgs: 5 * len(msgs)), 1)
+        self.assertFalse(os.path.exists(pickle_dir))
+        self.assertTrue(os.path.isdir(pickle_dir + ".imported"))
+        self.assertEqual(await self.store.load("1700000000.5"), messages)
+        threads, _ = await self.store.list_threads()
+        self.assertEqual((threads[0]["created"], threads[0]["token_count"]), (1700000000.5, 5))
+        self.assertEqual(self.store.import_pickled_threads(pickle_dir, len), 0) # only runs once
+
+if __name__ == '__main__':
+    unittest.main()
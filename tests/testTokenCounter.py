@@ -0,0 +1,112 @@
+'''
+Test token counting of chat messages, the tokenizer retry after a failed load and trimming threads to the context budget.
+'''
+import unittest
+import tempfile
+import asyncio
+import time
+import os
+import sys
+sys.path.append('..')
+import tiktoken
+import TokenCounter
+from TokenCounter import count_message_tokens, count_image_size_tokens, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from GenerativeAI import OpenAI_LLM
+
+class WordEncoding:
+    '''one token per word, so the expected counts are easy to work out'''
+    def encode(self, text: str, disallowed_special=()) -> list[str]:
+        return text.split()
+
+def text_message(role: str, text: str) -> dict:
+    return {"role": role, "content": [{"type": "text", "text": text}]}
+
+class TestCountTokens(unittest.TestCase):
+    '''Test messages are counted part by part, plus the framing.'''
+    def setUp(self):
+        self.saved = dict(TokenCounter._encodings), dict(TokenCounter._encoding_failed_at)
+        TokenCounter._encodings["word model"] = WordEncoding()
+
+    def tearDown(self):
+        TokenCounter._encodings, TokenCounter._encoding_failed_at = self.saved
+
+    def test_count_message_tokens(self):
+        self.assertEqual(count_message_tokens(text_message("user", "one two three"), "word model"), TOKENS_PER_MESSAGE + 1 + 3)
+        self.assertEqual(count_message_tokens({"role": "user", "content": "one two"}, "word model"), TOKENS_PER_MESSAGE + 1 + 2)
+        message = {"role": "user", "content": [
+            {"type": "text", "text": "look"},
+            {"type": "image", "image": {"hash": "0" * 64, "width": 1024, "height": 1024}},
+            {"type": "pdf", "pdf": {"hash": "1" * 64, "tokens": 40}},
+        ]}
+        self.assertEqual(count_image_size_tokens(1024, 1024), 85 + 170 * 4)
+        self.assertEqual(count_message_tokens(message, "word model"), TOKENS_PER_MESSAGE + 1 + 1 + 85 + 170 * 4 + 40)
+
+    def test_retry_failed_tokenizer(self):
+        calls = []
+        def encoding_for_model(model):
+            calls.append(model)
+            if len(calls) == 1:
+                raise ConnectionError("offline")
+            return WordEncoding()
+        saved = tiktoken.encoding_for_model
+        tiktoken.encoding_for_model = encoding_for_model
+        try:
+            self.assertEqual(count_message_tokens({"role": "user", "content": "a" * 40}, "flaky model"), TOKENS_PER_MESSAGE + 1 + 10) # estimated
+            self.assertIsNone(TokenCounter._get_encoding("flaky model")) # not retried during the cooldown
+            self.assertEqual(len(calls), 1)
+            TokenCounter._encoding_failed_at["flaky model"] -= TokenCounter.TOKENIZER_RETRY_S + 1
+            self.assertIsInstance(TokenCounter._get_encoding("flaky model"), WordEncoding)
+            TokenCounter._get_encoding("flaky model") # loaded ones are cached
+            self.assertEqual(len(calls), 2)
+        finally:
+            tiktoken.encoding_for_model = saved
+
+class TestTrimThread(unittest.TestCase):
+    '''Test the oldest messages are dropped to fit the budget, never the system prompt or the newest message.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.environ.setdefault("OPENAI_API_KEY", "test") # the client is never created
+        self.llm = OpenAI_LLM(app_data_dir=self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_trim(self):
+        session = self.llm._new_session("k")
+        for i in range(5):
+            self.llm._append_to_thread(session, text_message("user", f"message {i} " + "word " * 20))
+        system, *rest = session.messages
+        counts = list(session.thread_token_counts)
+
+        budget = session.thread_tokens + TOKENS_PER_REPLY # fits already
+        self.llm._trim_thread(session, budget)
+        self.assertEqual(len(session.messages), 6)
+
+        budget = counts[0] + counts[4] + counts[5] + TOKENS_PER_REPLY # room for the two newest messages
+        self.llm._trim_thread(session, budget)
+        self.assertEqual(session.messages, [system, rest[3], rest[4]])
+        self.assertEqual(session.thread_tokens, counts[0] + counts[4] + counts[5])
+        self.assertEqual(len(session.thread_token_counts), 6) # not compacted yet, half of the thread was trimmed
+
+        self.llm._trim_thread(session, 1) # over budget with just the two of them, they're kept anyway
+        self.assertEqual(session.messages, [system, rest[4]])
+        self.assertEqual(session.thread_token_counts, [counts[0], counts[5]]) # compacted
+        self.assertEqual(session.thread_tokens, counts[0] + counts[5])
+
+    def test_trim_at_budget(self):
+        '''a thread kept at the budget only sees its live messages, and the trimmed ones don't pile up'''
+        session = self.llm._new_session("k")
+        budget = session.thread_tokens + TOKENS_PER_REPLY + 200
+        for i in range(100):
+            self.llm._append_to_thread(session, text_message("user", f"message{i} " + "word " * 20))
+            self.llm._trim_thread(session, budget)
+            self.assertLessEqual(len(session.settings["messages"][0]), 2 * len(session.messages))
+        self.assertLessEqual(session.thread_tokens + TOKENS_PER_REPLY, budget)
+        self.assertEqual(session.thread_tokens, sum(count_message_tokens(m, "gpt-4o") for m in session.messages))
+        live = session.messages
+        self.assertEqual(session.to_dict()["settings"]["messages"][0], live) # the snapshot is compacted
+        self.assertIn("message99", asyncio.run(self.llm._get_curr_gpt_thread(session)))
+        self.assertNotIn(f"message{99 - len(live) + 1} ", asyncio.run(self.llm._get_curr_gpt_thread(session)))
+
+if __name__ == '__main__':
+    unittest.main()
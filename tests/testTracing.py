@@ -0,0 +1,71 @@
+'''
+Test per-message traces: span nesting, propagation through the scheduler and Message.from_text, and the jsonl sink.
+'''
+import unittest
+import asyncio
+import tempfile
+import os
+import sys
+sys.path.append('..')
+from Tracing import TraceSink, start_trace, span, current_span, read_traces, to_chrome_trace, self_times
+from Scheduler import RequestScheduler
+from Utils import Message
+
+class TestTracing(unittest.IsolatedAsyncioTestCase):
+    '''Test that spans end up in the trace of the message they were recorded for.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.sink = TraceSink(os.path.join(self.dir.name, "traces.jsonl"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def work_in_thread(self):
+        with span("in_thread", pages=3):
+            pass
+
+    async def test_nested_spans(self):
+        with start_trace("message", self.sink, user="1"):
+            with span("llm", model="gpt-4o") as llm:
+                await asyncio.to_thread(self.work_in_thread) # the context follows to_thread
+                llm.set(tokens=12)
+        with span("outside") as outside:
+            outside.set(ignored=True) # not in a trace, does nothing
+
+        [trace] = read_traces(self.sink.path)
+        spans = {s["name"]: s for s in trace["spans"]}
+        self.assertEqual(set(spans), {"message", "llm", "in_thread"})
+        self.assertEqual(spans["in_thread"]["parent"], spans["llm"]["id"])
+        self.assertIsNone(spans["message"]["parent"])
+        self.assertEqual(spans["llm"]["parent"], spans["message"]["id"])
+        self.assertEqual(spans["llm"]["attributes"], {"model": "gpt-4o", "tokens": 12})
+        self.assertEqual(len(to_chrome_trace([trace])["traceEvents"]), 4) # thread name + 3 spans
+        self.assertEqual(set(self_times([trace])), set(spans))
+
+    async def test_propagation(self):
+        '''queued scheduler jobs and derived messages stay in the trace of the message that caused them'''
+        scheduler = RequestScheduler(max_in_flight=1, max_queued_per_user=5)
+
+        async def handle(msg):
+            child = Message.from_text("prompt", parent=msg)
+            await asyncio.sleep(0.01)
+            with span("handle", child.trace, user=msg.content):
+                pass
+
+        async def on_message(user):
+            with start_trace("message", self.sink, user=user):
+                msg = Message(msgType="test")
+                msg.content = user
+                msg.trace = current_span()
+                await scheduler.submit("someone", lambda: handle(msg))
+
+        await asyncio.gather(*[on_message(str(i)) for i in range(3)])
+        traces = read_traces(self.sink.path)
+        self.assertEqual(len(traces), 3)
+        for trace in traces:
+            root, handled = trace["spans"]
+            self.assertEqual(handled["parent"], root["id"])
+            self.assertEqual(handled["attributes"]["user"], root["attributes"]["user"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+'''
+Test chunking, uploads, the stores, the embedding cache and the micro-batching of concurrent queries of the vector db.
+'''
+import unittest
+import asyncio
+import os
+import sys
+import tempfile
+sys.path.append('..')
+from VectorDB import VectorDB, AsyncVectorDB, mmr, dedupe_chunks, pack_chunks, word_spans, chunk_text
+from BM25Index import BM25Index
+from VectorStores import NumpyStore
+from EmbeddingCache import EmbeddingCache
+
+class FakeVectorDB:
+    '''stands in for VectorDB, records the batches it is asked to run'''
+    def __init__(self):
+        self.batches = []
+
+    def query_many(self, prompts, k, mode="vector", candidates=None, mmr_lambda=0.5):
+        self.batches.append((prompts, k))
+        return [[f"{prompt} {i}" for i in range(k)] for prompt in prompts]
+
+class StubEmbedder:
+    '''stands in for SentenceTransformerEmbedder: words as tokens, embeddings from the letters of the text'''
+    model = "stub model"
+
+    def __init__(self):
+        self.embedded: list[str] = []
+
+    @property
+    def func(self):
+        raise AssertionError("the chroma embedding function is only for the chroma backend")
+
+    def embed(self, texts: list[str]) -> list:
+        self.embedded.extend(texts)
+        return [[text.count(c) + 0.01 for c in "etaoinshr"] for text in texts]
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        return word_spans(text)
+
+class TestNumpyVectorDB(unittest.TestCase):
+    def test_warm_up_without_chromadb(self):
+        '''the numpy backend warms up the model without touching chromadb'''
+        with tempfile.TemporaryDirectory() as tmp:
+            db = VectorDB(tmp, "stub", "test", embedder=StubEmbedder(), backend="numpy")
+            db.warm_up()
+            self.assertEqual(db.store.count(), 0)
+
+    def test_upload_many_dedupes(self):
+        '''uploading the same documents again inserts and embeds nothing, chunks are stored under their text hash'''
+        with tempfile.TemporaryDirectory() as tmp:
+            embedder = StubEmbedder()
+            db = VectorDB(tmp, "stub", "test", chunk_tokens=4, chunk_overlap=0, embedder=embedder, backend="numpy",
+                          embedding_cache=EmbeddingCache(os.path.join(tmp, "embeddings.sqlite3")))
+            documents = ["one two three four five six seven eight", "one two three four nine ten"]
+            self.assertEqual(db.upload_many(documents), (3, 1)) # the first chunk is in both documents
+            self.assertEqual(db.store.count(), 3)
+            self.assertEqual(db.store.existing([db.chunk_id("five six seven eight")]), {db.chunk_id("five six seven eight")})
+            embedded = len(embedder.embedded)
+            self.assertEqual(db.upload_many(documents), (0, 4))
+            self.assertEqual(len(embedder.embedded), embedded)
+
+    def test_page_metadata(self):
+        '''every chunk of a page carries the page's source and number, plus its index within the page'''
+        with tempfile.TemporaryDirectory() as tmp:
+            db = VectorDB(tmp, "stub", "test", chunk_tokens=3, chunk_overlap=1, embedder=StubEmbedder(), backend="numpy")
+            stored = []
+            upsert = db.store.upsert
+            def recording_upsert(ids, documents, embeddings, metadatas):
+                stored.extend(zip(documents, metadatas))
+                upsert(ids, documents, embeddings, metadatas)
+            db.store.upsert = recording_upsert
+            db.upload_many(["a b c d e", "f g"], [{"source": "doc.pdf", "page": 1}, {"source": "doc.pdf", "page": 2}])
+            self.assertEqual(stored, [
+                ("a b c", {"source": "doc.pdf", "page": 1, "chunk": 0}),
+                ("c d e", {"source": "doc.pdf", "page": 1, "chunk": 1}),
+                ("f g", {"source": "doc.pdf", "page": 2, "chunk": 0}),
+            ])
+
+class TestChunkText(unittest.TestCase):
+    def test_budget_and_overlap(self):
+        '''chunks hold at most max_tokens tokens, consecutive ones share overlap tokens and together cover the text'''
+        words = [f"w{i}" for i in range(23)]
+        text = "  " + " ".join(words) + "\n"
+        chunks = chunk_text(text, 10, 3, word_spans)
+        self.assertEqual([chunk.split() for chunk in chunks], [words[0:10], words[7:17], words[14:23]])
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertEqual(previous.split()[-3:], chunk.split()[:3])
+        self.assertEqual(chunks[0], "w0 w1 w2 w3 w4 w5 w6 w7 w8 w9") # cut at token boundaries, the original spacing kept
+
+    def test_edge_cases(self):
+        self.assertEqual(chunk_text("", 10, 2, word_spans), [])
+        self.assertEqual(chunk_text("short text", 10, 2, word_spans), ["short text"])
+        self.assertEqual(chunk_text("a b c d", 2, 0, word_spans), ["a b", "c d"]) # no overlap
+        # the last chunk ends exactly at the end of the text, there is no chunk made only of overlap
+        self.assertEqual(chunk_text("a b c d e", 3, 1, word_spans), ["a b c", "c d e"])
+        with self.assertRaises(ValueError):
+            chunk_text("a b c", 2, 2, word_spans)
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_cap(self):
+        '''the least recently used vectors are dropped over max_entries'''
+        with tempfile.TemporaryDirectory() as tmp:
+            embedder = StubEmbedder()
+            cache = EmbeddingCache(os.path.join(tmp, "embeddings.sqlite3"), max_entries=2)
+            cache.embed("stub", ["a", "b"], embedder.embed)
+            cache.embed("stub", ["a"], embedder.embed) # a is now the most recently used
+            cache.embed("stub", ["c"], embedder.embed)
+            self.assertEqual(cache.evictions, 1)
+            cache.embed("stub", ["a", "c", "b"], embedder.embed)
+            self.assertEqual(embedder.embedded, ["a", "b", "c", "b"])
+
+class TestAsyncVectorDB(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_queries_are_batched(self):
+        '''queries within the batch window share one query_many, each caller gets its own top k'''
+        db = FakeVectorDB()
+        async_db = AsyncVectorDB(db, batch_window_s=0.05)
+        results = await asyncio.gather(async_db.query("a", k=1), async_db.query("b", k=3), async_db.query("c", k=2))
+        self.assertEqual(db.batches, [(["a", "b", "c"], 3)])
+        self.assertEqual(results, [["a 0"], ["b 0", "b 1", "b 2"], ["c 0", "c 1"]])
+
+        # a full batch doesn't wait for the window
+        async_db = AsyncVectorDB(db, batch_window_s=60, max_batch=2)
+        results = await asyncio.wait_for(asyncio.gather(async_db.query("d"), async_db.query("e")), timeout=5)
+        self.assertEqual(results, [["d 0"], ["e 0"]])
+        async_db.close()
+
+class TestBM25Index(unittest.TestCase):
+    def test_exact_identifiers_and_persistence(self):
+        '''identifiers rank their chunk first, and the index survives a reload from its file'''
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.bm25.jsonl")
+            index = BM25Index(path)
+            index.add_many([("a", "the connection was reset with ERR_CONN_RESET"),
+                            ("b", "the connection dropped"),
+                            ("c", "pizza is delicious")])
+            index.add_many([("a", "already indexed, ignored")])
+            self.assertEqual(index.query("what does ERR_CONN_RESET mean", k=3)[0][0], "a")
+            self.assertEqual([key for key, _ in index.query("connection", k=3)], ["b", "a"])
+
+            reloaded = BM25Index(path)
+            self.assertEqual(len(reloaded), 3)
+            self.assertEqual(reloaded.query("pizza", k=1)[0][0], "c")
+
+class TestNumpyStore(unittest.TestCase):
+    def test_search_upsert_and_reopen(self):
+        '''exact nearest neighbours, upserts replace in place, and everything survives reopening the files'''
+        with tempfile.TemporaryDirectory() as tmp:
+            store = NumpyStore(tmp, initial_capacity=2)
+            store.upsert(["x", "y", "z"], ["east", "north", "north east"], [[1, 0], [0, 1], [1, 1]], [{}, {}, {}])
+            self.assertEqual(store.search([[1, 0.1], [0, 1]], 2), [["x", "z"], ["y", "z"]])
+            store.upsert(["x"], ["west"], [[-1, 0]], None)
+            self.assertEqual(store.existing(["x", "w"]), {"x"})
+
+            reopened = NumpyStore(tmp, initial_capacity=2)
+            self.assertEqual(reopened.count(), 3)
+            self.assertEqual(reopened.search([[-1, 0]], 1), [["x"]])
+            self.assertEqual(reopened.get(["x", "missing"])[0], {"x": "west"})
+            self.assertEqual(reopened.scan(1, 5), [("y", "north"), ("z", "north east")])
+
+class TestContextSelection(unittest.TestCase):
+    def test_mmr_dedupe_and_pack(self):
+        '''mmr skips near duplicates, overlapping chunks are trimmed and packing respects the budget'''
+        query = [1.0, 0.0]
+        candidates = [[1.0, 0.0], [0.99, 0.01], [0.6, 0.8]]
+        self.assertEqual(mmr(query, candidates, k=2, mmr_lambda=1.0), [0, 1])
+        self.assertEqual(mmr(query, candidates, k=2, mmr_lambda=0.3), [0, 2])
+
+        first = "the quick brown fox jumps over the lazy dog"
+        second = "jumps over the lazy dog and runs into the woods"
+        self.assertEqual(dedupe_chunks([first, second, "quick brown fox"]), [first, "and runs into the woods"])
+
+        words = lambda text: len(text.split())
+        self.assertEqual(pack_chunks(["a b c", "d e f g", "h"], budget_tokens=4, count_tokens=words), ["a b c", "h"])
+
+if __name__ == '__main__':
+    unittest.main()